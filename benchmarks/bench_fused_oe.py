@@ -0,0 +1,88 @@
+"""
+Pixel reads, wall time and accuracy of the observed over expected IPA track calculated in a single pass over the band
+pixels (the 'fused' engine) against the two-pass calculation ('banded' engine): `cooltools.expected_cis` over the whole
+pixel table first, then the band sum. The pixel reads (of both ipa and cooltools) are counted by wrapping the pixel selector
+of the .cool file, so they show the I/O that dominates on network filesystems. The fused track is checked to match the two-pass one.
+
+Example:
+    python benchmarks/bench_fused_oe.py --cool-path file.mcool::resolutions/10000 --min-dist 40000 --max-dist 1000000
+"""
+import argparse
+import math
+import time
+
+import bioframe
+import cooler
+import numpy as np
+
+from ipa.lib import calculate_banded_sum, calculate_fused_oe_sum, calculate_expected, get_expected_arrays
+
+
+class CountingSelector:
+    """
+    Pixel selector of a .cool file that counts the pixels read through it.
+    """
+    def __init__(self, selector, reads):
+        self.selector, self.reads = selector, reads
+
+    def __getitem__(self, key):
+        result = self.selector[key]
+        self.reads[0] += len(result)
+        return result
+
+    def __len__(self):
+        return len(self.selector)
+
+    def __getattr__(self, name):
+        return getattr(self.selector, name)
+
+def count_pixel_reads(clr):
+    """
+    Wrap `clr.pixels` so that the number of pixels read through it is counted in the returned list.
+    """
+    reads = [0]
+    pixels = clr.pixels
+    clr.pixels = lambda *args, **kwargs: CountingSelector(pixels(*args, **kwargs), reads)
+    return reads
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the single-pass observed over expected IPA track against the two-pass calculation.")
+    parser.add_argument("--cool-path", required=True, help="Path to the .cool file or cooler URI.")
+    parser.add_argument("--chroms", nargs="+", default=None, help="Chromosomes to calculate the track for (default: all).")
+    parser.add_argument("--clr-weight-name", default="weight", help="Balancing weight column (default: 'weight').")
+    parser.add_argument("--min-dist", type=int, default=40_000, help="Minimum distance in bp (default: 40_000).")
+    parser.add_argument("--max-dist", type=int, default=100_000, help="Maximum distance in bp (default: 100_000).")
+    parser.add_argument("--rtol", type=float, default=1e-9, help="Relative tolerance of the fused track (default: 1e-9).")
+    args = parser.parse_args()
+
+    clr = cooler.Cooler(args.cool_path)
+    chroms = args.chroms if args.chroms is not None else clr.chromnames
+    min_diag, max_diag = math.floor(args.min_dist / clr.binsize), math.ceil(args.max_dist / clr.binsize)
+
+    # Two passes: expected of all chromosomes, then the band sums
+    reads = count_pixel_reads(clr)
+    start = time.perf_counter()
+    expected_df = calculate_expected(clr, bioframe.make_viewframe(clr.chromsizes.loc[chroms]), 0, args.clr_weight_name, 1)
+    expected_arrs = get_expected_arrays(expected_df, args.clr_weight_name, min_diag)
+    two_pass = {chrom: calculate_banded_sum(clr, chrom, min_diag, max_diag, args.clr_weight_name, expected_arrs[chrom]) for chrom in chroms}
+    two_pass_time, two_pass_reads = time.perf_counter() - start, reads[0]
+
+    # One pass: expected and band sums at once
+    reads[0] = 0
+    start = time.perf_counter()
+    fused = {chrom: calculate_fused_oe_sum(clr, chrom, min_diag, max_diag, args.clr_weight_name) for chrom in chroms}
+    fused_time, fused_reads = time.perf_counter() - start, reads[0]
+
+    print(f"{'calculation':<12}{'time, s':>10}{'pixels read':>16}")
+    print(f"{'two-pass':<12}{two_pass_time:>10.3f}{two_pass_reads:>16,}")
+    print(f"{'fused':<12}{fused_time:>10.3f}{fused_reads:>16,}")
+
+    # Relative error of the fused track (bins without contacts are skipped)
+    track, fused_track = np.concatenate([two_pass[chrom] for chrom in chroms]), np.concatenate([fused[chrom] for chrom in chroms])
+    nonzero = track != 0
+    error = np.max(np.abs(fused_track[nonzero] - track[nonzero]) / np.abs(track[nonzero]), initial=0)
+    print(f"max relative error of the fused track: {error:.2e} (tolerance {args.rtol:.0e})")
+    assert error <= args.rtol, "The fused track does not match the two-pass one"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Parity check and microbenchmark of the kernel backends (see `ipa.kernels`): the band sums, the fused O/E sums and the
+distance profile accumulated from the pixels of a synthetic .cool file, the diagonal masking, the expected matrix and the
+O/E division of whole matrices and row tiles, and the strand flip of a stackup plot are calculated with the 'numpy' and
+the 'numba' backends. The results of both backends are checked to be equal (up to the rounding of the accumulation order),
+and the kernels of whole matrices are also timed on a thread pool, where the 'numba' kernels run in parallel without the GIL.
+numba must be installed; the first call of every kernel (the compilation) is not timed.
+
+Example:
+    python benchmarks/bench_kernels.py --genome-size 100000000 --resolution 10000 --sizes 2000 5000 --threads 4
+"""
+import argparse
+import math
+import os
+import shutil
+import tempfile
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+
+import cooler
+import numpy as np
+
+from synthetic import make_chromsizes, make_synthetic_cool
+from ipa.kernels import set_backend, numba_available
+from ipa.lib import mask_out_diagonals, create_expected_matrix, calculate_observed_over_expected_matrix, calculate_banded_sum, calculate_fused_oe_sum, calculate_distance_profile, flip_stackup
+
+
+def max_relative_error(result, reference):
+    """
+    Largest relative difference of two arrays over the elements where the reference is nonzero, or infinity if their NaN elements differ.
+    """
+    if result.shape != reference.shape or not np.array_equal(np.isnan(result), np.isnan(reference)):
+        return math.inf
+    valid = ~np.isnan(reference) & (reference != 0)
+    return float(np.max(np.abs(result[valid] - reference[valid]) / np.abs(reference[valid]), initial=0.))
+
+def time_function(func, setup, repeat):
+    """
+    Best wall time (in seconds) of `func(setup())` over `repeat` runs, excluding the setup.
+    """
+    timings = []
+    for _ in range(repeat):
+        arg = setup()
+        timings.append(timeit.timeit(lambda: func(arg), number=1))
+    return min(timings)
+
+def run_backends(func, setup, repeat):
+    """
+    Result and best wall time of `func(setup())` with the 'numpy' and the 'numba' backend.
+
+    Returns:
+        A dictionary with the backends as keys and tuples (result, seconds) as values.
+    """
+    results = {}
+    for backend in ('numpy', 'numba'):
+        set_backend(backend)
+        # The first call compiles the kernels of the 'numba' backend
+        result = func(setup())
+        results[backend] = (result, time_function(func, setup, repeat))
+    set_backend('numpy')
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the parity of the 'numpy' and 'numba' kernel backends and benchmark them.")
+    parser.add_argument("--genome-size", type=int, default=50_000_000, help="Genome size of the synthetic .cool file in bp (default: 50_000_000).")
+    parser.add_argument("--resolution", type=int, default=10_000, help="Bin size of the synthetic .cool file in bp (default: 10_000).")
+    parser.add_argument("--min-dist", type=int, default=40_000, help="Minimum distance in bp (default: 40_000).")
+    parser.add_argument("--max-dist", type=int, default=1_000_000, help="Maximum distance in bp (default: 1_000_000).")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 2000, 5000], help="Matrix sizes (number of bins) of the matrix kernels (default: 1000 2000 5000).")
+    parser.add_argument("--nrows", type=int, default=20_000, help="Number of rows (regions) of the stackup plot to flip (default: 20_000).")
+    parser.add_argument("--threads", type=int, default=4, help="Number of threads of the thread pool benchmark, 1 to skip it (default: 4).")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs per measurement, the best one is reported (default: 3).")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random number generator (default: 0).")
+    args = parser.parse_args()
+
+    assert numba_available(), "numba is required to compare the kernel backends"
+    rng = np.random.default_rng(args.seed)
+    min_diag, max_diag = math.floor(args.min_dist / args.resolution), math.ceil(args.max_dist / args.resolution)
+
+    workdir = tempfile.mkdtemp(prefix='ipa_bench_kernels_')
+    try:
+        # Synthetic .cool file, the pixel kernels run on its largest chromosome
+        clr_path = os.path.join(workdir, 'synthetic.cool')
+        make_synthetic_cool(clr_path, make_chromsizes(args.genome_size, 2), args.resolution, max_dist=2 * args.max_dist, seed=args.seed)
+        clr = cooler.Cooler(clr_path)
+        chrom = clr.chromnames[0]
+        chrom_nbins = int(clr.extent(chrom)[1] - clr.extent(chrom)[0])
+        expected_arr = 1 / (np.arange(chrom_nbins) + 1.)
+        expected_arr[:min_diag] = np.nan
+
+        cases = [
+            (f"band sums [{chrom_nbins} bins]", lambda _: calculate_banded_sum(clr, chrom, min_diag, max_diag, 'weight'), lambda: None, 1e-12),
+            (f"band sums O/E [{chrom_nbins} bins]", lambda _: calculate_banded_sum(clr, chrom, min_diag, max_diag, 'weight', expected_arr), lambda: None, 1e-12),
+            (f"band sums float32 [{chrom_nbins} bins]", lambda _: calculate_banded_sum(clr, chrom, min_diag, max_diag, 'weight', dtype=np.float32), lambda: None, 1e-5),
+            (f"fused O/E sums [{chrom_nbins} bins]", lambda _: calculate_fused_oe_sum(clr, chrom, min_diag, max_diag, 'weight'), lambda: None, 1e-12),
+            (f"distance profile [{chrom_nbins} bins]", lambda _: calculate_distance_profile(clr, chrom, max_diag, 'weight'), lambda: None, 1e-12),
+        ]
+        for n in args.sizes:
+            matrix = rng.random((n, n))
+            tile_expected_arr = rng.random(2 * n) + 0.5
+            # The tiles are the second half of the rows and the columns around them, like the row tiles of the 'dense' engine,
+            # and the O/E division expects a masked tile (the arguments of the loop are bound as defaults of the lambdas)
+            row_lo, col_lo = n // 2, max(0, n // 2 - max_diag)
+            masked_matrix = matrix.copy()
+            mask_out_diagonals(masked_matrix, min_diag, max_diag, row_lo, col_lo)
+            cases += [
+                (f"mask_out_diagonals [{n}]", lambda m: (mask_out_diagonals(m, min_diag, max_diag), m)[1], matrix.copy, 0),
+                (f"mask_out_diagonals tile [{n}]", lambda m, row_lo=row_lo, col_lo=col_lo: (mask_out_diagonals(m, min_diag, max_diag, row_lo, col_lo), m)[1], matrix.copy, 0),
+                (f"create_expected_matrix [{n}]", create_expected_matrix, lambda n=n, arr=tile_expected_arr: arr[:n], 0),
+                (f"O/E tile [{n}]", lambda m, arr=tile_expected_arr, row_lo=row_lo, col_lo=col_lo: calculate_observed_over_expected_matrix(m, arr, min_diag, max_diag, row_lo, col_lo), masked_matrix.copy, 1e-15),
+            ]
+        stackup = rng.random((args.nrows, 150))
+        strand = rng.random(args.nrows) < 0.5
+        cases.append((f"flip_stackup [{args.nrows} rows]", lambda s: (flip_stackup(s, strand), s)[1], stackup.copy, 0))
+
+        # Parity and timings of both backends
+        print(f"{'kernel':<40}{'numpy, s':>12}{'numba, s':>12}{'speedup':>10}{'max rel error':>16}")
+        failed = []
+        for name, func, setup, tolerance in cases:
+            results = run_backends(func, setup, args.repeat)
+            (reference, time_numpy), (result, time_numba) = results['numpy'], results['numba']
+            error = max_relative_error(result, reference)
+            print(f"{name:<40}{time_numpy:>12.4f}{time_numba:>12.4f}{time_numpy / time_numba:>9.1f}x{error:>16.2e}{'' if error <= tolerance else '  FAILED'}")
+            if error > tolerance:
+                failed.append(name)
+
+        # Matrix kernels of several matrices on a thread pool: the 'numba' kernels release the GIL
+        if args.threads > 1:
+            n = max(args.sizes)
+            matrices = [rng.random((n, n)) for _ in range(args.threads)]
+            def run_pool(matrices):
+                with ThreadPoolExecutor(max_workers=args.threads) as pool:
+                    list(pool.map(lambda m: mask_out_diagonals(m, min_diag, max_diag, n // 2, 0), matrices))
+            print(f"\n{'thread pool':<40}{'numpy, s':>12}{'numba, s':>12}{'speedup':>10}")
+            results = run_backends(run_pool, lambda: [m.copy() for m in matrices], args.repeat)
+            time_numpy, time_numba = results['numpy'][1], results['numba'][1]
+            print(f"{f'mask_out_diagonals tile x{args.threads} [{n}]':<40}{time_numpy:>12.4f}{time_numba:>12.4f}{time_numpy / time_numba:>9.1f}x")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    assert not failed, f"The 'numba' backend does not match the 'numpy' backend: {', '.join(failed)}"
+
+if __name__ == "__main__":
+    main()
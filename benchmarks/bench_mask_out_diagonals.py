@@ -0,0 +1,99 @@
+"""
+Microbenchmark of the vectorized `mask_out_diagonals` and `create_expected_matrix` against
+the previous implementations that looped over diagonals with `np.fill_diagonal`.
+The results of both implementations are checked to be bit-identical.
+
+Example:
+    python benchmarks/bench_mask_out_diagonals.py --sizes 2000 5000 --min-diag 10 --max-diag 250
+"""
+import argparse
+import timeit
+
+import numpy as np
+
+from ipa.lib import mask_out_diagonals, create_expected_matrix
+
+
+def mask_out_diagonals_loop(matrix, min_diag, max_diag):
+    """
+    Previous implementation of `ipa.lib.mask_out_diagonals` (two `np.fill_diagonal` calls per diagonal).
+    """
+    mask_diagonal_above = lambda matrix, k: np.fill_diagonal(matrix[:, k:], np.nan) if matrix.shape[1] - k > 0 else None
+    mask_diagonal_below = lambda matrix, k: np.fill_diagonal(matrix[k:, :], np.nan) if matrix.shape[0] - k > 0 else None
+
+    for k in range(min_diag):
+        if k == 0:
+            np.fill_diagonal(matrix, np.nan)
+        else:
+            mask_diagonal_above(matrix, k)
+            mask_diagonal_below(matrix, k)
+
+    if max_diag is not None:
+        for k in range(max_diag + 1, matrix.shape[0]):
+            mask_diagonal_above(matrix, k)
+            mask_diagonal_below(matrix, k)
+
+def create_expected_matrix_loop(expected_arr):
+    """
+    Previous implementation of `ipa.lib.create_expected_matrix` (two `np.fill_diagonal` calls per diagonal).
+    """
+    n = len(expected_arr)
+    matrix = np.zeros((n, n), dtype=expected_arr.dtype)
+    np.fill_diagonal(matrix, expected_arr[0])
+    for k in range(1, n):
+        np.fill_diagonal(matrix[:, k:], expected_arr[k])
+        np.fill_diagonal(matrix[k:, :], expected_arr[k])
+
+    return matrix
+
+def bit_identical(a, b):
+    """
+    Check that two float arrays have the same shape and the same bytes (NaN payloads included).
+    """
+    return a.shape == b.shape and a.tobytes() == b.tobytes()
+
+def time_function(func, setup, repeat):
+    """
+    Best wall time (in seconds) of `func(setup())` over `repeat` runs, excluding the setup.
+    """
+    timings = []
+    for _ in range(repeat):
+        arg = setup()
+        timings.append(timeit.timeit(lambda: func(arg), number=1))
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark vectorized diagonal masking against the per-diagonal loop.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 2000, 5000], help="Matrix sizes (number of bins) to benchmark (default: 1000 2000 5000).")
+    parser.add_argument("--min-diag", type=int, default=10, help="Number of first diagonals to mask out (default: 10).")
+    parser.add_argument("--max-diag", type=int, default=250, help="Last diagonal to keep (default: 250).")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs per measurement, the best one is reported (default: 3).")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'function':<24}{'n':>8}{'loop, s':>12}{'vectorized, s':>16}{'speedup':>10}  bit-identical")
+    for n in args.sizes:
+        matrix = rng.random((n, n))
+        expected_arr = rng.random(n)
+
+        # Check that the results are bit-identical
+        matrix_loop, matrix_vectorized = matrix.copy(), matrix.copy()
+        mask_out_diagonals_loop(matrix_loop, args.min_diag, args.max_diag)
+        mask_out_diagonals(matrix_vectorized, args.min_diag, args.max_diag)
+        mask_identical = bit_identical(matrix_loop, matrix_vectorized)
+        expected_identical = bit_identical(create_expected_matrix_loop(expected_arr), create_expected_matrix(expected_arr))
+        del matrix_loop, matrix_vectorized
+
+        # Time both implementations
+        time_loop = time_function(lambda m: mask_out_diagonals_loop(m, args.min_diag, args.max_diag), matrix.copy, args.repeat)
+        time_vectorized = time_function(lambda m: mask_out_diagonals(m, args.min_diag, args.max_diag), matrix.copy, args.repeat)
+        print(f"{'mask_out_diagonals':<24}{n:>8}{time_loop:>12.4f}{time_vectorized:>16.4f}{time_loop / time_vectorized:>9.1f}x  {mask_identical}")
+
+        time_loop = time_function(create_expected_matrix_loop, lambda: expected_arr, args.repeat)
+        time_vectorized = time_function(create_expected_matrix, lambda: expected_arr, args.repeat)
+        print(f"{'create_expected_matrix':<24}{n:>8}{time_loop:>12.4f}{time_vectorized:>16.4f}{time_loop / time_vectorized:>9.1f}x  {expected_identical}")
+
+        assert mask_identical and expected_identical, "Vectorized results are not bit-identical to the loop implementation"
+
+if __name__ == "__main__":
+    main()
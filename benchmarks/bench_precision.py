@@ -0,0 +1,81 @@
+"""
+Peak memory, wall time and accuracy of the IPA track calculation in float32 against float64, for one
+chromosome of a .cool file. Peak memory is measured with `tracemalloc` (NumPy reports its allocations to it).
+The float32 track is checked to stay within the documented relative tolerance of the float64 one.
+
+Example:
+    python benchmarks/bench_precision.py --cool-path file.mcool::resolutions/10000 --chrom chr1 --engine dense --expected
+"""
+import argparse
+import time
+import tracemalloc
+
+import cooler
+import numpy as np
+
+from ipa.lib import fetch_cis_matrix, mask_out_diagonals, calculate_observed_over_expected_matrix, calculate_row_sum, calculate_banded_sum, calculate_fused_oe_sum, calculate_expected, get_expected_arrays
+
+
+def calculate_track(clr, chrom, engine, min_diag, max_diag, clr_weight_name, expected_arr, dtype):
+    """
+    IPA track of a chromosome, as calculated by `ipa.ipa._ipa_track_tiles`.
+    """
+    if engine == 'fused':
+        return calculate_fused_oe_sum(clr, chrom, min_diag, max_diag, clr_weight_name, dtype=dtype)
+    if engine == 'banded':
+        return calculate_banded_sum(clr, chrom, min_diag, max_diag, clr_weight_name, expected_arr, dtype=dtype)
+
+    cis_matrix = fetch_cis_matrix(clr, chrom, clr_weight_name, dtype)
+    mask_out_diagonals(cis_matrix, min_diag, max_diag)
+    if expected_arr is not None:
+        cis_matrix = calculate_observed_over_expected_matrix(cis_matrix, expected_arr, min_diag, max_diag)
+    return calculate_row_sum(cis_matrix)
+
+def measure(func):
+    """
+    Result, wall time (in seconds) and peak traced memory (in bytes) of `func()`.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the float32 IPA track calculation against float64.")
+    parser.add_argument("--cool-path", required=True, help="Path to the .cool file or cooler URI.")
+    parser.add_argument("--chrom", required=True, help="Chromosome to calculate the track for.")
+    parser.add_argument("--engine", choices=["banded", "dense", "fused"], default="dense", help="Engine to calculate the track with, 'fused' needs --expected (default: 'dense').")
+    parser.add_argument("--expected", action="store_true", default=False, help="Calculate the observed over expected track (default: False).")
+    parser.add_argument("--clr-weight-name", default="weight", help="Balancing weight column (default: 'weight').")
+    parser.add_argument("--min-dist", type=int, default=40_000, help="Minimum distance in bp (default: 40_000).")
+    parser.add_argument("--max-dist", type=int, default=100_000, help="Maximum distance in bp (default: 100_000).")
+    parser.add_argument("--rtol", type=float, default=1e-5, help="Documented relative tolerance of the float32 track (default: 1e-5).")
+    args = parser.parse_args()
+
+    clr = cooler.Cooler(args.cool_path)
+    min_diag, max_diag = args.min_dist // clr.binsize, -(-args.max_dist // clr.binsize)
+
+    assert args.engine != 'fused' or args.expected, "The 'fused' engine calculates the observed over expected track only"
+    expected_arr = None
+    if args.expected and args.engine != 'fused':
+        import bioframe
+        expected_df = calculate_expected(clr, bioframe.make_viewframe(clr.chromsizes), 0, args.clr_weight_name, 1)
+        expected_arr = get_expected_arrays(expected_df, args.clr_weight_name, min_diag)[args.chrom]
+
+    tracks = {}
+    print(f"{'precision':<12}{'time, s':>10}{'peak memory, MB':>18}")
+    for dtype in (np.float64, np.float32):
+        tracks[dtype], elapsed, peak = measure(lambda: calculate_track(clr, args.chrom, args.engine, min_diag, max_diag, args.clr_weight_name, expected_arr, dtype))
+        print(f"{np.dtype(dtype).name:<12}{elapsed:>10.3f}{peak / 1e6:>18.1f}")
+
+    # Relative error of the float32 track (bins without contacts are skipped)
+    nonzero = tracks[np.float64] != 0
+    error = np.nanmax(np.abs(tracks[np.float32][nonzero] - tracks[np.float64][nonzero]) / np.abs(tracks[np.float64][nonzero]))
+    print(f"max relative error of float32: {error:.2e} (tolerance {args.rtol:.0e})")
+    assert error <= args.rtol, "The float32 track is outside of the documented tolerance"
+
+if __name__ == "__main__":
+    main()
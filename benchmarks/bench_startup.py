@@ -0,0 +1,73 @@
+"""
+Startup time of the `ipa` command-line interface: `ipa --help` and the imports that `ipa track` and
+`ipa plot` need before they start reading data. Every measurement runs in a fresh interpreter.
+The script also checks that every command imports only the heavy dependencies it uses, and exits
+with an error if a command imports a forbidden module or exceeds the time budget.
+
+Example:
+    python benchmarks/bench_startup.py --repeat 5 --max-seconds 1.5
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+# Code run by every command before it reads data, and heavy modules it must not import
+COMMANDS = {
+    "ipa --help": {
+        "code": "import sys; sys.argv = ['ipa', '--help']\nfrom ipa.cli import main\ntry:\n    main()\nexcept SystemExit:\n    pass",
+        "forbidden": ["numpy", "pandas", "cooler", "cooltools", "bioframe", "bbi", "matplotlib"],
+    },
+    "ipa track": {
+        "code": "import ipa.cli\nfrom ipa import ipa_track\nimport cooler",
+        "forbidden": ["cooltools", "matplotlib"],
+    },
+    "ipa plot": {
+        "code": "import ipa.cli\nfrom ipa import ipa_plot\nimport bbi",
+        "forbidden": ["cooler", "cooltools", "bioframe", "matplotlib"],
+    },
+}
+
+HEAVY_MODULES = ["numpy", "pandas", "cooler", "cooltools", "bioframe", "bbi", "matplotlib", "numba"]
+
+
+def run_command(code):
+    """
+    Run `code` in a fresh interpreter and return the wall time (in seconds) and the heavy modules it imported.
+    """
+    # Print the list of imported heavy modules on the last line of stdout
+    report = f"\nimport json as _json, sys as _sys\nprint(_json.dumps([m for m in {HEAVY_MODULES!r} if m in _sys.modules]))"
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", code + report], capture_output=True, text=True, check=True)
+    elapsed = time.perf_counter() - start
+    return elapsed, json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the startup time of the ipa command-line interface.")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs per command, the best one is reported (default: 5).")
+    parser.add_argument("--max-seconds", type=float, default=None, help="Fail if the best startup time of any command exceeds this budget in seconds (default: None).")
+    args = parser.parse_args()
+
+    # Interpreter startup alone, for reference
+    baseline = min(run_command("pass")[0] for _ in range(args.repeat))
+    print(f"{'command':<14}{'best, s':>10}{'over python, s':>16}  heavy modules")
+    print(f"{'python':<14}{baseline:>10.3f}{0:>16.3f}")
+
+    failures = []
+    for name, command in COMMANDS.items():
+        runs = [run_command(command["code"]) for _ in range(args.repeat)]
+        best = min(elapsed for elapsed, _ in runs)
+        modules = runs[0][1]
+        print(f"{name:<14}{best:>10.3f}{best - baseline:>16.3f}  {', '.join(modules) or '-'}")
+
+        forbidden = [module for module in modules if module in command["forbidden"]]
+        if forbidden:
+            failures.append(f"`{name}` imports {', '.join(forbidden)}")
+        if args.max_seconds is not None and best > args.max_seconds:
+            failures.append(f"`{name}` takes {best:.3f} s (budget {args.max_seconds} s)")
+
+    assert not failures, "Startup regression: " + "; ".join(failures)
+
+if __name__ == "__main__":
+    main()
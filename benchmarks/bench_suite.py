@@ -0,0 +1,264 @@
+"""
+Benchmark suite of the IPA pipeline on synthetic data (see `synthetic.py`): generates a .cool file, a bigWig signal and a BED file
+of the given genome size and resolution, times every stage (the masking and expected matrix kernels, `ipa_track` with every engine,
+`create_stackup_plot`) with its peak memory, and writes the results to a JSON file, so that runs can be compared with `--baseline-json`.
+Peak memory is measured with `tracemalloc` (NumPy reports its allocations to it).
+
+Before timing, a correctness oracle checks every engine against the dense implementation (whole cis matrices) on a small
+synthetic .cool file: the 'banded' and 'fused' engines, row tiles of the 'dense' engine, the distance profile index,
+float32 precision and the 'numba' kernel backend (if numba is installed), with and without the expected. The suite exits with an error if any of them is outside its tolerance.
+
+Example:
+    python benchmarks/bench_suite.py --genome-size 200000000 --resolution 10000 --output-json bench.json
+    python benchmarks/bench_suite.py --genome-size 200000000 --resolution 10000 --output-json bench_new.json --baseline-json bench.json
+"""
+import argparse
+import importlib
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import bioframe
+import numpy as np
+import pandas as pd
+
+from synthetic import make_synthetic_dataset
+from ipa import ipa_track, ipa_index
+from ipa.kernels import get_backend, set_backend, numba_available
+from ipa.ipa import _get_cooler, _ipa_track_tiles, _ipa_track_from_index
+from ipa.lib import mask_out_diagonals, create_expected_matrix, calculate_expected, get_expected_arrays, estimate_track_memory, split_track_tiles, create_stackup_plot
+from ipa.writers import track_output_path
+
+
+def measure(func):
+    """
+    Result, wall time (in seconds) and peak traced memory (in bytes) of `func()`.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def max_relative_error(track, reference):
+    """
+    Largest relative difference of two tracks over the bins where the reference is nonzero, or infinity if their missing bins differ.
+    """
+    if not np.array_equal(np.isnan(track), np.isnan(reference)):
+        return math.inf
+    valid = ~np.isnan(reference) & (reference != 0)
+    return float(np.max(np.abs(track[valid] - reference[valid]) / np.abs(reference[valid]), initial=0.))
+
+def calculate_tracks(clr_path, engine, expected_arrs, min_diag, max_diag, precision='float64', max_memory=None):
+    """
+    IPA track of every chromosome of a .cool file, calculated by `ipa.ipa._ipa_track_tiles` with the given engine (row tiles with `max_memory`).
+    """
+    clr = _get_cooler(clr_path)
+    chrom_nbins = {chrom: int(clr.extent(chrom)[1] - clr.extent(chrom)[0]) for chrom in clr.chromnames}
+    tiles = split_track_tiles(chrom_nbins, engine, expected_arrs is not None, max_diag, max_memory, np.dtype(precision))
+
+    tracks = {chrom: np.full(nbins, np.nan) for chrom, nbins in chrom_nbins.items()}
+    for chrom, row_lo, tile_track in _ipa_track_tiles(clr_path, tiles, expected_arrs, 'weight', min_diag, max_diag, engine, precision):
+        tracks[chrom][row_lo:row_lo + len(tile_track)] = tile_track
+    return tracks
+
+def with_backend(backend, func):
+    """
+    Result of `func()` calculated with the given kernel backend (see `ipa.kernels`), the previous backend is restored afterwards.
+    """
+    previous = get_backend()
+    set_backend(backend)
+    try:
+        return func()
+    finally:
+        set_backend(previous)
+
+def run_oracle(workdir, genome_size, resolution, min_dist, max_dist, seed):
+    """
+    Check every engine against the dense implementation on a small synthetic .cool file.
+
+    Returns:
+        A list of dictionaries with the 'name' of every check, its 'max_rel_error', 'tolerance' and whether it 'passed'.
+    """
+    dataset = make_synthetic_dataset(os.path.join(workdir, 'oracle'), genome_size, 3, resolution, max_dist=2 * max_dist, nregions=100, seed=seed)
+    clr_path = dataset['cool']
+    clr = _get_cooler(clr_path)
+    min_diag, max_diag = math.floor(min_dist / resolution), math.ceil(max_dist / resolution)
+    expected_df = calculate_expected(clr, bioframe.make_viewframe(clr.chromsizes), 0, 'weight', 1)
+    expected_arrs = get_expected_arrays(expected_df, 'weight', min_diag)
+
+    # Index of the distance profiles with and without the expected
+    index_paths = {expected: ipa_index(clr_path, os.path.join(workdir, 'oracle', 'index'), 2 * max_dist, expected, 'weight', 1, os.path.join(workdir, 'oracle', 'cache'))
+                   for expected in (False, True)}
+
+    checks = []
+    for expected in (False, True):
+        arrs = expected_arrs if expected else None
+        reference = calculate_tracks(clr_path, 'dense', arrs, min_diag, max_diag)
+        candidates = {
+            'banded': (lambda: calculate_tracks(clr_path, 'banded', arrs, min_diag, max_diag), 1e-9),
+            'dense row tiles': (lambda: calculate_tracks(clr_path, 'dense', arrs, min_diag, max_diag, max_memory=estimate_track_memory(100, 'dense', expected, max_diag)), 1e-9),
+            'index': (lambda: _ipa_track_from_index(index_paths[expected], clr_path, clr, expected, 'weight', min_diag, max_diag), 1e-9),
+            'banded float32': (lambda: calculate_tracks(clr_path, 'banded', arrs, min_diag, max_diag, 'float32'), 1e-5),
+            'dense float32': (lambda: calculate_tracks(clr_path, 'dense', arrs, min_diag, max_diag, 'float32'), 1e-5),
+        }
+        if expected:
+            candidates['fused'] = (lambda: calculate_tracks(clr_path, 'fused', None, min_diag, max_diag), 1e-9)
+
+        # JIT-compiled kernels (optional)
+        if numba_available():
+            candidates['banded numba'] = (lambda: with_backend('numba', lambda: calculate_tracks(clr_path, 'banded', arrs, min_diag, max_diag)), 1e-9)
+            candidates['dense row tiles numba'] = (lambda: with_backend('numba', lambda: calculate_tracks(clr_path, 'dense', arrs, min_diag, max_diag, max_memory=estimate_track_memory(100, 'dense', expected, max_diag))), 1e-9)
+            if expected:
+                candidates['fused numba'] = (lambda: with_backend('numba', lambda: calculate_tracks(clr_path, 'fused', None, min_diag, max_diag)), 1e-9)
+
+        for name, (calculate, tolerance) in candidates.items():
+            tracks = calculate()
+            error = max(max_relative_error(tracks[chrom], reference[chrom]) for chrom in reference)
+            checks.append({'name': f"{name}{' (expected)' if expected else ''}", 'max_rel_error': error, 'tolerance': tolerance, 'passed': error <= tolerance})
+
+    return checks
+
+def run_stages(dataset, workdir, engines, min_dist, max_dist, flank, nbins, dense_max_bins):
+    """
+    Time every stage of the pipeline on the synthetic dataset.
+
+    Returns:
+        A list of dictionaries with the 'name', 'seconds' and 'peak_memory_mb' of every stage (or 'skipped' with the reason).
+    """
+    clr = _get_cooler(dataset['cool'])
+    resolution = clr.binsize
+    min_diag, max_diag = math.floor(min_dist / resolution), math.ceil(max_dist / resolution)
+    stages = []
+
+    def add_stage(name, func):
+        _, elapsed, peak = measure(func)
+        stages.append({'name': name, 'seconds': elapsed, 'peak_memory_mb': peak / 1e6})
+        print(f"{name:<40}{elapsed:>10.3f}{peak / 1e6:>18.1f}")
+
+    def skip_stage(name, reason):
+        stages.append({'name': name, 'skipped': reason})
+        print(f"{name:<40}  skipped: {reason}")
+
+    # Warm up: import the modules that ipa imports lazily and compile the numba kernels of cooltools (on the smallest chromosome),
+    # so that neither is attributed to the first stage that uses them
+    importlib.import_module('bbi')
+    calculate_expected(clr, bioframe.make_viewframe(clr.chromsizes.iloc[-1:]), 0, 'weight', 1)
+
+    print(f"{'stage':<40}{'time, s':>10}{'peak memory, MB':>18}")
+
+    # Dense kernels on a matrix of the largest chromosome
+    chrom_nbins = max(int(hi - lo) for lo, hi in map(clr.extent, clr.chromnames))
+    if chrom_nbins <= dense_max_bins:
+        rng = np.random.default_rng(0)
+        matrix = rng.random((chrom_nbins, chrom_nbins))
+        expected_arr = 1 / np.arange(1, chrom_nbins + 1)
+        add_stage(f"mask_out_diagonals [{chrom_nbins} bins]", lambda: mask_out_diagonals(matrix, min_diag, max_diag))
+        add_stage(f"create_expected_matrix [{chrom_nbins} bins]", lambda: create_expected_matrix(expected_arr))
+        del matrix
+    else:
+        skip_stage('dense kernels', f"the largest chromosome has {chrom_nbins} bins (more than --dense-max-bins)")
+
+    # IPA track with every engine, every run with its own cache (so the time of the expected is included)
+    track_paths = []
+    for engine in engines:
+        for expected in ((True,) if engine == 'fused' else (False, True)):
+            name = f"ipa_track [{engine}{', expected' if expected else ''}]"
+            if engine == 'dense' and chrom_nbins > dense_max_bins:
+                skip_stage(name, f"the largest chromosome has {chrom_nbins} bins (more than --dense-max-bins)")
+                continue
+            output_dir = os.path.join(workdir, 'tracks', f"{engine}{'_oe' if expected else ''}")
+            track_paths.append(track_output_path(output_dir))
+            add_stage(name, lambda: ipa_track(dataset['cool'], output_dir, expected, 'weight', min_dist, max_dist, 1, engine,
+                                              cache_dir=os.path.join(output_dir, 'cache')))
+
+    # Stackup plots of the IPA track and of the signal, without the cache
+    roi_df = pd.read_csv(dataset['bed'], sep='\t', header=None, names=['chrom', 'start', 'end', 'name', 'score', 'strand'])
+    if track_paths:
+        add_stage(f"create_stackup_plot [ipa track, {len(roi_df)} roi]", lambda: create_stackup_plot(track_paths[0], roi_df, flank, nbins))
+    add_stage(f"create_stackup_plot [signal, {len(roi_df)} roi]", lambda: create_stackup_plot(dataset['bigwig'], roi_df, flank, nbins))
+
+    return stages
+
+def compare_with_baseline(stages, baseline_path):
+    """
+    Print the speedup of every stage over the same stage of a baseline JSON file.
+    """
+    with open(baseline_path) as f:
+        baseline = {stage['name']: stage for stage in json.load(f)['stages'] if 'seconds' in stage}
+
+    print(f"\n{'stage':<40}{'baseline, s':>12}{'time, s':>10}{'speedup':>10}")
+    for stage in stages:
+        if 'seconds' in stage and stage['name'] in baseline:
+            baseline_seconds = baseline[stage['name']]['seconds']
+            print(f"{stage['name']:<40}{baseline_seconds:>12.3f}{stage['seconds']:>10.3f}{baseline_seconds / stage['seconds']:>9.2f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the IPA pipeline on synthetic data and check the engines against the dense implementation.")
+    parser.add_argument("--genome-size", type=int, default=100_000_000, help="Genome size of the synthetic dataset in bp (default: 100_000_000).")
+    parser.add_argument("--nchroms", type=int, default=4, help="Number of chromosomes (default: 4).")
+    parser.add_argument("--resolution", type=int, default=10_000, help="Bin size of the synthetic .cool file in bp (default: 10_000).")
+    parser.add_argument("--min-dist", type=int, default=40_000, help="Minimum distance in bp (default: 40_000).")
+    parser.add_argument("--max-dist", type=int, default=1_000_000, help="Maximum distance in bp (default: 1_000_000).")
+    parser.add_argument("--nregions", type=int, default=5000, help="Number of regions of interest (default: 5000).")
+    parser.add_argument("--flank", type=int, default=100_000, help="Flank size of the stackup plots in bp (default: 100_000).")
+    parser.add_argument("--nbins", type=int, default=50, help="Number of bins of the stackup plots (default: 50).")
+    parser.add_argument("--engines", nargs="+", choices=["banded", "dense", "fused"], default=["banded", "dense", "fused"], help="Engines to time (default: all).")
+    parser.add_argument("--dense-max-bins", type=int, default=20_000, help="Skip the dense stages for chromosomes with more bins (default: 20_000).")
+    parser.add_argument("--oracle-genome-size", type=int, default=6_000_000, help="Genome size of the synthetic dataset of the correctness oracle in bp, 0 to skip it (default: 6_000_000).")
+    parser.add_argument("--kernel-backend", choices=["numpy", "numba", "auto"], default="numpy", help="Kernel backend of the timed stages, see `ipa.kernels` (default: 'numpy').")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random number generator (default: 0).")
+    parser.add_argument("--workdir", default=None, help="Directory for the synthetic files and the outputs; a temporary directory that is removed at the end if not set (default: None).")
+    parser.add_argument("--output-json", default=None, help="Path to the JSON file to write the results to (default: None).")
+    parser.add_argument("--baseline-json", default=None, help="Path to the JSON file of a previous run to compare the stage times with (default: None).")
+    args = parser.parse_args()
+
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix='ipa_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        # Correctness oracle on small inputs
+        checks = []
+        if args.oracle_genome_size:
+            checks = run_oracle(workdir, args.oracle_genome_size, args.resolution, args.min_dist, args.max_dist, args.seed)
+            print(f"{'oracle check':<40}{'max rel error':>15}{'tolerance':>12}")
+            for check in checks:
+                print(f"{check['name']:<40}{check['max_rel_error']:>15.2e}{check['tolerance']:>12.0e}{'' if check['passed'] else '  FAILED'}")
+            print()
+
+        # Synthetic dataset and the timed stages
+        dataset, elapsed, _ = measure(lambda: make_synthetic_dataset(os.path.join(workdir, 'data'), args.genome_size, args.nchroms, args.resolution,
+                                                                     max_dist=2 * args.max_dist, nregions=args.nregions, seed=args.seed))
+        print(f"synthetic dataset generated in {elapsed:.1f} s\n")
+        stages = with_backend(args.kernel_backend, lambda: run_stages(dataset, workdir, args.engines, args.min_dist, args.max_dist, args.flank, args.nbins, args.dense_max_bins))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.baseline_json is not None:
+        compare_with_baseline(stages, args.baseline_json)
+
+    if args.output_json is not None:
+        import cooler
+        results = {
+            'params': {key: value for key, value in vars(args).items() if key not in ('workdir', 'output_json', 'baseline_json')},
+            'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'numpy': np.__version__,
+                            'pandas': pd.__version__, 'cooler': cooler.__version__},
+            'oracle': checks,
+            'stages': stages,
+        }
+        with open(args.output_json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if not all(check['passed'] for check in checks):
+        sys.exit("Some engines do not match the dense implementation")
+
+if __name__ == "__main__":
+    main()
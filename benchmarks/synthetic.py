@@ -0,0 +1,215 @@
+"""
+Synthetic inputs for the benchmarks: a balanced .cool file with distance decay, a compartment checkerboard and loops,
+a bigWig signal with peaks at the loop anchors, and a BED file of stranded regions of interest, all on the same genome.
+The contact counts are drawn from a Poisson model with per-bin biases, so the balancing weights are known exactly
+(the inverse biases) and the files need no balancing step. Bins with zero bias are gaps without contacts (weight NaN).
+
+Example:
+    python benchmarks/synthetic.py --output-dir synthetic --genome-size 100000000 --nchroms 4 --resolution 10000
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def make_chromsizes(genome_size, nchroms):
+    """
+    Chromosome sizes of a synthetic genome: `nchroms` chromosomes of decreasing size that add up to about `genome_size` bp.
+
+    Returns:
+        pandas Series with the chromosome sizes in bp, named chr1, chr2, ...
+    """
+    weights = np.linspace(1.5, 0.5, nchroms)
+    sizes = np.round(genome_size * weights / weights.sum()).astype(np.int64)
+    return pd.Series(sizes, index=[f"chr{i + 1}" for i in range(nchroms)])
+
+def make_loop_anchors(chromsizes, loop_spacing, seed=None):
+    """
+    Positions of the loop anchors of every chromosome: one anchor about every `loop_spacing` bp, with jitter.
+
+    Returns:
+        Dictionary with chromosome names as keys and sorted NumPy 1D arrays of anchor positions in bp as values.
+    """
+    rng = np.random.default_rng(seed)
+    anchors = {}
+    for chrom, size in chromsizes.items():
+        positions = np.arange(loop_spacing // 2, size, loop_spacing)
+        positions = positions + rng.integers(-loop_spacing // 4, loop_spacing // 4 + 1, len(positions))
+        anchors[chrom] = np.sort(np.clip(positions, 0, size - 1))
+    return anchors
+
+def make_synthetic_cool(path, chromsizes, resolution, max_dist=2_000_000, decay=-1.0, depth=50.0, compartment_strength=0.3,
+                        compartment_size=1_000_000, loop_anchors=None, loop_strength=5.0, max_loop_dist=500_000, gap_fraction=0.02, seed=None):
+    """
+    Write a synthetic .cool file. The expected count of a pixel (i, j) at distance d = j - i bins is
+    `depth * b_i * b_j * (d + 1) ** decay * (1 + compartment_strength * s_i * s_j)`, with the bin biases b and the compartment
+    signs s (blocks of about `compartment_size` bp), and `loop_strength` times more at the pixels between consecutive loop anchors.
+    Pixels are drawn up to `max_dist` only, so that the file stays small for large genomes.
+
+    Args:
+        path: Path to the output .cool file.
+        chromsizes: pandas Series with the chromosome sizes in bp.
+        resolution: Bin size in bp.
+        max_dist: Maximum distance of the drawn pixels in bp (default: 2_000_000).
+        decay: Exponent of the contact probability decay with distance (default: -1.0).
+        depth: Expected count at the main diagonal (default: 50.0).
+        compartment_strength: Amplitude of the compartment checkerboard (default: 0.3).
+        compartment_size: Mean size of the compartment blocks in bp (default: 1_000_000).
+        loop_anchors: (optional) Dictionary with the loop anchor positions of every chromosome, see `make_loop_anchors` (default: None).
+        loop_strength: Enrichment of the loop pixels over the decay (default: 5.0).
+        max_loop_dist: Maximum distance between the anchors of a loop in bp (default: 500_000).
+        gap_fraction: Fraction of the bins without contacts (default: 0.02).
+        seed: (optional) Seed of the random number generator (default: None).
+
+    Returns:
+        Path to the .cool file.
+    """
+    import cooler
+
+    rng = np.random.default_rng(seed)
+    max_diag = max_dist // resolution
+
+    bins, pixels, offset = [], [], 0
+    for chrom, size in chromsizes.items():
+        nbins = -(-int(size) // resolution)
+        starts = np.arange(nbins, dtype=np.int64) * resolution
+
+        # Bin biases (gaps have zero bias) and compartment signs
+        biases = rng.lognormal(0, 0.3, nbins)
+        biases[rng.random(nbins) < gap_fraction] = 0.
+        signs = np.repeat(np.where(np.arange(nbins) % 2 == 0, 1., -1.), rng.geometric(min(resolution / compartment_size, 1.), nbins))[:nbins]
+
+        # Loop pixels between consecutive anchors (first bin and diagonal of every loop)
+        loop_bin1, loop_diags = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        if loop_anchors is not None:
+            anchor_bins = loop_anchors[chrom] // resolution
+            loop_bin1, loop_diags = anchor_bins[:-1], np.diff(anchor_bins)
+            keep = (loop_diags > 0) & (loop_diags * resolution <= max_loop_dist)
+            loop_bin1, loop_diags = loop_bin1[keep], loop_diags[keep]
+
+        # Draw the counts diagonal by diagonal
+        chrom_bin1, chrom_bin2, chrom_counts = [], [], []
+        for diag in range(min(max_diag, nbins - 1) + 1):
+            bin1 = np.arange(nbins - diag)
+            bin2 = bin1 + diag
+            rates = depth * biases[bin1] * biases[bin2] * (diag + 1.) ** decay * (1 + compartment_strength * signs[bin1] * signs[bin2])
+            rates[loop_bin1[loop_diags == diag]] *= loop_strength
+            counts = rng.poisson(rates)
+            nonzero = counts > 0
+            chrom_bin1.append(bin1[nonzero])
+            chrom_bin2.append(bin2[nonzero])
+            chrom_counts.append(counts[nonzero])
+        chrom_bin1, chrom_bin2, chrom_counts = np.concatenate(chrom_bin1), np.concatenate(chrom_bin2), np.concatenate(chrom_counts)
+
+        # Pixels sorted by (bin1, bin2) with genome-wide bin ids
+        order = np.lexsort((chrom_bin2, chrom_bin1))
+        pixels.append(pd.DataFrame({'bin1_id': chrom_bin1[order] + offset, 'bin2_id': chrom_bin2[order] + offset, 'count': chrom_counts[order]}))
+
+        # The balancing weights are the inverse biases (scaled so that the balanced contacts follow the decay)
+        weights = np.full(nbins, np.nan)
+        weights[biases > 0] = 1 / (np.sqrt(depth) * biases[biases > 0])
+        bins.append(pd.DataFrame({'chrom': chrom, 'start': starts, 'end': np.minimum(starts + resolution, int(size)), 'weight': weights}))
+        offset += nbins
+
+    cooler.create_cooler(path, pd.concat(bins, ignore_index=True), pd.concat(pixels, ignore_index=True), ordered=True, dtypes={'count': np.int32})
+    return path
+
+def make_synthetic_bigwig(path, chromsizes, step=1000, loop_anchors=None, peak_height=5.0, peak_width=5000, seed=None):
+    """
+    Write a synthetic bigWig signal (e.g. an ATAC-Seq track) with one value every `step` bp: noise around 1, with Gaussian peaks at the loop anchors.
+
+    Args:
+        path: Path to the output bigWig file.
+        chromsizes: pandas Series with the chromosome sizes in bp.
+        step: Size of the intervals in bp (default: 1000).
+        loop_anchors: (optional) Dictionary with the anchor positions of every chromosome, see `make_loop_anchors` (default: None).
+        peak_height: Height of the peaks over the background (default: 5.0).
+        peak_width: Standard deviation of the peaks in bp (default: 5000).
+        seed: (optional) Seed of the random number generator (default: None).
+
+    Returns:
+        Path to the bigWig file.
+    """
+    from ipa.writers import open_track_writer, write_track_chrom, close_track_writer
+
+    rng = np.random.default_rng(seed)
+    writer = open_track_writer(path, 'bigwig', chromsizes, step)
+    for chrom, size in chromsizes.items():
+        centers = np.arange(-(-int(size) // step)) * step + step / 2
+        signal = rng.gamma(4., 0.25, len(centers))
+        if loop_anchors is not None:
+            for anchor in loop_anchors[chrom]:
+                lo, hi = np.searchsorted(centers, [anchor - 4 * peak_width, anchor + 4 * peak_width])
+                signal[lo:hi] += peak_height * np.exp(-0.5 * ((centers[lo:hi] - anchor) / peak_width) ** 2)
+        write_track_chrom(writer, chrom, signal)
+    close_track_writer(writer)
+    return path
+
+def make_synthetic_bed(path, chromsizes, nregions, min_size=1000, max_size=100_000, flank=100_000, seed=None):
+    """
+    Write a BED file with `nregions` random stranded regions of interest (e.g. genes) with log-uniform sizes,
+    placed so that their flanks stay inside the chromosomes.
+
+    Args:
+        path: Path to the output BED file.
+        chromsizes: pandas Series with the chromosome sizes in bp.
+        nregions: Number of regions.
+        min_size: Minimum size of a region in bp (default: 1000).
+        max_size: Maximum size of a region in bp (default: 100_000).
+        flank: Size of the flanks that stay inside the chromosomes in bp (default: 100_000).
+        seed: (optional) Seed of the random number generator (default: None).
+
+    Returns:
+        Path to the BED file.
+    """
+    rng = np.random.default_rng(seed)
+    chroms = rng.choice(chromsizes.index.to_numpy(), nregions, p=(chromsizes / chromsizes.sum()).to_numpy())
+    sizes = np.exp(rng.uniform(np.log(min_size), np.log(max_size), nregions)).astype(np.int64)
+    chrom_ends = chromsizes[chroms].to_numpy()
+    starts = (flank + rng.random(nregions) * np.maximum(chrom_ends - sizes - 2 * flank, 0)).astype(np.int64)
+
+    roi_df = pd.DataFrame({'chrom': chroms, 'start': starts, 'end': starts + sizes, 'name': [f"region{i}" for i in range(nregions)],
+                           'score': 0, 'strand': rng.choice(['+', '-'], nregions)})
+    roi_df['chrom'] = pd.Categorical(roi_df['chrom'], categories=chromsizes.index, ordered=True)
+    roi_df.sort_values(['chrom', 'start']).to_csv(path, sep='\t', header=False, index=False)
+    return path
+
+def make_synthetic_dataset(output_dir, genome_size=100_000_000, nchroms=4, resolution=10_000, max_dist=2_000_000, nregions=5000, loop_spacing=200_000, seed=0):
+    """
+    Write a synthetic dataset to `output_dir`: 'synthetic.cool', 'signal.bw' and 'roi.bed' on the same genome, with peaks of the signal at the loop anchors.
+
+    Returns:
+        Dictionary with the paths to the 'cool', 'bigwig' and 'bed' files and the 'chromsizes'.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    chromsizes = make_chromsizes(genome_size, nchroms)
+    anchors = make_loop_anchors(chromsizes, loop_spacing, rng)
+
+    return {
+        'cool': make_synthetic_cool(os.path.join(output_dir, 'synthetic.cool'), chromsizes, resolution, max_dist, loop_anchors=anchors, seed=rng),
+        'bigwig': make_synthetic_bigwig(os.path.join(output_dir, 'signal.bw'), chromsizes, loop_anchors=anchors, seed=rng),
+        'bed': make_synthetic_bed(os.path.join(output_dir, 'roi.bed'), chromsizes, nregions, seed=rng),
+        'chromsizes': chromsizes,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic .cool file, bigWig signal and BED file for the benchmarks.")
+    parser.add_argument("--output-dir", required=True, help="Directory to write synthetic.cool, signal.bw and roi.bed to.")
+    parser.add_argument("--genome-size", type=int, default=100_000_000, help="Genome size in bp (default: 100_000_000).")
+    parser.add_argument("--nchroms", type=int, default=4, help="Number of chromosomes (default: 4).")
+    parser.add_argument("--resolution", type=int, default=10_000, help="Bin size of the .cool file in bp (default: 10_000).")
+    parser.add_argument("--max-dist", type=int, default=2_000_000, help="Maximum distance of the pixels in bp (default: 2_000_000).")
+    parser.add_argument("--nregions", type=int, default=5000, help="Number of regions of interest (default: 5000).")
+    parser.add_argument("--loop-spacing", type=int, default=200_000, help="Mean distance between loop anchors in bp (default: 200_000).")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random number generator (default: 0).")
+    args = parser.parse_args()
+
+    paths = make_synthetic_dataset(args.output_dir, args.genome_size, args.nchroms, args.resolution, args.max_dist, args.nregions, args.loop_spacing, args.seed)
+    for name in ('cool', 'bigwig', 'bed'):
+        print(f"{name:<8}{paths[name]}")
+
+if __name__ == "__main__":
+    main()
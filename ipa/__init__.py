@@ -1,3 +1,12 @@
-from .ipa import ipa, ipa_track, ipa_plot
+import importlib
 
-__all__ = ["ipa", "ipa_track", "ipa_plot"]
+__all__ = ["ipa", "ipa_track", "ipa_track_batch", "ipa_plot", "ipa_plot_batch", "ipa_index", "ipa_merge"]
+
+
+def __getattr__(name):
+    # Import the API (numpy, pandas) on first use only, so that `ipa --help` does not pay for it
+    if name in __all__:
+        module = importlib.import_module(f"{__name__}.ipa")
+        globals().update({api_name: getattr(module, api_name) for api_name in __all__})
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import warnings
+
+import pandas as pd
+
+
+def split_cooler_uri(clr_path):
+    """
+    Split a cooler URI, e.g. 'file.mcool::resolutions/5000', into the file path and the group path.
+
+    Args:
+        clr_path: Path to the .cool file or cooler URI.
+
+    Returns:
+        A tuple (file path, group path). The group path is '/' for a plain .cool file.
+    """
+    if '::' in clr_path:
+        file_path, group_path = clr_path.split('::', 1)
+        return file_path, '/' + group_path.lstrip('/')
+    return clr_path, '/'
+
+def file_identity(file_path):
+    """
+    Identity of a file used in cache keys: absolute path, size and modification time.
+    A cache entry is invalidated as soon as the file is rewritten.
+
+    Args:
+        file_path: Path to the file.
+
+    Returns:
+        A dictionary with the file identity.
+    """
+    stat = os.stat(file_path)
+    return {'path': os.path.realpath(file_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def make_cache_key(**params):
+    """
+    Build a short hash from the parameters that identify a cache entry.
+
+    Args:
+        params: JSON-serializable parameters.
+
+    Returns:
+        A hexadecimal string.
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+# Name of the default cache directory inside the output directory
+CACHE_DIR_NAME = '.ipa_cache'
+
+def get_cache_dir(output_dir, cache_dir=None):
+    """
+    Get the directory for cached intermediate results (expected, stackup plots) and create it if needed.
+    By default it is the '.ipa_cache' directory inside the output directory, so nothing is written next to the input files.
+
+    Args:
+        output_dir: Path to the output directory, or None if there is no output directory (then only `cache_dir` is used).
+        cache_dir: (optional) Path to the cache directory that overrides the default one, or False to disable the cache (default: None).
+
+    Returns:
+        Path to the cache directory or None if the cache is disabled or the directory cannot be created (then the results are not cached).
+    """
+    if cache_dir is False or (cache_dir is None and output_dir is None):
+        return None
+    if cache_dir is None:
+        cache_dir = os.path.join(output_dir, CACHE_DIR_NAME)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError as error:
+        warnings.warn(f"Cannot create cache directory {cache_dir} ({error}). Intermediate results will not be cached.")
+        return None
+    return cache_dir
+
+def expected_cache_path(clr_path, resolution, clr_weight_name, ignore_diags, cache_dir):
+    """
+    Get the path to the cached expected of a .cool file. The cache entry is keyed by the .cool file identity,
+    the resolution, the balancing weight name and the number of ignored diagonals.
+
+    Args:
+        clr_path: Path to the .cool file or cooler URI.
+        resolution: Resolution of the .cool file in bp.
+        clr_weight_name: The name of the column in the .cool file that contains the balancing weights.
+        ignore_diags: Number of first diagonals ignored in the calculation of expected.
+        cache_dir: Path to the cache directory (see `get_cache_dir`) or None if the results are not cached.
+
+    Returns:
+        Path to the cache file (.tsv) or None if the results are not cached.
+    """
+    if cache_dir is None:
+        return None
+    file_path, group_path = split_cooler_uri(clr_path)
+    key = make_cache_key(file=file_identity(file_path), group=group_path, resolution=resolution,
+                         clr_weight_name=clr_weight_name, ignore_diags=ignore_diags)
+    return os.path.join(cache_dir, f"expected_{resolution}bp_{key}.tsv")
+
+def hash_roi(roi_df):
+    """
+    Hash the regions of interest (ROI): coordinates and strands of all regions, in order.
+
+    Args:
+        roi_df: DataFrame with the region of interest (ROI) information.
+
+    Returns:
+        A hexadecimal string.
+    """
+    columns = [column for column in ['chrom', 'start', 'end', 'strand'] if column in roi_df.columns]
+    return hashlib.sha1(pd.util.hash_pandas_object(roi_df[columns], index=False).to_numpy().tobytes()).hexdigest()[:16]
+
+def stackup_cache_path(cache_dir, bw_file, roi_df, flank, nbins):
+    """
+    Get the path to the cached stackup plot of a bigWig file. The cache entry is keyed by the bigWig file identity,
+    the hash of the regions of interest (after filtering by size), the flank size and the number of bins.
+
+    Args:
+        cache_dir: Path to the cache directory.
+        bw_file: Path to the bigWig file.
+        roi_df: DataFrame with the region of interest (ROI) information.
+        flank: Size of the flanking regions in bp.
+        nbins: Number of bins to split the ROI into.
+
+    Returns:
+        Path to the cache file (.npy).
+    """
+    key = make_cache_key(file=file_identity(bw_file), roi=hash_roi(roi_df), flank=flank, nbins=nbins)
+    return os.path.join(cache_dir, f"stackup_{os.path.basename(bw_file).split('.')[0]}_{key}.npy")
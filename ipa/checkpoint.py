@@ -0,0 +1,158 @@
+import json
+import os
+import re
+
+import numpy as np
+
+from ipa.cache import file_identity, make_cache_key, split_cooler_uri
+
+
+MANIFEST_NAME = "ipa_manifest.json"
+
+def track_key(clr_path, expected, clr_weight_name, min_diag, max_diag, precision):
+    """
+    Build the key of an IPA track from the .cool file identity and the parameters that change the track values.
+    The engine, the number of workers and the memory budget do not change the track, so they are not part of the key.
+
+    Args:
+        clr_path: Path to the .cool file or cooler URI.
+        expected: If True, the track is based on the observed over expected matrix.
+        clr_weight_name: The name of the column in the .cool file that contains the balancing weights.
+        min_diag: First diagonal of the band.
+        max_diag: Last diagonal of the band (None if the band is not restricted from above).
+        precision: Floating point precision of the contact values ('float32' or 'float64').
+
+    Returns:
+        A hexadecimal string.
+    """
+    file_path, group_path = split_cooler_uri(clr_path)
+    return make_cache_key(file=file_identity(file_path), group=group_path, expected=expected, clr_weight_name=clr_weight_name,
+                          min_diag=min_diag, max_diag=max_diag, precision=precision)
+
+def track_checkpoint_dir(output_dir, key):
+    """
+    Get the directory for the per-chromosome checkpoints of the IPA track with the given key.
+    """
+    return os.path.join(output_dir, "checkpoints", f"ipa_track_{key}")
+
+def checkpoint_path(checkpoint_dir, chrom_index, chrom):
+    """
+    Get the path to the checkpoint (.npy) of a chromosome. The chromosome index keeps names unique
+    after the characters that are not safe in file names are replaced.
+    """
+    return os.path.join(checkpoint_dir, f"{chrom_index}_{re.sub(r'[^A-Za-z0-9_.-]', '_', chrom)}.npy")
+
+def save_checkpoint(checkpoint_dir, chrom_index, chrom, ipa_track):
+    """
+    Save the IPA track of a finished chromosome. The file is written under a temporary name first,
+    so that an interrupted run never leaves a broken checkpoint.
+
+    Args:
+        checkpoint_dir: Path to the checkpoint directory (see `track_checkpoint_dir`).
+        chrom_index: Index of the chromosome in the .cool file.
+        chrom: Chromosome name.
+        ipa_track: NumPy 1D array with the IPA track of the chromosome.
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    path = checkpoint_path(checkpoint_dir, chrom_index, chrom)
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, ipa_track)
+    os.replace(path + '.tmp', path)
+
+def load_checkpoints(checkpoint_dir, chromnames):
+    """
+    Load the IPA tracks of the chromosomes that were finished by a previous run.
+
+    Args:
+        checkpoint_dir: Path to the checkpoint directory (see `track_checkpoint_dir`).
+        chromnames: List of chromosome names of the .cool file.
+
+    Returns:
+        A dictionary with chromosome names as keys and NumPy 1D arrays with the IPA track as values.
+    """
+    ipa_tracks = {}
+    for chrom_index, chrom in enumerate(chromnames):
+        path = checkpoint_path(checkpoint_dir, chrom_index, chrom)
+        if os.path.isfile(path):
+            ipa_tracks[chrom] = np.load(path)
+
+    return ipa_tracks
+
+def load_manifest(output_dir):
+    """
+    Load the manifest of an output directory: a JSON file with the key and the output files of every finished step.
+
+    Returns:
+        A dictionary {step: {'key': key, 'outputs': {path: file identity}}}, empty if there is no (readable) manifest.
+    """
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def is_step_done(output_dir, step, key):
+    """
+    Check that a step was finished with the same key and that none of its output files have changed since then.
+
+    Args:
+        output_dir: Path to the output directory with the manifest.
+        step: Name of the step, e.g. 'track:ipa_track.bw' or 'plot:sig1_sig2.png'.
+        key: Key of the step inputs and parameters.
+
+    Returns:
+        True if the step can be skipped.
+    """
+    entry = load_manifest(output_dir).get(step)
+    if entry is None or entry['key'] != key:
+        return False
+    return all(os.path.isfile(path) and file_identity(path) == identity for path, identity in entry['outputs'].items())
+
+def mark_step_done(output_dir, step, key, output_files):
+    """
+    Record a finished step with its key and the identity of its output files in the manifest of the output directory.
+
+    Args:
+        output_dir: Path to the output directory with the manifest.
+        step: Name of the step, e.g. 'track:ipa_track.bw' or 'plot:sig1_sig2.png'.
+        key: Key of the step inputs and parameters.
+        output_files: List of paths to the output files of the step.
+    """
+    manifest = load_manifest(output_dir)
+    manifest[step] = {'key': key, 'outputs': {path: file_identity(path) for path in output_files}}
+
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def shard_output_path(output_dir, shard, nshards):
+    """
+    Get the path to the partial IPA track file of shard `shard` (1-based) of `nshards`.
+    """
+    return os.path.join(output_dir, f"ipa_track.shard-{shard}-of-{nshards}.npz")
+
+def save_shard(path, metadata, tile_tracks):
+    """
+    Save the partial IPA track of a shard: the tracks of its row tiles and the metadata that `ipa_merge` checks. The file is
+    written under a temporary name first, so that an interrupted run never leaves a broken shard.
+
+    Args:
+        path: Path to the shard file (see `shard_output_path`).
+        metadata: JSON-serializable dictionary with the shard metadata.
+        tile_tracks: List of tuples (chrom, row_lo, NumPy 1D array with the IPA track of the tile rows).
+    """
+    tiles = [[chrom, int(row_lo), int(row_lo + len(ipa_track))] for chrom, row_lo, ipa_track in tile_tracks]
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, metadata=np.array(json.dumps({**metadata, 'tiles': tiles})), **{f"tile_{i}": ipa_track for i, (_, _, ipa_track) in enumerate(tile_tracks)})
+    os.replace(path + '.tmp', path)
+
+def load_shard(path):
+    """
+    Open the partial IPA track file of a shard (see `save_shard`).
+
+    Returns:
+        A tuple (dictionary with the shard metadata, with the row tiles in 'tiles', NpzFile that loads the track of tile i as 'tile_{i}').
+    """
+    shard_file = np.load(path)
+    return json.loads(str(shard_file['metadata'])), shard_file
@@ -1,5 +1,27 @@
 import argparse
-from ipa import ipa, ipa_track, ipa_plot
+import logging
+
+# Choices of the options shared by several commands
+# (not imported from the library modules, so that `ipa --help` starts fast)
+ENGINES = ["banded", "dense", "fused"]
+PRECISIONS = ["float32", "float64"]
+TRACK_FORMATS = ["bigwig", "bedgraph", "hdf5", "npz"]
+KERNEL_BACKENDS = ["numpy", "numba", "auto"]
+
+# Help of the options shared by several commands
+ENGINE_HELP = "Engine to calculate the IPA track with: 'banded' reads only the pixels inside the [min_dist, max_dist] diagonal band from the .cool file, 'dense' fetches the whole cis matrix of every chromosome into memory, 'fused' calculates the observed over expected track (--expected) in a single pass over the band pixels, accumulating the expected in the same pass (default: 'banded')."
+NWORKERS_HELP = "Number of worker processes that calculate chromosomes of the IPA track in parallel, largest chromosome first (default: 1)."
+MAX_MEMORY_HELP = "Memory budget for the IPA track calculation in bytes or with a unit suffix, e.g. 16G. Limits how many large chromosomes are calculated at once; with the dense engine, chromosomes that do not fit into the budget of a worker are split into row tiles that overlap by --max-dist. The peak RSS is reported at the end (default: None)."
+INDEX_PATH_HELP = "Path to the cumulative distance profile index (.npy) built by `ipa index` for the .cool file. If set, the IPA track is calculated from the index without reading pixels from the .cool file (default: None)."
+PRECISION_HELP = "Floating point precision of the contact values for the IPA track calculation. 'float32' halves the memory of the dense engine; sums are always accumulated in float64 (default: 'float64')."
+CI_HELP = "Confidence level of the bootstrap interval and of the null band (default: 0.95)."
+GAPS_PATH_HELP = "Path to a BED file with the gaps (e.g. assembly gaps or blacklisted regions) that the shifted ROI of --n-perm with their flanks avoid (default: None)."
+SEED_HELP = "Seed of the random number generator of --n-boot and --n-perm, for reproducible bands (default: None)."
+METRICS_JSON_HELP = "Path to a JSON file to write stage-level metrics of the run to: wall time, pixels read, bins, bytes written and peak RSS of every stage (e.g. every row tile of the IPA track and every stackup plot) per sample and chromosome, with the totals and the throughput of every stage. If not set, no metrics are recorded (default: None)."
+PROFILE_PATH_HELP = "Path to save a profile of the run to: an HTML report of pyinstrument if the path ends with .html (pyinstrument must be installed), otherwise cProfile statistics (e.g. run.prof) that can be read with pstats or snakeviz. Only the main process is profiled, not the worker processes of --nworkers (default: None)."
+KERNEL_BACKEND_HELP = "Backend of the inner loops of the calculation: 'numpy' (vectorized NumPy code), 'numba' (JIT-compiled kernels that release the GIL, numba must be installed) or 'auto' ('numba' if numba is installed, otherwise 'numpy'). Both backends give the same results. If not set, the backend is taken from the IPA_KERNEL_BACKEND environment variable, 'numpy' by default (default: None)."
+EXPECTED_CACHE_DIR_HELP = "Path to the directory to cache the expected in. If not set, the expected is cached in the .ipa_cache directory of the output directory, see --no-cache (default: None)."
+EXPECTED_NO_CACHE_HELP = "If set, the expected is not cached, and no cache directory is created (default: False)."
 
 def main():
     parser = argparse.ArgumentParser(prog="ipa", description="Interaction Pattern Aggregation (IPA)")
@@ -17,22 +39,74 @@ def main():
     parser.add_argument("--min-dist", "--min_dist", type=int, default=40_000, required=False, help="Minimum distance (in bp) between two loci to consider for the IPA calculation, e.g. minimum loop size in bp. If None, restriction on minimum distance is not applied (default: 40_000).")
     parser.add_argument("--max-dist", "--max_dist", type=int, default=100_000, required=False, help="Maximum distance (in bp) between two loci to consider for the IPA calculation, e.g. maximum loop size in bp. If None, restriction on maximum distance is not applied (default: 100_000).")
     parser.add_argument("--nproc", "-np", type=int, default=4, required=False, help="Number of processes to use for the calculation of expected (default: 4).")
+    parser.add_argument("--engine", choices=ENGINES, default="banded", required=False, help=ENGINE_HELP)
+    parser.add_argument("--nworkers", type=int, default=1, required=False, help=NWORKERS_HELP)
+    parser.add_argument("--max-memory", "--max_memory", default=None, required=False, help=MAX_MEMORY_HELP)
+    parser.add_argument("--cache-dir", "--cache_dir", default=None, required=False, help="Path to the directory to cache the expected and the stackup plots in. If not set, they are cached in the .ipa_cache directory of the output directory, see --no-cache (default: None).")
+    parser.add_argument("--no-cache", "--no_cache", action="store_true", default=False, required=False, help="If set, the expected and the stackup plots are not cached, and no cache directory is created (default: False).")
+    parser.add_argument("--index-path", "--index_path", default=None, required=False, help=INDEX_PATH_HELP)
+    parser.add_argument("--precision", choices=PRECISIONS, default="float64", required=False, help=PRECISION_HELP)
+    parser.add_argument("--resume", action="store_true", default=False, required=False, help="If True, resumes a killed run: the chromosomes of the IPA track finished by a previous run with the same .cool file and parameters are loaded from their checkpoints in the output directory, and the track and the plots recorded as finished in the manifest of the output directory with unchanged inputs are skipped (default: False).")
+    parser.add_argument("--roi-only", "--roi_only", action="store_true", default=False, required=False, help="If True, calculates the IPA track only for the bins inside the ROI extended by --flank and creates its stackup plot in memory, without writing the genome-wide .bw file; --engine, --max-memory and --index-path are not used (default: False).")
     parser.add_argument("--roi-start-name", "--roi_start_name", default=None, required=False, help="Alias for the start of the region of interest, e.g. TSS or loop start (default: None).")
     parser.add_argument("--roi-end-name", "--roi_end_name", default=None, required=False, help="Alias for the end of the region of interest, e.g. TES or loop end (default: None).")
     parser.add_argument("--flank", type=int, default=100_000, required=False, help="Size of the flanking regions in bp (default: 100_000).")
     parser.add_argument("--nbins", type=int, default=50, required=False, help="Number of bins for the stackup plot (default: 50).")
     parser.add_argument("--min-roi-size", "--min_roi_size", type=int, default=None, required=False, help="Minimum size of the region of interest (ROI) in bp to filter out small regions in the roi file (default: None).")
     parser.add_argument("--max-roi-size", "--max_roi_size", type=int, default=None, required=False, help="Maximum size of the region of interest (ROI) in bp to filter out large regions in the roi file (default: None).")
+    parser.add_argument("--profiles-only", "--profiles_only", action="store_true", default=False, required=False, help="If True, writes the aggregated profiles (mean, median, SEM and number of values per bin) to tables instead of rendering the plots. The plots can be rendered later with `ipa render` (default: False).")
+    parser.add_argument("--profile-format", "--profile_format", choices=["tsv", "parquet"], default="tsv", required=False, help="Format of the profile tables written with --profiles-only (default: 'tsv').")
+    parser.add_argument("--n-boot", "--n_boot", type=int, default=0, required=False, help="Number of bootstrap resamples of the ROI for the confidence interval of every profile, drawn as a band on the plot or written to the 'ci_low' and 'ci_high' columns of the profile tables. If 0, no interval is calculated (default: 0).")
+    parser.add_argument("--n-perm", "--n_perm", type=int, default=0, required=False, help="Number of random sets of shifted ROI for the empirical null of every profile: every ROI is moved to a random position on its chromosome, and the null mean, the null band and the per-bin empirical p-value are drawn on the plots or written to the 'null_mean', 'null_low', 'null_high' and 'p_value' columns of the profile tables. If 0, no null is calculated (default: 0).")
+    parser.add_argument("--ci", type=float, default=0.95, required=False, help=CI_HELP)
+    parser.add_argument("--gaps-path", "--gaps_path", default=None, required=False, help=GAPS_PATH_HELP)
+    parser.add_argument("--seed", type=int, default=None, required=False, help=SEED_HELP)
+    parser.add_argument("--metrics-json", "--metrics_json", default=None, required=False, help=METRICS_JSON_HELP)
+    parser.add_argument("--profile-path", "--profile_path", default=None, required=False, help=PROFILE_PATH_HELP)
+    parser.add_argument("--kernel-backend", "--kernel_backend", choices=KERNEL_BACKENDS, default=None, required=False, help=KERNEL_BACKEND_HELP)
 
     # IPA track arguments
     parser_track = subparsers.add_parser("track", help="Calculate the IPA track from a .cool file")
-    parser_track.add_argument("--cool-path", "--cool_path", "-c", required=True, help="Path to the .cool file. Keep in mind that chromosome names in the .cool file and in all the files that will be used in the ipa_plot() function (e.g. TSS-TES sites, ATAC-Seq signal .bw file) should match each other.")
+    parser_track_input = parser_track.add_mutually_exclusive_group(required=True)
+    parser_track_input.add_argument("--cool-path", "--cool_path", "-c", help="Path to the .cool file. Keep in mind that chromosome names in the .cool file and in all the files that will be used in the ipa_plot() function (e.g. TSS-TES sites, ATAC-Seq signal .bw file) should match each other.")
+    parser_track_input.add_argument("--jobs-path", "--jobs_path", "-j", help="Path to a tab-separated job table to calculate several IPA tracks on one shared worker pool (batch mode), one row per track with the column 'cool_path' and the optional columns 'resolution' (comma-separated list for an .mcool file), 'min_dist', 'max_dist', 'expected', 'clr_weight_name' and 'name'. Empty values take the values of the options below. Every track is written to a subdirectory of the output directory.")
     parser_track.add_argument("--output-dir", "--output_dir", "-o", required=True, help="Path to create the output directory which will store the output .bw file.")
     parser_track.add_argument("--expected", "-e", action="store_true", default=False, required=False, help="If True, generates an IPA track based on the observed over expected matrix (default: False).")
     parser_track.add_argument("--clr-weight-name", "--clr_weight_name", "-b", default="weight", required=False, help="The name of the column in the .cool file that contains the balancing weights (default: 'weight').")
     parser_track.add_argument("--min-dist", "--min_dist", type=int, default=40_000, required=False, help="Minimum distance (in bp) between two loci to consider for the IPA calculation, e.g. minimum loop size in bp. If None, restriction on minimum distance is not applied (default: 40_000).")
     parser_track.add_argument("--max-dist", "--max_dist", type=int, default=100_000, required=False, help="Maximum distance (in bp) between two loci to consider for the IPA calculation, e.g. maximum loop size in bp. If None, restriction on maximum distance is not applied (default: 100_000).")
     parser_track.add_argument("--nproc", "-np", type=int, default=4, required=False, help="Number of processes to use for the calculation of expected (default: 4).")
+    parser_track.add_argument("--engine", choices=ENGINES, default="banded", required=False, help=ENGINE_HELP)
+    parser_track.add_argument("--nworkers", type=int, default=1, required=False, help=NWORKERS_HELP)
+    parser_track.add_argument("--max-memory", "--max_memory", default=None, required=False, help=MAX_MEMORY_HELP)
+    parser_track.add_argument("--cache-dir", "--cache_dir", default=None, required=False, help=EXPECTED_CACHE_DIR_HELP)
+    parser_track.add_argument("--no-cache", "--no_cache", action="store_true", default=False, required=False, help=EXPECTED_NO_CACHE_HELP)
+    parser_track.add_argument("--index-path", "--index_path", default=None, required=False, help=INDEX_PATH_HELP)
+    parser_track.add_argument("--precision", choices=PRECISIONS, default="float64", required=False, help=PRECISION_HELP)
+    parser_track.add_argument("--resume", action="store_true", default=False, required=False, help="If True, resumes a killed run: the chromosomes of the IPA track finished by a previous run with the same .cool file and parameters are loaded from their checkpoints in the output directory, and the track is skipped if it is up to date (default: False).")
+    parser_track.add_argument("--output-format", "--output_format", choices=TRACK_FORMATS, default="bigwig", required=False, help="Format of the IPA track file: 'bigwig' (ipa_track.bw), 'bedgraph' (ipa_track.bedGraph), 'hdf5' (ipa_track.h5) or 'npz' (ipa_track.npz) with one array per chromosome. Every chromosome is written as soon as it is calculated, and bins without contacts are skipped in the bigWig and bedGraph files (default: 'bigwig').")
+    parser_track.add_argument("--shard", default=None, required=False, help="Shard of the IPA track to calculate as i/N (1 <= i <= N), e.g. to split the track over N cluster nodes. The row tiles of all chromosomes are split into N shards with about the same number of pixels (large chromosomes into row segments), and only shard i is calculated and saved to the partial track file ipa_track.shard-i-of-N.npz in the output directory. The shards are assembled into the track file by `ipa merge` (default: None).")
+    parser_track.add_argument("--metrics-json", "--metrics_json", default=None, required=False, help=METRICS_JSON_HELP)
+    parser_track.add_argument("--profile-path", "--profile_path", default=None, required=False, help=PROFILE_PATH_HELP)
+    parser_track.add_argument("--kernel-backend", "--kernel_backend", choices=KERNEL_BACKENDS, default=None, required=False, help=KERNEL_BACKEND_HELP)
+
+    # IPA index arguments
+    parser_index = subparsers.add_parser("index", help="Build the cumulative distance profile index of a .cool file, to calculate IPA tracks for any [min_dist, max_dist] range without reading the .cool file again")
+    parser_index.add_argument("--cool-path", "--cool_path", "-c", required=True, help="Path to the .cool file.")
+    parser_index.add_argument("--output-dir", "--output_dir", "-o", required=True, help="Path to create the output directory which will store the index files.")
+    parser_index.add_argument("--max-dist", "--max_dist", type=int, default=1_000_000, required=False, help="Maximum distance (in bp) covered by the index. The index can be used for any --max-dist up to this one (default: 1_000_000).")
+    parser_index.add_argument("--expected", "-e", action="store_true", default=False, required=False, help="If True, the index is based on the observed over expected matrix (default: False).")
+    parser_index.add_argument("--clr-weight-name", "--clr_weight_name", "-b", default="weight", required=False, help="The name of the column in the .cool file that contains the balancing weights (default: 'weight').")
+    parser_index.add_argument("--nproc", "-np", type=int, default=4, required=False, help="Number of processes to use for the calculation of expected (default: 4).")
+    parser_index.add_argument("--cache-dir", "--cache_dir", default=None, required=False, help=EXPECTED_CACHE_DIR_HELP)
+    parser_index.add_argument("--no-cache", "--no_cache", action="store_true", default=False, required=False, help=EXPECTED_NO_CACHE_HELP)
+    parser_index.add_argument("--kernel-backend", "--kernel_backend", choices=KERNEL_BACKENDS, default=None, required=False, help=KERNEL_BACKEND_HELP)
+
+    # IPA merge arguments
+    parser_merge = subparsers.add_parser("merge", help="Assemble the IPA track from the partial track files of its shards calculated by `ipa track --shard`")
+    parser_merge.add_argument("--shard-paths", "--shard_paths", "-s", nargs="+", required=True, help="Paths to the partial track files (ipa_track.shard-i-of-N.npz) or to the directories with them.")
+    parser_merge.add_argument("--output-dir", "--output_dir", "-o", required=True, help="Path to the output directory which will store the track file.")
+    parser_merge.add_argument("--output-format", "--output_format", choices=TRACK_FORMATS, default="bigwig", required=False, help="Format of the IPA track file, see `ipa track` (default: 'bigwig').")
 
     # IPA plot arguments
     parser_plot = subparsers.add_parser("plot", help="Create an Interaction Pattern Aggregation (IPA) plot for a given region of interest (ROI) using up to two bigWig files.")
@@ -46,35 +120,120 @@ def main():
     parser_plot.add_argument("--nbins", type=int, default=50, required=False, help="Number of bins for the stackup plot (default: 50).")
     parser_plot.add_argument("--min-roi-size", "--min_roi_size", type=int, default=None, required=False, help="Minimum size of the region of interest (ROI) in bp to filter out small regions in the roi file (default: None).")
     parser_plot.add_argument("--max-roi-size", "--max_roi_size", type=int, default=None, required=False, help="Maximum size of the region of interest (ROI) in bp to filter out large regions in the roi file (default: None).")
+    parser_plot.add_argument("--cache-dir", "--cache_dir", default=None, required=False, help="Path to the directory to cache the stackup plots in. If not set, they are cached in the .ipa_cache directory of the output directory, see --no-cache (default: None).")
+    parser_plot.add_argument("--no-cache", "--no_cache", action="store_true", default=False, required=False, help="If set, the stackup plots are not cached, and no cache directory is created (default: False).")
+    parser_plot.add_argument("--profiles-only", "--profiles_only", action="store_true", default=False, required=False, help="If True, writes the aggregated profiles (mean, median, SEM and number of values per bin) to a table instead of rendering the plot. The plot can be rendered later with `ipa render` (default: False).")
+    parser_plot.add_argument("--profile-format", "--profile_format", choices=["tsv", "parquet"], default="tsv", required=False, help="Format of the profile table written with --profiles-only (default: 'tsv').")
+    parser_plot.add_argument("--n-boot", "--n_boot", type=int, default=0, required=False, help="Number of bootstrap resamples of the ROI for the confidence interval of every profile, drawn as a band on the plot or written to the 'ci_low' and 'ci_high' columns of the profile table. If 0, no interval is calculated (default: 0).")
+    parser_plot.add_argument("--n-perm", "--n_perm", type=int, default=0, required=False, help="Number of random sets of shifted ROI for the empirical null of every profile: every ROI is moved to a random position on its chromosome, and the null mean, the null band and the per-bin empirical p-value are drawn on the plot or written to the 'null_mean', 'null_low', 'null_high' and 'p_value' columns of the profile table. If 0, no null is calculated (default: 0).")
+    parser_plot.add_argument("--ci", type=float, default=0.95, required=False, help=CI_HELP)
+    parser_plot.add_argument("--gaps-path", "--gaps_path", default=None, required=False, help=GAPS_PATH_HELP)
+    parser_plot.add_argument("--seed", type=int, default=None, required=False, help=SEED_HELP)
+    parser_plot.add_argument("--metrics-json", "--metrics_json", default=None, required=False, help=METRICS_JSON_HELP)
+    parser_plot.add_argument("--profile-path", "--profile_path", default=None, required=False, help=PROFILE_PATH_HELP)
+    parser_plot.add_argument("--kernel-backend", "--kernel_backend", choices=KERNEL_BACKENDS, default=None, required=False, help=KERNEL_BACKEND_HELP)
+
+    # IPA render arguments
+    parser_render = subparsers.add_parser("render", help="Render IPA plots from the profile tables written by `ipa plot --profiles-only` or `ipa --profiles-only`.")
+    parser_render.add_argument("--profiles-path", "--profiles_path", "-p", nargs="+", required=True, help="Path(s) to the profile tables (.tsv or .parquet).")
+    parser_render.add_argument("--output-dir", "--output_dir", "-o", required=True, help="Path to the output directory which will store the output plot files.")
+    parser_render.add_argument("--roi-start-name", "--roi_start_name", default=None, required=False, help="Alias for the start of the region of interest, e.g. TSS or loop start (default: None).")
+    parser_render.add_argument("--roi-end-name", "--roi_end_name", default=None, required=False, help="Alias for the end of the region of interest, e.g. TES or loop end (default: None).")
+    parser_render.add_argument("--nproc", "-np", type=int, default=4, required=False, help="Number of processes to render the plots with (default: 4).")
+
+    # IPA serve arguments
+    parser_serve = subparsers.add_parser("serve", help="Run a local query service that keeps .cool and bigWig files open and answers region-scoped IPA track and stackup profile requests over HTTP.")
+    parser_serve.add_argument("--host", default="127.0.0.1", required=False, help="Host to listen on (default: '127.0.0.1').")
+    parser_serve.add_argument("--port", type=int, default=8765, required=False, help="Port to listen on (default: 8765).")
+    parser_serve.add_argument("--socket-path", "--socket_path", default=None, required=False, help="Path to a Unix socket to listen on instead of --host and --port (default: None).")
+    parser_serve.add_argument("--nworkers", type=int, default=4, required=False, help="Number of threads that calculate the requests concurrently (default: 4).")
+    parser_serve.add_argument("--cache-size", "--cache_size", default="1G", required=False, help="Memory budget of the LRU cache of band sums and bigWig intervals in bytes or with a unit suffix, e.g. 4G (default: '1G').")
+    parser_serve.add_argument("--block-size", "--block_size", type=int, default=1_000, required=False, help="Number of bins of the cached blocks of band sums. Requested regions are covered by whole blocks, so that overlapping and neighbouring regions reuse them (default: 1_000).")
+    parser_serve.add_argument("--cache-dir", "--cache_dir", default=None, required=False, help="Path to the directory to cache the expected in. If not set, the expected is kept in the LRU cache only (default: None).")
+    parser_serve.add_argument("--kernel-backend", "--kernel_backend", choices=KERNEL_BACKENDS, default=None, required=False, help=KERNEL_BACKEND_HELP)
 
     args = parser.parse_args()
 
-    # Handle the different command cases
-    if args.command == "track":
-        ipa_track(args.cool_path, args.output_dir, args.expected, 
-                 args.clr_weight_name, args.min_dist, args.max_dist, args.nproc)
-    elif args.command == "plot":
-        ipa_plot(args.bw_path, args.roi_path, args.output_dir, 
-                args.extra_bw_path, args.roi_start_name, args.roi_end_name,
-                args.flank, args.nbins, args.min_roi_size, args.max_roi_size)
-    else:
-        # This is the main 'ipa' command without subcommands
-        # Check that required arguments are present
-        missing_args = []
-        if not args.cool_path:
-            missing_args.append("--cool-path/--cool_path/-c")
-        if not args.roi_path:
-            missing_args.append("--roi-path/--roi_path/-roi")
-        if not args.output_dir:
-            missing_args.append("--output-dir/--output_dir/-o")
+    # Show the progress messages of the library functions, which report through `logging`
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    # Disable the cache of the expected and of the stackup plots (optional)
+    if getattr(args, "no_cache", False):
+        if args.cache_dir is not None:
+            parser.error("argument --no-cache/--no_cache: not allowed with argument --cache-dir/--cache_dir")
+        args.cache_dir = False
+
+    # Select the backend of the inner loops (optional), worker processes get it with their jobs
+    if getattr(args, "kernel_backend", None) is not None:
+        from ipa.kernels import set_backend
+        set_backend(args.kernel_backend)
+
+    # Record stage-level metrics and profile the run (optional)
+    from ipa.metrics import instrument_run
+    with instrument_run(getattr(args, "metrics_json", None), getattr(args, "profile_path", None), {"command": args.command or "ipa", "args": vars(args)}):
+        # Handle the different command cases
+        # (the API is imported only after parsing, so that `ipa --help` starts fast)
+        if args.command == "track" and args.jobs_path:
+            if args.index_path:
+                parser_track.error("argument --index-path/--index_path: not allowed with argument --jobs-path/--jobs_path")
+            if args.shard:
+                parser_track.error("argument --shard: not allowed with argument --jobs-path/--jobs_path")
+            from ipa import ipa_track_batch
+            ipa_track_batch(args.jobs_path, args.output_dir, args.expected,
+                            args.clr_weight_name, args.min_dist, args.max_dist, args.nproc,
+                            args.engine, args.nworkers, args.max_memory, args.cache_dir,
+                            args.precision, args.resume, args.output_format)
+        elif args.command == "track":
+            from ipa import ipa_track
+            ipa_track(args.cool_path, args.output_dir, args.expected, 
+                     args.clr_weight_name, args.min_dist, args.max_dist, args.nproc,
+                     args.engine, args.nworkers, args.max_memory, args.cache_dir,
+                     args.index_path, args.precision, args.resume, args.output_format,
+                     args.shard)
+        elif args.command == "index":
+            from ipa import ipa_index
+            ipa_index(args.cool_path, args.output_dir, args.max_dist, args.expected,
+                     args.clr_weight_name, args.nproc, args.cache_dir)
+        elif args.command == "merge":
+            from ipa import ipa_merge
+            ipa_merge(args.shard_paths, args.output_dir, args.output_format)
+        elif args.command == "plot":
+            from ipa import ipa_plot
+            ipa_plot(args.bw_path, args.roi_path, args.output_dir, 
+                    args.extra_bw_path, args.roi_start_name, args.roi_end_name,
+                    args.flank, args.nbins, args.min_roi_size, args.max_roi_size,
+                    args.cache_dir, args.profiles_only, args.profile_format, args.n_boot,
+                    args.n_perm, args.ci, args.gaps_path, args.seed)
+        elif args.command == "serve":
+            from ipa.serve import serve
+            serve(args.host, args.port, args.socket_path, args.nworkers,
+                  args.cache_size, args.block_size, args.cache_dir)
+        elif args.command == "render":
+            from ipa.render import render_profiles_batch
+            render_profiles_batch(args.profiles_path, args.output_dir, args.roi_start_name,
+                                  args.roi_end_name, args.nproc)
+        else:
+            # This is the main 'ipa' command without subcommands
+            # Check that required arguments are present
+            missing_args = []
+            if not args.cool_path:
+                missing_args.append("--cool-path/--cool_path/-c")
+            if not args.roi_path:
+                missing_args.append("--roi-path/--roi_path/-roi")
+            if not args.output_dir:
+                missing_args.append("--output-dir/--output_dir/-o")
             
-        if missing_args:
-            parser.error(f"the following arguments are required: {', '.join(missing_args)}")
+            if missing_args:
+                parser.error(f"the following arguments are required: {', '.join(missing_args)}")
         
-        ipa(args.cool_path, args.roi_path, args.output_dir, args.bw_dir, 
-           args.expected, args.clr_weight_name, args.min_dist, args.max_dist, 
-           args.nproc, args.roi_start_name, args.roi_end_name, args.flank, 
-           args.nbins, args.min_roi_size, args.max_roi_size)
+            from ipa import ipa
+            ipa(args.cool_path, args.roi_path, args.output_dir, args.bw_dir, 
+               args.expected, args.clr_weight_name, args.min_dist, args.max_dist, 
+               args.nproc, args.roi_start_name, args.roi_end_name, args.flank, 
+               args.nbins, args.min_roi_size, args.max_roi_size, args.engine,
+               args.nworkers, args.max_memory, args.cache_dir, args.index_path,
+               args.precision, args.profiles_only, args.profile_format, args.resume,
+               args.roi_only, args.n_boot, args.n_perm, args.ci, args.gaps_path, args.seed)
 
 if __name__ == "__main__":
     main()
@@ -1,25 +1,36 @@
 import argparse
+from collections import Counter
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import json
+import logging
 import os
 import math
+import shutil
+import threading
 from tqdm import tqdm
 import warnings
 
-import bbi
-import bioframe
-import cooler
-import cooltools
-import matplotlib
-import matplotlib.pyplot as plt
-matplotlib.use('Agg')
+# Heavy dependencies (cooler, cooltools, bioframe, bbi, matplotlib) are imported inside the functions
+# that need them, so that the CLI starts fast and every command loads only what it uses
 import numpy as np
 import pandas as pd
 
-from ipa.lib import mask_out_diagonals, fetch_cis_matrix, calculate_observed_over_expected_matrix, warning_chromnames, create_stackup_plot, filter_regions
+from ipa.cache import CACHE_DIR_NAME, expected_cache_path, file_identity, get_cache_dir, make_cache_key, split_cooler_uri
+from ipa.checkpoint import track_key, track_checkpoint_dir, save_checkpoint, load_checkpoints, shard_output_path, save_shard, load_shard, is_step_done, mark_step_done
+from ipa.kernels import get_backend, set_backend
+from ipa.metrics import get_peak_rss, metrics_enabled, record_stage, start_metrics, stop_metrics, add_records
+from ipa.writers import check_track_format, track_output_path, open_track_writer, write_track_chrom, close_track_writer
+from ipa.lib import BYTES_PER_PIXEL, mask_out_diagonals, fetch_cis_matrix, fetch_cis_tile, calculate_observed_over_expected_matrix, calculate_banded_sum, calculate_fused_oe_sum, calculate_row_sum, calculate_distance_profile, calculate_track_from_profile, calculate_expected, get_expected_arrays, estimate_track_memory, split_track_tiles, split_track_shards, split_chrom_jobs, parse_memory, warning_chromnames, read_bed, create_stackup_plot, create_stackup_plot_from_tracks, create_stackup_plot_from_intervals, read_bigwig_intervals, get_roi_windows, filter_regions, calculate_null_profiles, calculate_profile_statistics, create_profile_table, write_profile_table
 
 
-def ipa_track(clr_path, output_dir, expected=False, clr_weight_name='weight', min_dist=40_000, max_dist=100_000, nproc=4):
+# Progress messages of the pipeline (shown by the CLI, silent by default when the functions are called from Python)
+logger = logging.getLogger(__name__)
+
+def ipa_track(clr_path, output_dir, expected=False, clr_weight_name='weight', min_dist=40_000, max_dist=100_000, nproc=4, engine='banded', nworkers=1, max_memory=None, cache_dir=None, index_path=None, precision='float64', resume=False, output_format='bigwig', shard=None):
     """
-    Calculate the Interaction Pattern Aggregation track (IPA) from a .cool file and save it to a .bw file.
+    Calculate the Interaction Pattern Aggregation track (IPA) from a .cool file and save it to a .bw file (or another output format).
+    Every chromosome is written to the output file as soon as it is calculated (and all chromosomes before it are written).
 
     Args:
         clr_path: Path to the .cool file. Keep in mind that chromosome names in the .cool file and in all the files that will be used in the ipa_plot() function (e.g. TSS-TES sites, ATAC-Seq signal .bw file) should match each other.
@@ -29,18 +40,147 @@ def ipa_track(clr_path, output_dir, expected=False, clr_weight_name='weight', mi
         min_dist: Minimum distance (in bp) between two loci to consider for the IPA calculation, e.g. minimum loop size in bp. If None, restriction on minimum distance is not applied (default: 40_000).
         max_dist: Maximum distance (in bp) between two loci to consider for the IPA calculation, e.g. maximum loop size in bp. If None, restriction on maximum distance is not applied (default: 100_000).
         nproc: Number of processes to use for the calculation of expected (default: 4).
+        engine: Engine to calculate the track with: 'banded' reads only the pixels inside the [min_dist, max_dist] diagonal band from the .cool file, 'dense' fetches the whole cis matrix of every chromosome into memory,
+            'fused' calculates the observed over expected track (`expected` must be True) in a single pass over the pixels of the band: the expected of the band diagonals
+            is accumulated in the same pass instead of being calculated by `cooltools.expected_cis` beforehand. It needs `max_dist` and keeps (number of bins) x (number of band diagonals) float64 partial sums per chromosome in memory (default: 'banded').
+        nworkers: Number of worker processes that calculate chromosomes in parallel, largest chromosome first (default: 1).
+        max_memory: (optional) Memory budget in bytes or as a string like '16G'. Limits how many large chromosomes are calculated at once by the workers. With the 'dense' engine, chromosomes that do not fit into the budget of a worker (`max_memory` / `nworkers`) are split into row tiles that overlap by `max_dist`; the 'banded' engine reads pixels in chunks that fit into it (default: None).
+        cache_dir: (optional) Path to the directory to cache the expected in. If None, the expected is cached in the '.ipa_cache' directory of `output_dir`. If False, the expected is not cached (default: None).
+        index_path: (optional) Path to the cumulative distance profile index (.npy) built by `ipa_index` for this .cool file. If given, the track is calculated from the index without reading pixels from the .cool file (default: None).
+        precision: Floating point precision of the contact values, 'float32' or 'float64'. With 'float32' the dense engine needs about half the memory; sums are always accumulated in float64, so the track stays within a relative tolerance of 1e-5 of the 'float64' one. Not used with `index_path` (default: 'float64').
+        resume: If True, the chromosomes finished by a previous run with the same .cool file and parameters are loaded from their checkpoints
+            in `output_dir`, and the track is not calculated at all if the manifest of `output_dir` shows it is up to date (default: False).
+        output_format: Format of the output file: 'bigwig' (ipa_track.bw), 'bedgraph' (ipa_track.bedGraph), 'hdf5' (ipa_track.h5, one dataset per chromosome)
+            or 'npz' (ipa_track.npz, one array per chromosome). Bins without contacts are skipped in the bigWig and bedGraph files and are NaN in the arrays.
+            The bigWig file is written in-process with pyBigWig; 'hdf5' needs h5py (default: 'bigwig').
+        shard: (optional) Shard of the track to calculate, as a string 'i/N' or a tuple (i, N) with the 1-based shard index i and the number of shards N,
+            e.g. to split the track over the nodes of a cluster. The row tiles of all chromosomes are split into N shards with about the same number of pixels
+            (see `split_track_shards`), large chromosomes into row segments, and only the tiles of shard i are calculated and saved to the partial track file
+            'ipa_track.shard-i-of-N.npz' in `output_dir` instead of the track file. The shards are assembled into the track file by `ipa_merge` (default: None).
+    """
+    track = _prepare_track(clr_path, output_dir, expected, clr_weight_name, min_dist, max_dist, nproc, engine, nworkers, max_memory, cache_dir, index_path, precision, resume, output_format, shard)
+    if track is None:
+        return
+
+    # Create ipa track for the remaining chromosomes (or row tiles of them)
+    _run_tracks([track], nworkers, max_memory)
+    assert track['done'], f"IPA track is missing chromosomes {', '.join(track['unwritten_chromnames'])}"
+
+    # Report the peak memory usage
+    peak_rss, peak_worker_rss = get_peak_rss()
+    logger.info(f"Peak RSS: {peak_rss / 2**20:.0f} MB" + (f" (worker processes: {peak_worker_rss / 2**20:.0f} MB)" if nworkers > 1 and index_path is None else ""))
+
+def ipa_track_batch(jobs, output_dir, expected=False, clr_weight_name='weight', min_dist=40_000, max_dist=100_000, nproc=4, engine='banded', nworkers=1, max_memory=None, cache_dir=None, precision='float64', resume=False, output_format='bigwig'):
+    """
+    Calculate the Interaction Pattern Aggregation tracks (IPA) for a table of jobs, e.g. several resolutions of the same .mcool file
+    and several samples. The chromosomes (or row tiles) of all jobs are scheduled on one shared pool of `nworkers` processes, largest first,
+    so that the workers stay busy until the last job is finished; every worker process opens each .cool file once, and every track
+    is written to its own output file as soon as its chromosomes are finished.
+
+    Args:
+        jobs: pandas DataFrame or path to a tab-separated file with a header and one row per job. The 'cool_path' column (path to the .cool file
+            or cooler URI) is required. The optional columns 'resolution' (appended to the .mcool path as '::resolutions/N'; several resolutions
+            can be given separated by commas, one job per resolution), 'min_dist', 'max_dist', 'expected', 'clr_weight_name' and 'name'
+            (output subdirectory) override the arguments below for the job; empty values and 'None' distances keep the argument and
+            disable the distance restriction, respectively.
+        output_dir: Path to create the output directory. The track of every job is saved to the subdirectory `name`, by default
+            '{cooler name}_res_{resolution}bp_min_dist_{min_dist}bp_max_dist_{max_dist}bp'.
+        expected, clr_weight_name, min_dist, max_dist: Default parameters of the jobs, see `ipa_track`.
+        nproc: Number of processes to use for the calculation of expected (default: 4).
+        engine, nworkers, max_memory, cache_dir, precision, resume, output_format: See `ipa_track`. The memory budget is shared by all jobs, and the expected is cached in the '.ipa_cache' directory of `output_dir` by default.
+
+    Returns:
+        A list with the output directory of every job.
+    """
+    defaults = dict(expected=expected, clr_weight_name=clr_weight_name, min_dist=min_dist, max_dist=max_dist)
+    jobs = _read_track_jobs(jobs, defaults)
+
+    # The expected is cached in `output_dir` by default, shared by the jobs of the same .cool file
+    cache_dir = os.path.join(output_dir, CACHE_DIR_NAME) if cache_dir is None else cache_dir
+
+    # Prepare all jobs first (output files, checkpoints, expected and row tiles), then calculate their tiles on one pool
+    output_dirs, tracks = [], []
+    for job in jobs:
+        clr = _get_cooler(job['clr_path'])
+        name = job['name'] if job['name'] is not None else f"{os.path.basename(split_cooler_uri(job['clr_path'])[0]).split('.')[0]}_res_{clr.binsize}bp_min_dist_{job['min_dist']}bp_max_dist_{job['max_dist']}bp"
+        output_dirs.append(os.path.join(output_dir, name))
+        assert output_dirs.count(output_dirs[-1]) == 1, f"Jobs must have different output directories, {output_dirs[-1]} is used twice"
+        track = _prepare_track(job['clr_path'], output_dirs[-1], job['expected'], job['clr_weight_name'], job['min_dist'], job['max_dist'], nproc,
+                               engine, nworkers, max_memory, cache_dir, None, precision, resume, output_format)
+        if track is not None:
+            tracks.append(track)
+
+    _run_tracks(tracks, nworkers, max_memory)
+    unfinished = [track['output_file'] for track in tracks if not track['done']]
+    assert not unfinished, f"IPA tracks {', '.join(unfinished)} are missing chromosomes"
+
+    # Report the peak memory usage
+    peak_rss, peak_worker_rss = get_peak_rss()
+    logger.info(f"Peak RSS: {peak_rss / 2**20:.0f} MB" + (f" (worker processes: {peak_worker_rss / 2**20:.0f} MB)" if nworkers > 1 else ""))
+
+    return output_dirs
+
+def _read_track_jobs(jobs, defaults):
+    """
+    Read the job table of `ipa_track_batch`: fill in the default parameters and expand the lists of resolutions.
+
+    Returns:
+        A list of dictionaries with the keys 'clr_path', 'name', 'expected', 'clr_weight_name', 'min_dist' and 'max_dist'.
+    """
+    jobs_df = pd.read_csv(jobs, sep='\t', dtype=str, keep_default_na=False) if isinstance(jobs, str) else jobs.astype(str)
+    assert 'cool_path' in jobs_df.columns, "The job table must contain the 'cool_path' column"
+
+    # Convert a table value to the type of the parameter, empty values (and missing columns) keep the default
+    def get_value(row, column, convert):
+        value = row.get(column, '')
+        if value in ('', 'nan'):
+            return defaults.get(column)
+        return None if value == 'None' else convert(value)
+
+    parsed_jobs = []
+    for row in jobs_df.to_dict('records'):
+        job = {'name': get_value(row, 'name', str),
+               'expected': get_value(row, 'expected', lambda value: value.lower() in ('true', '1', 'yes')),
+               'clr_weight_name': get_value(row, 'clr_weight_name', str),
+               'min_dist': get_value(row, 'min_dist', lambda value: int(float(value))),
+               'max_dist': get_value(row, 'max_dist', lambda value: int(float(value)))}
+        resolutions = get_value(row, 'resolution', lambda value: [int(float(resolution)) for resolution in value.split(',')])
+        if resolutions is None:
+            parsed_jobs.append({'clr_path': row['cool_path'], **job})
+        else:
+            # One job per resolution of the .mcool file (the name gets the resolution as a suffix)
+            for resolution in resolutions:
+                name = f"{job['name']}_res_{resolution}bp" if job['name'] is not None and len(resolutions) > 1 else job['name']
+                parsed_jobs.append({'clr_path': f"{row['cool_path']}::resolutions/{resolution}", **job, 'name': name})
+
+    return parsed_jobs
+
+def _prepare_track(clr_path, output_dir, expected, clr_weight_name, min_dist, max_dist, nproc, engine, nworkers, max_memory, cache_dir, index_path, precision, resume, output_format, shard=None):
+    """
+    Prepare the calculation of an IPA track (see `ipa_track` for the arguments): open its output file, load the chromosome checkpoints
+    and the expected, and split the remaining chromosomes into row tiles. The track is written and recorded in the manifest
+    as soon as all its chromosomes are collected.
+
+    Returns:
+        A dictionary with the state of the track: 'clr_path', 'tiles', 'chrom_nbins', 'expected_arrs', 'track_params', 'collect'
+        (the function that collects the results of `_ipa_track_tiles`), 'output_file', 'unwritten_chromnames' and 'done',
+        or None if the track is up to date.
     """
+    assert engine in ('banded', 'dense', 'fused'), f"Unknown engine {engine}. Available engines: 'banded', 'dense', 'fused'"
+    assert engine != 'fused' or expected, "The 'fused' engine calculates the observed over expected track only: set expected=True (--expected) or use the 'banded' engine"
+    assert engine != 'fused' or max_dist is not None, "The 'fused' engine needs a maximum distance to bound its partial sums: set max_dist (--max-dist) or use the 'banded' engine"
+    assert precision in ('float32', 'float64'), f"Unknown precision {precision}. Available precisions: 'float32', 'float64'"
+    check_track_format(output_format)
+
     # Create output directory
     if not os.path.isdir(output_dir):
         os.makedirs(output_dir)
     else:
         warnings.warn(f"Directory {output_dir} already exists. The content of the directory could be overwritten.")
 
-    # Read cool file
-    clr = cooler.Cooler(clr_path)
+    # Read cool file (the handle is shared by all tracks of the same .cool file)
+    clr = _get_cooler(clr_path)
     resolution, chromnames, chromsizes = clr.binsize, clr.chromnames, clr.chromsizes
-    view_df = bioframe.make_viewframe(chromsizes)
-    bins = clr.bins()[:][['chrom', 'start', 'end']]
 
     # Warning if any of chromosome names do not start with 'chr'
     warning_chromnames(chromnames, clr_path)
@@ -49,32 +189,520 @@ def ipa_track(clr_path, output_dir, expected=False, clr_weight_name='weight', mi
     get_min_diag = lambda dist: math.floor(dist / resolution) if dist is not None else 0
     get_max_diag = lambda dist: math.ceil(dist / resolution) if dist is not None else None
     min_diag, max_diag = get_min_diag(min_dist), get_max_diag(max_dist)
-    
-    # Create ipa track for each individual chromosome
+
+    # Key of the track parameters: it identifies the chromosome checkpoints and the track entry in the manifest of the output directory
+    key = track_key(clr_path, expected, clr_weight_name, min_diag, max_diag, precision)
+    if shard is not None:
+        assert index_path is None, "A shard of the IPA track cannot be calculated from the index"
+        return _prepare_shard(clr, clr_path, output_dir, key, shard, expected, clr_weight_name, min_diag, max_diag, nproc, engine, nworkers, max_memory, cache_dir, precision, resume)
+    output_file = track_output_path(output_dir, output_format)
+    step = f"track:{os.path.basename(output_file)}"
+    if resume and is_step_done(output_dir, step, key):
+        logger.info(f"IPA track {output_file} is up to date, skipping it")
+        return None
+
+    # Stream the finished chromosomes to the output file in the order of the .cool file: a chromosome that is finished
+    # before the ones preceding it (e.g. by a parallel worker) is kept in `ipa_tracks` until they are written
+    writer = open_track_writer(output_file, output_format, chromsizes, resolution)
+    checkpoint_dir = track_checkpoint_dir(output_dir, key)
+    track = {'clr_path': clr_path, 'tiles': [], 'chrom_nbins': {}, 'expected_arrs': None, 'track_params': None, 'collect': None,
+             'output_file': output_file, 'unwritten_chromnames': list(chromnames), 'done': False}
+    unwritten_chromnames = track['unwritten_chromnames']
+    def write_finished_chroms():
+        while unwritten_chromnames and unwritten_chromnames[0] in ipa_tracks:
+            chrom = unwritten_chromnames.pop(0)
+            ipa_track = ipa_tracks.pop(chrom)
+            with record_stage('write_track', sample=clr_path, chrom=chrom, bins=len(ipa_track)):
+                write_track_chrom(writer, chrom, ipa_track)
+        if not unwritten_chromnames and not track['done']:
+            # Finish the output file and record the finished track in the manifest, the chromosome checkpoints are not needed anymore
+            with record_stage('close_track', sample=clr_path, output_file=output_file) as record:
+                close_track_writer(writer)
+                record['bytes_written'] = os.path.getsize(output_file)
+            mark_step_done(output_dir, step, key, [output_file])
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+            try:
+                os.rmdir(os.path.dirname(checkpoint_dir))
+            except OSError:
+                pass
+            track['done'] = True
+
+    if index_path is not None:
+        # Create ipa track from the cumulative distance profile index, no pixels are read from the .cool file
+        ipa_tracks = _ipa_track_from_index(index_path, clr_path, clr, expected, clr_weight_name, min_diag, max_diag)
+        write_finished_chroms()
+        return track
+
+    # Chromosomes finished by a previous run with the same parameters (optional)
+    ipa_tracks = load_checkpoints(checkpoint_dir, chromnames) if resume else {}
+    remaining_chromnames = [chrom for chrom in chromnames if chrom not in ipa_tracks]
+    if ipa_tracks:
+        logger.info(f"Resuming IPA track: {len(ipa_tracks)} of {len(chromnames)} chromosomes are loaded from {checkpoint_dir}")
+    write_finished_chroms()
+
+    # Expected calculation (optional), once for all chromosomes (the 'fused' engine accumulates it while summing the contacts)
+    track['expected_arrs'] = get_expected_arrays(_load_expected(clr, clr_path, clr_weight_name, nproc, get_cache_dir(output_dir, cache_dir)), clr_weight_name, min_diag) if expected and remaining_chromnames and engine != 'fused' else None
+
+    # Split chromosomes into row tiles
+    track['chrom_nbins'] = {chrom: int(np.diff(clr.extent(chrom))[0]) for chrom in remaining_chromnames}
+    track['tiles'], track['track_params'] = _split_tiles(track['chrom_nbins'], expected, clr_weight_name, min_diag, max_diag, engine, nworkers, max_memory, precision)
+
+    # Stitch the per-bin sums of the row tiles together, save a checkpoint and write the track as soon as a chromosome is finished
+    chrom_tiles = {chrom: [] for chrom in remaining_chromnames}
+    remaining_tiles = Counter(chrom for chrom, _, _ in track['tiles'])
+    chrom_indices = {chrom: chrom_index for chrom_index, chrom in enumerate(chromnames)}
+    def collect_tile_tracks(tile_tracks):
+        for chrom, row_lo, ipa_track in tile_tracks:
+            chrom_tiles[chrom].append((row_lo, ipa_track))
+            remaining_tiles[chrom] -= 1
+            if remaining_tiles[chrom] == 0:
+                ipa_tracks[chrom] = np.concatenate([ipa_track for _, ipa_track in sorted(chrom_tiles.pop(chrom), key=lambda tile: tile[0])])
+                with record_stage('checkpoint', sample=clr_path, chrom=chrom):
+                    save_checkpoint(checkpoint_dir, chrom_indices[chrom], chrom, ipa_tracks[chrom])
+                write_finished_chroms()
+    track['collect'] = collect_tile_tracks
+
+    return track
+
+def _split_tiles(chrom_nbins, expected, clr_weight_name, min_diag, max_diag, engine, nworkers, max_memory, precision):
+    """
+    Split the chromosomes into row tiles (see `split_track_tiles`) and get the parameters of `_ipa_track_tiles`. With a memory budget,
+    the chromosomes whose dense matrices do not fit into the budget of a worker are split into row tiles, and the 'banded' engine reads pixels in smaller chunks.
+
+    Returns:
+        A tuple (list of tuples (chrom, row_lo, row_hi), dictionary with the keyword arguments of `_ipa_track_tiles`).
+    """
+    max_memory = parse_memory(max_memory)
+    worker_memory = max_memory // nworkers if max_memory is not None else None
+    # (at least 100_000 pixels per chunk, below that the .cool file reads dominate)
+    chunksize = min(10_000_000, max(100_000, worker_memory // BYTES_PER_PIXEL)) if worker_memory is not None else 10_000_000
+    tiles = split_track_tiles(chrom_nbins, engine, expected, max_diag, worker_memory, precision)
+    return tiles, dict(clr_weight_name=clr_weight_name, min_diag=min_diag, max_diag=max_diag, engine=engine, precision=precision, chunksize=chunksize)
+
+def _prepare_shard(clr, clr_path, output_dir, key, shard, expected, clr_weight_name, min_diag, max_diag, nproc, engine, nworkers, max_memory, cache_dir, precision, resume):
+    """
+    Prepare the calculation of a shard of an IPA track (see `ipa_track` with `shard`): split the row tiles of all chromosomes into shards
+    with about the same number of pixels (see `split_track_shards`) and keep the tiles of this shard. The tracks of the tiles are saved
+    to a partial track file as soon as all of them are collected, to be assembled by `ipa_merge`.
+
+    Returns:
+        A dictionary with the state of the track like `_prepare_track` does, or None if the shard is up to date.
+    """
+    shard_index, nshards = _parse_shard(shard)
+    output_file = shard_output_path(output_dir, shard_index, nshards)
+    step = f"shard:{os.path.basename(output_file)}"
+    if resume and is_step_done(output_dir, step, key):
+        logger.info(f"IPA track shard {output_file} is up to date, skipping it")
+        return None
+
+    # Row tiles of all chromosomes, split into shards by the number of pixels in their rows of the pixel table
+    # (the 'fused' engine calculates whole chromosomes only, so its chromosomes are not split)
+    chrom_nbins = {chrom: int(np.diff(clr.extent(chrom))[0]) for chrom in clr.chromnames}
+    tiles, track_params = _split_tiles(chrom_nbins, expected, clr_weight_name, min_diag, max_diag, engine, nworkers, max_memory, precision)
+    with clr.open('r') as grp:
+        bin1_offset = grp['indexes']['bin1_offset'][:]
+    chrom_offsets = {chrom: bin1_offset[lo:hi + 1] for chrom, (lo, hi) in zip(clr.chromnames, map(clr.extent, clr.chromnames))}
+    shard_tiles = split_track_shards(tiles, chrom_offsets, nshards, split_tiles=engine != 'fused')[shard_index - 1]
+    shard_pixels = sum(int(chrom_offsets[chrom][row_hi] - chrom_offsets[chrom][row_lo]) for chrom, row_lo, row_hi in shard_tiles)
+    logger.info(f"IPA track shard {shard_index}/{nshards}: {len(shard_tiles)} row tiles with {shard_pixels} of {int(bin1_offset[-1])} pixels")
+
+    # Expected calculation (optional), once for all chromosomes (the 'fused' engine accumulates it while summing the contacts)
+    shard_chromnames = {chrom for chrom, _, _ in shard_tiles}
+    expected_arrs = get_expected_arrays(_load_expected(clr, clr_path, clr_weight_name, nproc, get_cache_dir(output_dir, cache_dir)), clr_weight_name, min_diag) if expected and shard_tiles and engine != 'fused' else None
+
+    # Save the tiles of the shard to the partial track file once all of them are collected
+    track = {'clr_path': clr_path, 'tiles': shard_tiles, 'chrom_nbins': {chrom: chrom_nbins[chrom] for chrom in shard_chromnames},
+             'expected_arrs': expected_arrs, 'track_params': track_params, 'collect': None, 'output_file': output_file,
+             'unwritten_chromnames': [], 'done': False}
+    tile_tracks, tile_order = [], {(chrom, row_lo): i for i, (chrom, row_lo, _) in enumerate(shard_tiles)}
+    def collect_tile_tracks(new_tile_tracks):
+        tile_tracks.extend(new_tile_tracks)
+        if len(tile_tracks) == len(shard_tiles):
+            metadata = {'key': key, 'shard': shard_index, 'nshards': nshards, 'clr_path': clr_path, 'binsize': int(clr.binsize),
+                        'chromsizes': {chrom: int(size) for chrom, size in clr.chromsizes.items()}, 'chrom_nbins': chrom_nbins}
+            with record_stage('save_shard', sample=clr_path, output_file=output_file) as record:
+                save_shard(output_file, metadata, sorted(tile_tracks, key=lambda tile: tile_order[tile[0], tile[1]]))
+                record['bytes_written'] = os.path.getsize(output_file)
+            mark_step_done(output_dir, step, key, [output_file])
+            track['done'] = True
+    track['collect'] = collect_tile_tracks
+    if not shard_tiles:
+        collect_tile_tracks([])
+
+    return track
+
+def _parse_shard(shard):
+    """
+    Parse a shard given as a string 'i/N' or a tuple (i, N), with the 1-based index i of the shard and the number of shards N.
+    """
+    shard_index, nshards = map(int, shard.split('/')) if isinstance(shard, str) else shard
+    assert 1 <= shard_index <= nshards, f"Shard must be given as i/N with 1 <= i <= N, got {shard_index}/{nshards}"
+    return shard_index, nshards
+
+def _run_tracks(tracks, nworkers, max_memory):
+    """
+    Calculate the row tiles of the prepared tracks (see `_prepare_track`), in a pool of `nworkers` processes shared by all tracks
+    or one after another in the current process, and pass the results to the `collect` function of their track.
+    """
+    tracks = [track for track in tracks if track['tiles']]
+    if not tracks:
+        return
+
+    if nworkers > 1:
+        _ipa_track_parallel(tracks, nworkers, parse_memory(max_memory))
+    else:
+        for track, tile in tqdm([(track, tile) for track in tracks for tile in track['tiles']]):
+            track['collect'](_ipa_track_tiles(track['clr_path'], [tile], track['expected_arrs'], **track['track_params']))
+
+# Cooler objects opened in the current process (every worker process has its own handles)
+_COOLERS = {}
+
+def _get_cooler(clr_path):
+    """
+    Get a Cooler object for a given .cool file, opened once per process.
+    """
+    if clr_path not in _COOLERS:
+        import cooler
+        _COOLERS[clr_path] = cooler.Cooler(clr_path)
+    return _COOLERS[clr_path]
+
+def _load_expected(clr, clr_path, clr_weight_name, nproc, cache_dir=None):
+    """
+    Calculate the expected for all chromosomes of a .cool file or load it from the cache directory `cache_dir` (see `get_cache_dir`, not cached if it is None).
+    Expected values of the diagonals do not depend on the number of ignored diagonals, so the expected is calculated
+    without ignoring any of them and shared between runs with different `min_dist`/`max_dist`.
+
+    Returns:
+        A DataFrame with the expected values as returned by `cooltools.expected_cis`.
+    """
+    cache_path = expected_cache_path(clr_path, clr.binsize, clr_weight_name, 0, cache_dir)
+    if cache_path is not None and os.path.isfile(cache_path):
+        with record_stage('expected', sample=clr_path, cached=True):
+            return pd.read_csv(cache_path, sep='\t', dtype={'region1': str, 'region2': str})
+
+    import bioframe
+    with record_stage('expected', sample=clr_path, cached=False, bins=int(clr.info['nbins'])):
+        expected_df = calculate_expected(clr, bioframe.make_viewframe(clr.chromsizes), 0, clr_weight_name, nproc)
+
+    # Write the cache file under a temporary name first, so that an interrupted run does not leave a broken cache
+    if cache_path is not None:
+        expected_df.to_csv(cache_path + '.tmp', sep='\t', index=False)
+        os.replace(cache_path + '.tmp', cache_path)
+
+    return expected_df
+
+def _ipa_track_tiles(clr_path, tiles, expected_arrs, clr_weight_name, min_diag, max_diag, engine, precision='float64', chunksize=10_000_000):
+    """
+    Calculate the IPA track for the given row tiles (chrom, row_lo, row_hi) of a .cool file, see `split_track_tiles`.
+    If `expected_arrs` (a dictionary with the expected values per chromosome) is given, the track is based on the observed over expected matrix.
+
+    Returns:
+        A list of tuples (chrom, row_lo, NumPy 1D array with the IPA track of the tile rows).
+    """
+    clr = _get_cooler(clr_path)
+    dtype = np.dtype(precision)
+
+    tile_tracks = []
+    for chrom, row_lo, row_hi in tiles:
+        expected_arr = expected_arrs[chrom] if expected_arrs is not None else None
+        lo, hi = clr.extent(chrom)
+        with record_stage('track_tile', sample=clr_path, chrom=chrom, row_lo=row_lo, row_hi=row_hi, engine=engine, bins=row_hi - row_lo) as record:
+            if metrics_enabled():
+                record['pixels_read'] = _count_tile_pixels(clr, chrom, row_lo, row_hi, max_diag, engine)
+            if engine == 'banded':
+                # Sum contacts inside the diagonal band straight from the pixel table
+                ipa_track = calculate_banded_sum(clr, chrom, min_diag, max_diag, clr_weight_name, expected_arr, chunksize, dtype, row_lo, row_hi)
+            elif engine == 'fused':
+                # Sum observed over expected contacts inside the diagonal band, with the expected from the same pass over the pixels
+                assert (row_lo, row_hi) == (0, hi - lo), "The 'fused' engine calculates whole chromosomes only"
+                ipa_track = calculate_fused_oe_sum(clr, chrom, min_diag, max_diag, clr_weight_name, chunksize, dtype)
+            else:
+                # Fetch cis matrix (or a tile of its rows)
+                with record_stage('fetch_matrix', sample=clr_path, chrom=chrom, row_lo=row_lo, row_hi=row_hi):
+                    if (row_lo, row_hi) == (0, hi - lo):
+                        cis_matrix, col_lo = fetch_cis_matrix(clr, chrom, clr_weight_name, dtype), 0
+                    else:
+                        cis_matrix, col_lo = fetch_cis_tile(clr, chrom, row_lo, row_hi, max_diag, clr_weight_name, dtype)
+
+                # Mask out diagonals in contact matrix based on min and max distance
+                mask_out_diagonals(cis_matrix, min_diag, max_diag, row_lo, col_lo)
+
+                # Expected calculation (optional)
+                if expected_arr is not None:
+                    cis_matrix = calculate_observed_over_expected_matrix(cis_matrix, expected_arr, min_diag, max_diag, row_lo, col_lo)
+
+                # Calculate average statistics (in place, accumulated in float64)
+                ipa_track = calculate_row_sum(cis_matrix)
+                del cis_matrix
+            ipa_track[ipa_track == 0.] = np.nan
+        tile_tracks.append((chrom, row_lo, ipa_track))
+
+    return tile_tracks
+
+def _count_tile_pixels(clr, chrom, row_lo, row_hi, max_diag, engine):
+    """
+    Count the pixels in the rows of the pixel table that are read to calculate a row tile of a chromosome
+    (the 'banded' engine reads the `max_diag` rows before the tile too, see `calculate_banded_sum`).
+    """
+    lo, _ = clr.extent(chrom)
+    if engine == 'banded':
+        row_lo = max(0, row_lo - max_diag) if max_diag is not None else 0
+    with clr.open('r') as grp:
+        pixel_lo, pixel_hi = grp['indexes']['bin1_offset'][[lo + row_lo, lo + row_hi]]
+    return int(pixel_hi - pixel_lo)
+
+def _ipa_track_job(clr_path, tiles, expected_arrs, record_metrics, kernel_backend, **track_params):
+    """
+    Calculate the IPA track for the given row tiles in a worker process with the kernel backend of the main process, see `_ipa_track_tiles`.
+
+    Returns:
+        A tuple (list of the tiles as returned by `_ipa_track_tiles`, list of the stages recorded by the worker process
+        if `record_metrics` is True, otherwise None).
+    """
+    set_backend(kernel_backend)
+    if record_metrics:
+        start_metrics()
+    tile_tracks = _ipa_track_tiles(clr_path, tiles, expected_arrs, **track_params)
+    return tile_tracks, stop_metrics() if record_metrics else None
+
+def _ipa_track_parallel(tracks, nworkers, max_memory):
+    """
+    Calculate the row tiles of the prepared tracks (see `_prepare_track`) in a pool of `nworkers` processes shared by all tracks.
+    Whole chromosomes of every track are grouped into jobs by `split_chrom_jobs`, row tiles of large chromosomes are jobs on their own.
+    Jobs of all tracks are submitted largest first, and a job is only started if the estimated memory of all running jobs stays within `max_memory`.
+    The results of every finished job, a list of tuples (chrom, row_lo, NumPy 1D array with the IPA track of the tile rows),
+    are passed to the `collect` function of its track as soon as the job is done.
+    """
+    jobs, job_memory = [], []
+    for track_index, track in enumerate(tracks):
+        tiles, chrom_nbins, track_params = track['tiles'], track['chrom_nbins'], track['track_params']
+        whole_chroms = {chrom: chrom_nbins[chrom] for chrom, row_lo, row_hi in tiles if row_hi - row_lo == chrom_nbins[chrom]}
+        track_jobs = [[(chrom, 0, chrom_nbins[chrom]) for chrom in job] for job in split_chrom_jobs(whole_chroms, nworkers)]
+        track_jobs += [[tile] for tile in tiles if tile[0] not in whole_chroms]
+        jobs += [(track_index, job) for job in track_jobs]
+        job_memory += [sum(estimate_track_memory(chrom_nbins[chrom], track_params['engine'], track['expected_arrs'] is not None, track_params['max_diag'],
+                                                 track_params['chunksize'], track_params['precision'], row_hi - row_lo) for chrom, row_lo, row_hi in job) for job in track_jobs]
+    queue = sorted(range(len(jobs)), key=lambda i: job_memory[i], reverse=True)
+
+    running = {}
+    with ProcessPoolExecutor(max_workers=nworkers) as pool, tqdm(total=sum(len(track['tiles']) for track in tracks)) as progress:
+        while queue or running:
+            # Submit the largest jobs that fit into the memory budget (at least one job is always running)
+            for i in list(queue):
+                if len(running) >= nworkers:
+                    break
+                if running and max_memory is not None and sum(job_memory[j] for j in running.values()) + job_memory[i] > max_memory:
+                    continue
+                queue.remove(i)
+                track_index, job = jobs[i]
+                track = tracks[track_index]
+                job_expected_arrs = {chrom: track['expected_arrs'][chrom] for chrom, _, _ in job} if track['expected_arrs'] is not None else None
+                future = pool.submit(_ipa_track_job, track['clr_path'], job, job_expected_arrs, metrics_enabled(), get_backend(), **track['track_params'])
+                running[future] = i
+
+            # Collect the results of the finished jobs
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                track_index, job = jobs[running.pop(future)]
+                tile_tracks, records = future.result()
+                add_records(records)
+                tracks[track_index]['collect'](tile_tracks)
+                progress.update(len(job))
+
+def _ipa_track_roi(clr_path, roi_df, flank, expected=False, clr_weight_name='weight', min_dist=40_000, max_dist=100_000, nproc=4, nworkers=1, cache_dir=None, precision='float64'):
+    """
+    Calculate the IPA track only for the bins that the stackup plot of the regions of interest (ROI) reads, see `get_roi_windows`.
+    The windows are calculated with the 'banded' engine, which reads only the pixel rows of a window and the `max_dist` rows before it.
+
+    Returns:
+        A tuple (dictionary with chromosome names as keys and NumPy 1D arrays with the IPA track, NaN outside of the windows, as values,
+        bin size, chromosome sizes).
+    """
+    clr = _get_cooler(clr_path)
+    resolution, chromnames, chromsizes = clr.binsize, clr.chromnames, clr.chromsizes
+    min_diag = math.floor(min_dist / resolution) if min_dist is not None else 0
+    max_diag = math.ceil(max_dist / resolution) if max_dist is not None else None
+
+    # Windows of the flank-extended ROI
+    chrom_nbins = {chrom: int(np.diff(clr.extent(chrom))[0]) for chrom in chromnames}
+    windows = get_roi_windows(roi_df, flank, resolution, chrom_nbins)
+    logger.info(f"IPA track is calculated for {sum(row_hi - row_lo for _, row_lo, row_hi in windows)} of {sum(chrom_nbins.values())} bins around the ROI")
+
+    # Expected calculation (optional), once for all chromosomes
+    expected_arrs = get_expected_arrays(_load_expected(clr, clr_path, clr_weight_name, nproc, get_cache_dir(None, cache_dir)), clr_weight_name, min_diag) if expected and windows else None
+
+    # Windows of every chromosome are a job
+    track_params = dict(clr_weight_name=clr_weight_name, min_diag=min_diag, max_diag=max_diag, engine='banded', precision=precision)
+    jobs = [[window for window in windows if window[0] == chrom] for chrom in chromnames]
+    jobs = [job for job in jobs if job]
+    get_job_expected_arrs = lambda job: {job[0][0]: expected_arrs[job[0][0]]} if expected_arrs is not None else None
+    if nworkers > 1:
+        with ProcessPoolExecutor(max_workers=nworkers) as pool:
+            futures = [pool.submit(_ipa_track_job, clr_path, job, get_job_expected_arrs(job), metrics_enabled(), get_backend(), **track_params) for job in jobs]
+            window_tracks = []
+            for future in tqdm(futures):
+                job_tracks, records = future.result()
+                add_records(records)
+                window_tracks += job_tracks
+    else:
+        window_tracks = [window_track for job in tqdm(jobs) for window_track in _ipa_track_tiles(clr_path, job, get_job_expected_arrs(job), **track_params)]
+
+    # Place the windows into the tracks of the chromosomes
+    ipa_tracks = {chrom: np.full(nbins, np.nan) for chrom, nbins in chrom_nbins.items()}
+    for chrom, row_lo, ipa_track in window_tracks:
+        ipa_tracks[chrom][row_lo:row_lo + len(ipa_track)] = ipa_track
+
+    return ipa_tracks, resolution, chromsizes
+
+def ipa_index(clr_path, output_dir, max_dist=1_000_000, expected=False, clr_weight_name='weight', nproc=4, cache_dir=None):
+    """
+    Build the cumulative distance profile index of a .cool file and save it to a .npy file.
+    For every bin the index stores the cumulative sum of contacts as a function of the diagonal up to `max_dist`, so that
+    the IPA track for any [min_dist, max_dist] range can be calculated by `ipa_track` as a difference of two columns of the index.
+    The index is a dense float64 matrix of (number of bins) x (`max_dist` / resolution + 1) values, e.g. about 150 GB for the human
+    genome at 400 bp and `max_dist` of 1 Mb, so it fails early if it does not fit into the free disk space of `output_dir`.
+
+    Args:
+        clr_path: Path to the .cool file.
+        output_dir: Path to create the output directory which will store the index files.
+        max_dist: Maximum distance (in bp) covered by the index. `ipa_track` can use the index for any `max_dist` up to this one (default: 1_000_000).
+        expected: If True, the index is based on the observed over expected matrix (default: False).
+        clr_weight_name: The name of the column in the .cool file that contains the balancing weights (default: 'weight').
+        nproc: Number of processes to use for the calculation of expected (default: 4).
+        cache_dir: (optional) Path to the directory to cache the expected in. If None, the expected is cached in the '.ipa_cache' directory of `output_dir`. If False, the expected is not cached (default: None).
+
+    Returns:
+        Path to the index file (.npy). The index metadata is stored next to it in a .json file with the same name.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Read cool file
+    import cooler
+    clr = cooler.Cooler(clr_path)
+    resolution, chromnames = clr.binsize, clr.chromnames
+    max_diag = math.ceil(max_dist / resolution)
+
+    # Expected calculation (optional), once for all chromosomes
+    expected_arrs = get_expected_arrays(_load_expected(clr, clr_path, clr_weight_name, nproc, get_cache_dir(output_dir, cache_dir)), clr_weight_name) if expected else None
+
+    # The index takes (number of bins) x (`max_diag` + 1) float64 values on disk: check that it fits before writing it
+    index_path = os.path.join(output_dir, f"ipa_index_{resolution}bp{'_oe' if expected else ''}.npy")
+    index_shape = (int(clr.info['nbins']), max_diag + 1)
+    index_bytes = index_shape[0] * index_shape[1] * np.dtype(np.float64).itemsize
+    free_bytes = shutil.disk_usage(output_dir).free + (os.path.getsize(index_path) if os.path.isfile(index_path) else 0)
+    assert index_bytes <= free_bytes, f"Index of {index_shape[0]} bins x {index_shape[1]} diagonals needs {index_bytes / 2**30:.1f} GB, but only {free_bytes / 2**30:.1f} GB are free in {output_dir}. Use a smaller --max-dist or a coarser resolution."
+
+    # The index is memory-mapped and the profile of every chromosome is calculated in its rows, so it is never kept in memory
+    index = np.lib.format.open_memmap(index_path, mode='w+', dtype=np.float64, shape=index_shape)
     for chrom in tqdm(chromnames):
-        # Fetch cis matrix
-        cis_matrix = fetch_cis_matrix(clr, chrom, clr_weight_name)
+        lo, hi = clr.extent(chrom)
+        expected_arr = expected_arrs[chrom] if expected_arrs is not None else None
+        calculate_distance_profile(clr, chrom, max_diag, clr_weight_name, expected_arr, out=index[lo:hi])
+    index.flush()
+    del index
+
+    # Save the index metadata
+    file_path, group_path = split_cooler_uri(clr_path)
+    metadata = {'cooler': file_identity(file_path), 'group': group_path, 'resolution': int(resolution), 'max_diag': int(max_diag),
+                'expected': expected, 'clr_weight_name': clr_weight_name}
+    with open(os.path.splitext(index_path)[0] + '.json', 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+    return index_path
+
+def _ipa_track_from_index(index_path, clr_path, clr, expected, clr_weight_name, min_diag, max_diag):
+    """
+    Calculate the IPA track for all chromosomes of a .cool file from its cumulative distance profile index.
 
-        # Mask out diagonals in contact matrix based on min and max distance
-        mask_out_diagonals(cis_matrix, min_diag, max_diag)
+    Returns:
+        A dictionary with chromosome names as keys and NumPy 1D arrays with the IPA track as values.
+    """
+    with open(os.path.splitext(index_path)[0] + '.json') as f:
+        metadata = json.load(f)
 
-        # Expected calculation (optional)
-        if expected:
-            cis_matrix = calculate_observed_over_expected_matrix(cis_matrix, clr, chrom, view_df, min_diag, clr_weight_name, nproc)
+    # Check that the index was built for the same .cool file and parameters
+    file_path, group_path = split_cooler_uri(clr_path)
+    assert metadata['cooler'] == file_identity(file_path) and metadata['group'] == group_path, f"Index {index_path} was not built for {clr_path} or the file has changed since then"
+    assert metadata['expected'] == expected and metadata['clr_weight_name'] == clr_weight_name, f"Index {index_path} was built with expected={metadata['expected']} and clr_weight_name={metadata['clr_weight_name']}"
+    # Without the restriction on maximum distance the index has to cover whole chromosomes
+    required_max_diag = max_diag if max_diag is not None else max(hi - lo for lo, hi in map(clr.extent, clr.chromnames)) - 1
+    assert required_max_diag <= metadata['max_diag'], f"Index {index_path} covers distances up to {metadata['max_diag'] * clr.binsize} bp only"
 
-        # Calculate average statistics
-        ipa_track = np.nansum(cis_matrix, axis=1)
+    index = np.load(index_path, mmap_mode='r')
+    ipa_tracks = {}
+    for chrom in clr.chromnames:
+        lo, hi = clr.extent(chrom)
+        with record_stage('index_track', sample=clr_path, chrom=chrom, bins=hi - lo):
+            ipa_track = calculate_track_from_profile(index[lo:hi], min_diag, max_diag)
         ipa_track[ipa_track == 0.] = np.nan
-        del cis_matrix
+        ipa_tracks[chrom] = ipa_track
 
-        # Final dataframe arrangement
-        idx = bins.index[bins['chrom'] == chrom]
-        bins.loc[idx, 'ipa'] = ipa_track
-    
-    # Save the ipa track to a `output_bw_file` file
-    bioframe.to_bigwig(bins, chromsizes, os.path.join(output_dir, "ipa_track.bw"), value_field="ipa")
+    return ipa_tracks
 
-def ipa_plot(bw_file, roi_file, output_dir, extra_bw_file=None, roi_start_name=None, roi_end_name=None, flank=100_000, nbins=50, min_roi_size=None, max_roi_size=None):
+def ipa_merge(shard_paths, output_dir, output_format='bigwig'):
+    """
+    Assemble the IPA track from the partial track files of its shards (see `ipa_track` with `shard`), e.g. calculated on several nodes of a cluster,
+    and save it to the track file in `output_dir`. All shards must come from the same .cool file and parameters, and together they must cover
+    every bin of every chromosome exactly once; otherwise nothing is written.
+
+    Args:
+        shard_paths: List of paths to the partial track files ('ipa_track.shard-i-of-N.npz') or to the directories with them.
+        output_dir: Path to the output directory which will store the track file.
+        output_format: Format of the track file: 'bigwig', 'bedgraph', 'hdf5' or 'npz', see `ipa_track` (default: 'bigwig').
+
+    Returns:
+        Path to the track file.
+    """
+    check_track_format(output_format)
+
+    # Partial track files of the shards, given directly or found in the directories
+    paths = []
+    for shard_path in shard_paths:
+        if os.path.isdir(shard_path):
+            paths += sorted(os.path.join(shard_path, name) for name in os.listdir(shard_path) if name.startswith('ipa_track.shard-') and name.endswith('.npz'))
+        else:
+            paths.append(shard_path)
+    assert paths, f"No shard files found in {', '.join(shard_paths)}"
+    shards = [load_shard(path) for path in paths]
+
+    # All shards of the same track, every shard once
+    metadata = shards[0][0]
+    for path, (shard_metadata, _) in zip(paths, shards):
+        assert (shard_metadata['key'], shard_metadata['nshards']) == (metadata['key'], metadata['nshards']), f"Shard {path} belongs to another IPA track than {paths[0]} (different .cool file, parameters or number of shards)"
+    shard_counts = Counter(shard_metadata['shard'] for shard_metadata, _ in shards)
+    duplicated = sorted(shard for shard, count in shard_counts.items() if count > 1)
+    missing = sorted(set(range(1, metadata['nshards'] + 1)) - set(shard_counts))
+    assert not duplicated, f"Shards {', '.join(map(str, duplicated))} are given more than once"
+    assert not missing, f"Shards {', '.join(map(str, missing))} of {metadata['nshards']} are missing"
+
+    # Every bin of every chromosome is covered by exactly one row tile
+    chrom_tiles = {chrom: [] for chrom in metadata['chrom_nbins']}
+    for shard_metadata, shard_file in shards:
+        for i, (chrom, row_lo, row_hi) in enumerate(shard_metadata['tiles']):
+            chrom_tiles[chrom].append((row_lo, row_hi, shard_file, f"tile_{i}"))
+    for chrom, nbins in metadata['chrom_nbins'].items():
+        row = 0
+        for row_lo, row_hi, _, _ in sorted(chrom_tiles[chrom], key=lambda tile: tile[0]):
+            assert row_lo == row, f"Bins {row}-{row_lo} of chromosome {chrom} are not covered by the shards" if row_lo > row else f"Bins {row_lo}-{row} of chromosome {chrom} are covered by more than one shard"
+            row = row_hi
+        assert row == nbins, f"Bins {row}-{nbins} of chromosome {chrom} are not covered by the shards"
+
+    # Write the track one chromosome at a time and record it in the manifest of the output directory
+    os.makedirs(output_dir, exist_ok=True)
+    output_file = track_output_path(output_dir, output_format)
+    writer = open_track_writer(output_file, output_format, pd.Series(metadata['chromsizes']), metadata['binsize'])
+    for chrom in metadata['chrom_nbins']:
+        tiles = sorted(chrom_tiles[chrom], key=lambda tile: tile[0])
+        write_track_chrom(writer, chrom, np.concatenate([shard_file[name] for _, _, shard_file, name in tiles]) if tiles else np.zeros(0))
+    close_track_writer(writer)
+    for _, shard_file in shards:
+        shard_file.close()
+    mark_step_done(output_dir, f"track:{os.path.basename(output_file)}", metadata['key'], [output_file])
+    logger.info(f"IPA track {output_file} is assembled from {metadata['nshards']} shards")
+
+    return output_file
+
+def ipa_plot(bw_file, roi_file, output_dir, extra_bw_file=None, roi_start_name=None, roi_end_name=None, flank=100_000, nbins=50, min_roi_size=None, max_roi_size=None, cache_dir=None, profiles_only=False, profile_format='tsv', n_boot=0, n_perm=0, ci=0.95, gaps_file=None, seed=None):
     """
     Create an Interaction Pattern Aggregation (IPA) plot for a given region of interest (ROI) using up to two bigWig files.
 
@@ -89,6 +717,66 @@ def ipa_plot(bw_file, roi_file, output_dir, extra_bw_file=None, roi_start_name=N
         nbins: Number of bins to split the ROI into (default: 50).
         min_roi_size: Minimum size of the region of interest in bp to filter out small regions in the roi file (default: None).
         max_roi_size: Maximum size of the region of interest in bp to filter out large regions in the roi file (default: None).
+        cache_dir: (optional) Path to the directory to cache the stackup plots in. If None, the stackup plots are cached in the '.ipa_cache' directory of `output_dir`. If False, the stackup plots are not cached (default: None).
+        profiles_only: If True, the aggregated profiles (mean, median, SEM and number of values per bin) are written to a table instead of rendering the plot, and matplotlib is not imported. The plot can be rendered later from the table with `ipa.render.render_profiles` (default: False).
+        profile_format: Format of the profile table: 'tsv' or 'parquet' (default: 'tsv').
+        n_boot: Number of bootstrap resamples of the ROI for the confidence interval of every profile, no interval if 0 (default: 0).
+        n_perm: Number of random sets of shifted ROI for the empirical null of every profile and the per-bin p-values, no null if 0.
+            Every ROI is moved to a random position on its chromosome, and the bigWig file is read into memory once to stack them up (default: 0).
+        ci: Confidence level of the bootstrap interval and of the null band (default: 0.95).
+        gaps_file: (optional) Path to a BED file with the gaps (e.g. assembly gaps or blacklisted regions) that the shifted ROI with their flanks avoid (default: None).
+        seed: (optional) Seed of the random number generator of the bootstrap and the shifted ROI (default: None).
+    """
+    # Check if the output directory exists
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    else:
+        warnings.warn(f"Directory {output_dir} already exists. The content of the directory could be overwritten.")
+
+    # Read the annotation file with the regions of interest (e.g. TSS-TES sites) and filter regions based on the size
+    roi_df = _read_roi(roi_file, min_roi_size, max_roi_size)
+
+    # Create a stackup plot
+    cache_dir = get_cache_dir(output_dir, cache_dir)
+    stackup_concat = _create_stackup(bw_file, roi_df, flank, nbins, cache_dir)
+
+    # Create a second stackup plot (optional)
+    stackup_concat_2 = _create_stackup(extra_bw_file, roi_df, flank, nbins, cache_dir) if extra_bw_file is not None else None
+
+    # Bootstrap confidence intervals and permutation nulls of the profiles (optional)
+    significance = _get_significance_params(n_boot, n_perm, ci, gaps_file, seed)
+    statistics = _get_profile_statistics(stackup_concat, lambda: read_bigwig_intervals(bw_file), roi_df, flank, nbins, significance)
+    statistics_2 = _get_profile_statistics(stackup_concat_2, lambda: read_bigwig_intervals(extra_bw_file), roi_df, flank, nbins, significance) if extra_bw_file is not None else None
+
+    # IPA plot or profile table
+    _save_ipa_plot(stackup_concat, bw_file, roi_file, output_dir, stackup_concat_2, extra_bw_file, roi_start_name, roi_end_name, flank, nbins, profiles_only, profile_format, statistics, statistics_2)
+
+def ipa_plot_batch(bw_file, roi_file, output_dir, extra_bw_files, roi_start_name=None, roi_end_name=None, flank=100_000, nbins=50, min_roi_size=None, max_roi_size=None, nproc=4, cache_dir=None, profiles_only=False, profile_format='tsv', n_boot=0, n_perm=0, ci=0.95, gaps_file=None, seed=None):
+    """
+    Create Interaction Pattern Aggregation (IPA) plots for a given region of interest (ROI), one per extra bigWig file.
+    Produces the same plots as calling `ipa_plot` for every extra bigWig file, but the ROI file is read and filtered once,
+    the stackup of `bw_file` is calculated once, and the stackups of the extra bigWig files are calculated concurrently.
+
+    Args:
+        bw_file: Path to the bigWig file shared by all plots (e.g. the IPA track).
+        roi_file: Path to the annotation file with the regions of interest (e.g. TSS-TES sites). The file should be in a BED format.
+        output_dir: Path to the output directory which will store the output plot files.
+        extra_bw_files: List of paths to the extra bigWig files, one plot is created for each of them.
+        roi_start_name: Alias for the start of the region of interest, e.g. TSS or loop start (default: None).
+        roi_end_name: Alias for the end of the region of interest, e.g. TES or loop end (default: None).
+        flank: Flank size in bp (default: 100_000).
+        nbins: Number of bins to split the ROI into (default: 50).
+        min_roi_size: Minimum size of the region of interest in bp to filter out small regions in the roi file (default: None).
+        max_roi_size: Maximum size of the region of interest in bp to filter out large regions in the roi file (default: None).
+        nproc: Number of threads to calculate the stackups of the extra bigWig files with (default: 4).
+        cache_dir: (optional) Path to the directory to cache the stackup plots in. If None, the stackup plots are cached in the '.ipa_cache' directory of `output_dir`. If False, the stackup plots are not cached (default: None).
+        profiles_only: If True, the aggregated profiles are written to tables instead of rendering the plots, see `ipa_plot` (default: False).
+        profile_format: Format of the profile tables: 'tsv' or 'parquet' (default: 'tsv').
+        n_boot: Number of bootstrap resamples of the ROI for the confidence interval of every profile, see `ipa_plot` (default: 0).
+        n_perm: Number of random sets of shifted ROI for the empirical null of every profile, see `ipa_plot` (default: 0).
+        ci: Confidence level of the bootstrap interval and of the null band (default: 0.95).
+        gaps_file: (optional) Path to a BED file with the gaps that the shifted ROI with their flanks avoid (default: None).
+        seed: (optional) Seed of the random number generator of the bootstrap and the shifted ROI (default: None).
     """
     # Check if the output directory exists
     if not os.path.isdir(output_dir):
@@ -96,8 +784,90 @@ def ipa_plot(bw_file, roi_file, output_dir, extra_bw_file=None, roi_start_name=N
     else:
         warnings.warn(f"Directory {output_dir} already exists. The content of the directory could be overwritten.")
 
+    # Read the annotation file with the regions of interest once
+    roi_df = _read_roi(roi_file, min_roi_size, max_roi_size)
+
+    # Create the shared stackup plot once and the stackup plots of the extra bigWig files concurrently
+    cache_dir = get_cache_dir(output_dir, cache_dir)
+    stackup_concat = _create_stackup(bw_file, roi_df, flank, nbins, cache_dir)
+    significance = _get_significance_params(n_boot, n_perm, ci, gaps_file, seed)
+    statistics = _get_profile_statistics(stackup_concat, lambda: read_bigwig_intervals(bw_file), roi_df, flank, nbins, significance)
+    _save_ipa_plots(stackup_concat, bw_file, roi_df, roi_file, output_dir, extra_bw_files, roi_start_name, roi_end_name, flank, nbins, nproc, cache_dir, profiles_only, profile_format, significance, statistics)
+
+def _save_ipa_plots(stackup_concat, bw_file, roi_df, roi_file, output_dir, extra_bw_files, roi_start_name=None, roi_end_name=None, flank=100_000, nbins=50, nproc=4, cache_dir=None, profiles_only=False, profile_format='tsv', significance=None, statistics=None):
+    """
+    Save the IPA plots of a shared stackup plot with the stackup plots of the extra bigWig files (None for a plot of the shared stackup plot alone),
+    which are calculated concurrently by `nproc` threads together with their statistics (see `_get_profile_statistics`) and cached in `cache_dir`
+    (see `get_cache_dir`, not cached if it is None). The permutation null keeps all intervals of a bigWig file in memory, so the threads
+    calculate it for one bigWig file at a time.
+    """
+    null_lock = threading.Lock()
+    def create_extra_stackup(extra_bw_file):
+        if extra_bw_file is None:
+            return None, None
+        stackup_concat_2 = _create_stackup(extra_bw_file, roi_df, flank, nbins, cache_dir)
+        return stackup_concat_2, _get_profile_statistics(stackup_concat_2, lambda: read_bigwig_intervals(extra_bw_file), roi_df, flank, nbins, significance, null_lock)
+
+    with ThreadPoolExecutor(max_workers=nproc) as pool:
+        extra_stackups = pool.map(create_extra_stackup, extra_bw_files)
+
+        # IPA plots or profile tables
+        for extra_bw_file, (stackup_concat_2, statistics_2) in zip(extra_bw_files, extra_stackups):
+            _save_ipa_plot(stackup_concat, bw_file, roi_file, output_dir, stackup_concat_2, extra_bw_file, roi_start_name, roi_end_name, flank, nbins, profiles_only, profile_format, statistics, statistics_2)
+
+def _create_stackup(bw_file, roi_df, flank, nbins, cache_dir=None):
+    """
+    Create the stackup plot of a bigWig file for the regions of interest, see `create_stackup_plot`.
+    It is cached in `cache_dir` (see `get_cache_dir`, not cached if it is None).
+    """
+    with record_stage('stackup', sample=bw_file, bins=len(roi_df) * 3 * nbins):
+        return create_stackup_plot(bw_file, roi_df, flank=flank, nbins=nbins, cache_dir=cache_dir)
+
+def _get_significance_params(n_boot=0, n_perm=0, ci=0.95, gaps_file=None, seed=None):
+    """
+    Parameters of the significance statistics of the IPA profiles with the gaps read from `gaps_file`,
+    or None if both the bootstrap and the permutation null are disabled.
+    """
+    if not n_boot and not n_perm:
+        return None
+    assert 0 < ci < 1, f"Confidence level must be between 0 and 1, got {ci}"
+    gaps_df = read_bed(gaps_file, ['chrom', 'start', 'end']) if gaps_file is not None else None
+    return {'n_boot': n_boot, 'n_perm': n_perm, 'ci': ci, 'gaps_df': gaps_df, 'seed': seed}
+
+def _get_profile_statistics(stackup_concat, get_intervals, roi_df, flank, nbins, significance, null_lock=None):
+    """
+    Bootstrap confidence interval and permutation null of the mean profile of a stackup plot (None without `significance`).
+    `get_intervals` returns the intervals of the signal and the chromosome sizes (see `read_bigwig_intervals`), which are
+    kept in memory to stack up all random sets of shifted ROI; it is called only for the permutation null (no null if it is None).
+    If `null_lock` is given, the intervals are read and kept in memory only while it is held, so that concurrent threads hold the intervals
+    of one bigWig file at a time.
+    """
+    if significance is None:
+        return None
+
+    null_profiles = None
+    if significance['n_perm'] and get_intervals is not None:
+        with null_lock if null_lock is not None else nullcontext(), record_stage('null_profiles', bins=significance['n_perm'] * len(roi_df) * 3 * nbins):
+            intervals, chromsizes = get_intervals()
+            null_profiles = calculate_null_profiles(lambda shifted_df: create_stackup_plot_from_intervals(intervals, chromsizes, shifted_df, flank, nbins),
+                                                    roi_df, chromsizes, flank, nbins, significance['n_perm'], significance['gaps_df'], significance['seed'])
+            # (released before the lock)
+            del intervals
+
+    with record_stage('profile_statistics', bins=significance['n_boot'] * stackup_concat.size):
+        return calculate_profile_statistics(stackup_concat, significance['n_boot'], significance['ci'], null_profiles, significance['seed'])
+
+def _read_roi(roi_file, min_roi_size=None, max_roi_size=None):
+    """
+    Read the annotation file with the regions of interest (ROI), check it and filter regions based on their size.
+
+    Returns:
+        DataFrame with the region of interest information.
+    """
     # Read the annotation file with the regions of interest (e.g. TSS-TES sites)
-    roi_df = bioframe.read_table(roi_file, schema='bed')
+    # (read with `read_bed`: importing bioframe pulls in matplotlib, which the profiles-only mode avoids)
+    with record_stage('read_roi', sample=roi_file):
+        roi_df = read_bed(roi_file)
 
     # Check if the annotation file contains the required columns
     assert all(column in roi_df.columns for column in ['chrom', 'start', 'end']), f"File {roi_file} must contain at least these three columns: {'chrom', 'start', 'end'}"
@@ -106,48 +876,43 @@ def ipa_plot(bw_file, roi_file, output_dir, extra_bw_file=None, roi_start_name=N
     warning_chromnames(roi_df['chrom'], roi_file)
 
     # Region filtering based on the size
-    roi_df = filter_regions(roi_df, min_roi_size, max_roi_size)
-
-    # Create a stackup plot
-    stackup_concat = create_stackup_plot(bw_file, roi_df, flank=flank, nbins=nbins)
-
-    # IPA plot
-    f, ax1 = plt.subplots(figsize=[15, 5])
+    return filter_regions(roi_df, min_roi_size, max_roi_size)
 
-    # Plot the first dataset
-    line1, = ax1.plot(np.nanmean(stackup_concat, axis=0), label=os.path.basename(bw_file))
-    ax1.set_xlabel(f'Distance from {roi_start_name}/{roi_end_name}, kbp')
-    ax1.set_ylabel(os.path.basename(bw_file))
-    ax1.set_title(os.path.basename(os.path.normpath(output_dir)))
-
-    # Make x-axis ticks
-    x_ticks = list(np.arange(0, nbins + 10, 10)) + list(np.arange(2 * nbins - 1, 3 * nbins, 10))
-    x_labels = [int(x) for x in list(np.linspace(-flank // 1000, 0, 6))[:-1]] + [roi_start_name, roi_end_name] + [int(x) for x in list(np.linspace(0, flank // 1000, 6))[1:]]
-
-    ax1.set_xticks(x_ticks)
-    ax1.set_xticklabels(x_labels)
-
-    # Create a second y-axis (optional)
+def _output_plot_path(output_dir, bw_file, extra_bw_file=None, profiles_only=False, profile_format='tsv'):
+    """
+    Path to the output file of an IPA plot (a .png file or, in the profiles-only mode, a profile table), named after its bigWig files.
+    """
+    name = os.path.basename(bw_file).split('.')[0]
     if extra_bw_file is not None:
-        stackup_concat_2 = create_stackup_plot(extra_bw_file, roi_df, flank=flank, nbins=nbins)
-        ax2 = ax1.twinx()
-        line2, = ax2.plot(np.nanmean(stackup_concat_2, axis=0), color='r', label=os.path.basename(extra_bw_file))
-        ax2.set_ylabel(os.path.basename(extra_bw_file))
-        lines = [line1, line2]
-        output_plot_filename = os.path.join(output_dir, f"{os.path.basename(bw_file).split('.')[0]}_{os.path.basename(extra_bw_file).split('.')[0]}.png")
-    else:
-        lines = [line1]
-        output_plot_filename = os.path.join(output_dir, f"{os.path.basename(bw_file).split('.')[0]}.png")
-    
-    # Combine legends
-    labels = [line.get_label() for line in lines]
-    ax1.legend(lines, labels, loc='best')
+        name += f"_{os.path.basename(extra_bw_file).split('.')[0]}"
+    return os.path.join(output_dir, f"{name}.profiles.{profile_format}" if profiles_only else f"{name}.png")
+
+def _save_ipa_plot(stackup_concat, bw_file, roi_file, output_dir, stackup_concat_2=None, extra_bw_file=None, roi_start_name=None, roi_end_name=None, flank=100_000, nbins=50, profiles_only=False, profile_format='tsv', statistics=None, statistics_2=None):
+    """
+    Save an IPA plot from one or two stackup plots: either render it to a .png file or, in the profiles-only mode,
+    write the aggregated profiles to a table without importing matplotlib. The significance statistics of the profiles
+    (optional) are drawn as bands or written as extra columns.
+    """
+    output_path = _output_plot_path(output_dir, bw_file, extra_bw_file, profiles_only, profile_format)
+    with record_stage('profile_table' if profiles_only else 'render', sample=bw_file, extra_sample=extra_bw_file) as record:
+        if profiles_only:
+            # Profile table with mean, median, SEM and number of values per bin for every bigWig file
+            stackups = {os.path.basename(bw_file): stackup_concat}
+            profile_statistics = {os.path.basename(bw_file): statistics or {}}
+            if extra_bw_file is not None:
+                stackups[os.path.basename(extra_bw_file)] = stackup_concat_2
+                profile_statistics[os.path.basename(extra_bw_file)] = statistics_2 or {}
+            profiles_df = create_profile_table(stackups, os.path.basename(roi_file).split('.')[0], flank, profile_statistics)
+            write_profile_table(profiles_df, output_path)
+        else:
+            from ipa.render import render_ipa_plot
 
-    # Save the plot
-    f.savefig(output_plot_filename, dpi=300, bbox_inches='tight')
-    plt.close(f)
+            profile_2 = np.nanmean(stackup_concat_2, axis=0) if stackup_concat_2 is not None else None
+            render_ipa_plot(np.nanmean(stackup_concat, axis=0), bw_file, output_dir, profile_2, extra_bw_file, roi_start_name, roi_end_name, flank, nbins, statistics, statistics_2)
+        if metrics_enabled():
+            record['bytes_written'] = os.path.getsize(output_path)
 
-def ipa(clr_path, roi_file, output_dir, bw_dir=None, expected=False, clr_weight_name='weight', min_dist=40_000, max_dist=100_000, nproc=4, roi_start_name=None, roi_end_name=None, flank=100_000, nbins=50, min_roi_size=None, max_roi_size=None):
+def ipa(clr_path, roi_file, output_dir, bw_dir=None, expected=False, clr_weight_name='weight', min_dist=40_000, max_dist=100_000, nproc=4, roi_start_name=None, roi_end_name=None, flank=100_000, nbins=50, min_roi_size=None, max_roi_size=None, engine='banded', nworkers=1, max_memory=None, cache_dir=None, index_path=None, precision='float64', profiles_only=False, profile_format='tsv', resume=False, roi_only=False, n_boot=0, n_perm=0, ci=0.95, gaps_file=None, seed=None):
     """
     Run the Interaction Pattern Aggregation analysis (IPA).
     It consists of two steps:
@@ -162,21 +927,89 @@ def ipa(clr_path, roi_file, output_dir, bw_dir=None, expected=False, clr_weight_
         clr_weight_name: The name of the column in the .cool file that contains the balancing weights (default: 'weight').
         min_dist: Minimum distance (in bp) between two loci to consider for the IPA calculation, e.g. minimum loop size in bp. If None, restriction on minimum distance is not applied (default: 40_000).
         max_dist: Maximum distance (in bp) between two loci to consider for the IPA calculation, e.g. maximum loop size in bp. If None, restriction on maximum distance is not applied (default: 100_000).
-        nproc: Number of processes to use for the calculation of expected (default: 4).
+        nproc: Number of processes to use for the calculation of expected and number of threads to calculate the stackups of the bigWig files from `bw_dir` with (default: 4).
         roi_start_name: Alias for the start of the region of interest, e.g. TSS or loop start (default: None).
         roi_end_name: Alias for the end of the region of interest, e.g. TES or loop end (default: None).
         flank: Flank size in bp (default: 100_000).
         nbins: Number of bins to split the ROI into (default: 50).
         min_roi_size: Minimum size of the region of interest in bp to filter out small regions in the roi file (default: None).
         max_roi_size: Maximum size of the region of interest in bp to filter out small regions in the roi file (default: None).
+        engine: Engine to calculate the IPA track with: 'banded', 'dense' or 'fused', see `ipa_track` (default: 'banded').
+        nworkers: Number of worker processes that calculate chromosomes of the IPA track in parallel (default: 1).
+        max_memory: (optional) Memory budget for the IPA track calculation in bytes or as a string like '16G' (default: None).
+        cache_dir: (optional) Path to the directory to cache the expected and the stackup plots in. If None, they are cached in the '.ipa_cache' directory of `output_dir`. If False, nothing is cached (default: None).
+        index_path: (optional) Path to the cumulative distance profile index (.npy) built by `ipa_index` for this .cool file (default: None).
+        precision: Floating point precision of the contact values for the IPA track calculation, 'float32' or 'float64' (default: 'float64').
+        profiles_only: If True, the aggregated profiles are written to tables instead of rendering the plots, see `ipa_plot` (default: False).
+        profile_format: Format of the profile tables: 'tsv' or 'parquet' (default: 'tsv').
+        resume: If True, a killed run is resumed from the chromosome checkpoints of the IPA track, and the track and the plots that are
+            recorded as finished in the manifest of `output_dir` with unchanged input files and parameters are not calculated again (default: False).
+        roi_only: If True, the IPA track is calculated only for the bins inside the ROI extended by `flank` (merged into windows) with the 'banded' engine,
+            and its stackup plot is created in memory, without writing the genome-wide .bw file. Worth it for sparse ROI, e.g. a few hundred loop anchors.
+            `engine`, `max_memory` and `index_path` are not used (default: False).
+        n_boot: Number of bootstrap resamples of the ROI for the confidence interval of every profile, see `ipa_plot` (default: 0).
+        n_perm: Number of random sets of shifted ROI for the empirical null of every profile, see `ipa_plot`. With `roi_only`, the IPA track
+            is known only around the ROI, so the null is calculated for the bigWig files from `bw_dir` only (default: 0).
+        ci: Confidence level of the bootstrap interval and of the null band (default: 0.95).
+        gaps_file: (optional) Path to a BED file with the gaps that the shifted ROI with their flanks avoid (default: None).
+        seed: (optional) Seed of the random number generator of the bootstrap and the shifted ROI (default: None).
     """
-    # Step 1: Create a .bw file from .cool file
-    ipa_track(clr_path, output_dir, expected=expected, clr_weight_name=clr_weight_name, min_dist=min_dist, max_dist=max_dist, nproc=nproc)
+    # The expected and the stackup plots of all steps are cached in `output_dir` by default
+    cache_dir = os.path.join(output_dir, CACHE_DIR_NAME) if cache_dir is None else cache_dir
+
+    # Step 1: Create a .bw file from .cool file (with `roi_only`, the track around the ROI is calculated in step 2 instead)
+    if not roi_only:
+        ipa_track(clr_path, output_dir, expected=expected, clr_weight_name=clr_weight_name, min_dist=min_dist, max_dist=max_dist, nproc=nproc, engine=engine, nworkers=nworkers, max_memory=max_memory, cache_dir=cache_dir, index_path=index_path, precision=precision, resume=resume)
 
     # Step 2: Create a stackup plot from .bw files
+    bw_file = os.path.join(output_dir, "ipa_track.bw")
     if bw_dir is None:
-        ipa_plot(os.path.join(output_dir, "ipa_track.bw"), roi_file, os.path.join(output_dir, "ipa_track.png"), extra_bw_file=None, roi_start_name=roi_start_name, roi_end_name=roi_end_name, flank=flank, nbins=nbins, min_roi_size=min_roi_size, max_roi_size=max_roi_size)
+        plot_dir, extra_bw_files = os.path.join(output_dir, "ipa_track.png"), [None]
     else:
-        bw_files = [os.path.join(bw_dir, f) for f in os.listdir(bw_dir) if f.lower().endswith('.bw') or f.lower().endswith('.bigwig')]
-        for bw_file in bw_files:
-            ipa_plot(os.path.join(output_dir, "ipa_track.bw"), roi_file, output_dir, extra_bw_file=bw_file, roi_start_name=roi_start_name, roi_end_name=roi_end_name, flank=flank, nbins=nbins, min_roi_size=min_roi_size, max_roi_size=max_roi_size)
+        plot_dir = output_dir
+        extra_bw_files = [os.path.join(bw_dir, f) for f in os.listdir(bw_dir) if f.lower().endswith('.bw') or f.lower().endswith('.bigwig')]
+
+    # Key of every plot: identity of the input files (of the .cool file and the track parameters if the track is not written) and the plot parameters
+    if roi_only:
+        file_path, group_path = split_cooler_uri(clr_path)
+        track_identity = make_cache_key(cooler=file_identity(file_path), group=group_path, expected=expected, clr_weight_name=clr_weight_name,
+                                        min_dist=min_dist, max_dist=max_dist, precision=precision)
+    else:
+        track_identity = file_identity(bw_file)
+    plot_params = dict(roi=file_identity(roi_file), roi_start_name=roi_start_name, roi_end_name=roi_end_name, flank=flank, nbins=nbins,
+                       min_roi_size=min_roi_size, max_roi_size=max_roi_size, profiles_only=profiles_only, profile_format=profile_format,
+                       n_boot=n_boot, n_perm=n_perm, ci=ci, gaps=file_identity(gaps_file) if gaps_file is not None else None, seed=seed)
+    plot_keys = {extra_bw_file: make_cache_key(bw=track_identity, extra_bw=file_identity(extra_bw_file) if extra_bw_file is not None else None, **plot_params)
+                 for extra_bw_file in extra_bw_files}
+    plot_steps = {extra_bw_file: f"plot:{os.path.basename(_output_plot_path(plot_dir, bw_file, extra_bw_file, profiles_only, profile_format))}" for extra_bw_file in extra_bw_files}
+
+    # Skip the plots that are up to date (optional)
+    if resume:
+        extra_bw_files = [extra_bw_file for extra_bw_file in extra_bw_files if not is_step_done(output_dir, plot_steps[extra_bw_file], plot_keys[extra_bw_file])]
+        if not extra_bw_files:
+            logger.info(f"IPA plots in {plot_dir} are up to date, skipping them")
+            return
+
+    if roi_only:
+        # IPA track around the ROI and its stackup plot in memory, then the plots with the extra bigWig files
+        os.makedirs(plot_dir, exist_ok=True)
+        roi_df = _read_roi(roi_file, min_roi_size, max_roi_size)
+        ipa_tracks, resolution, chromsizes = _ipa_track_roi(clr_path, roi_df, flank, expected, clr_weight_name, min_dist, max_dist, nproc, nworkers, cache_dir, precision)
+        with record_stage('stackup', sample=clr_path, bins=len(roi_df) * 3 * nbins):
+            stackup_concat = create_stackup_plot_from_tracks(ipa_tracks, resolution, chromsizes, roi_df, flank, nbins)
+        # (the shifted ROI would fall outside the calculated windows, so there is no permutation null of the IPA track)
+        significance = _get_significance_params(n_boot, n_perm, ci, gaps_file, seed)
+        if n_perm:
+            warnings.warn("The IPA track is calculated around the ROI only, so the permutation null is calculated for the bigWig files from `bw_dir` only.")
+        statistics = _get_profile_statistics(stackup_concat, None, roi_df, flank, nbins, significance)
+        _save_ipa_plots(stackup_concat, bw_file, roi_df, roi_file, plot_dir, extra_bw_files, roi_start_name, roi_end_name, flank, nbins, nproc, get_cache_dir(plot_dir, cache_dir), profiles_only, profile_format, significance, statistics)
+    elif bw_dir is None:
+        ipa_plot(bw_file, roi_file, plot_dir, extra_bw_file=None, roi_start_name=roi_start_name, roi_end_name=roi_end_name, flank=flank, nbins=nbins, min_roi_size=min_roi_size, max_roi_size=max_roi_size, cache_dir=cache_dir, profiles_only=profiles_only, profile_format=profile_format,
+                 n_boot=n_boot, n_perm=n_perm, ci=ci, gaps_file=gaps_file, seed=seed)
+    else:
+        ipa_plot_batch(bw_file, roi_file, plot_dir, extra_bw_files, roi_start_name=roi_start_name, roi_end_name=roi_end_name, flank=flank, nbins=nbins, min_roi_size=min_roi_size, max_roi_size=max_roi_size, nproc=nproc, cache_dir=cache_dir, profiles_only=profiles_only, profile_format=profile_format,
+                       n_boot=n_boot, n_perm=n_perm, ci=ci, gaps_file=gaps_file, seed=seed)
+
+    # Record the finished plots in the manifest
+    for extra_bw_file in extra_bw_files:
+        mark_step_done(output_dir, plot_steps[extra_bw_file], plot_keys[extra_bw_file], [_output_plot_path(plot_dir, bw_file, extra_bw_file, profiles_only, profile_format)])
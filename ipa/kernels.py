@@ -0,0 +1,64 @@
+import os
+
+
+# Backends of the inner loops of `ipa.lib` (band sums, per-diagonal sums, diagonal masking, expected matrix, stackup flipping):
+# 'numpy' runs the vectorized NumPy code, 'numba' the JIT-compiled kernels of `ipa.numba_kernels` with the GIL released
+BACKENDS = ('numpy', 'numba')
+
+# Environment variable with the initial backend, read on the first use of the backend only
+BACKEND_ENV = 'IPA_KERNEL_BACKEND'
+
+# Backend selected by `set_backend` (None until the first use, then initialized from `BACKEND_ENV`)
+_backend = None
+
+def numba_available():
+    """
+    Check if numba is installed.
+    """
+    import importlib.util
+    return importlib.util.find_spec('numba') is not None
+
+def set_backend(backend):
+    """
+    Select the backend of the inner loops for the current process. Worker processes get the backend of the main process
+    with their jobs, see `get_backend`.
+
+    Args:
+        backend: 'numpy', 'numba' or 'auto' ('numba' if numba is installed, otherwise 'numpy').
+
+    Returns:
+        The selected backend.
+    """
+    assert backend in BACKENDS + ('auto',), f"The kernel backend should be one of {', '.join(BACKENDS + ('auto',))}, got '{backend}'"
+    if backend == 'auto':
+        backend = 'numba' if numba_available() else 'numpy'
+    elif backend == 'numba' and not numba_available():
+        raise ImportError("numba is required for the 'numba' kernel backend. Install numba or use the 'numpy' backend instead.")
+
+    global _backend
+    _backend = backend
+    return backend
+
+def get_backend():
+    """
+    Get the backend of the inner loops selected by `set_backend`. If no backend is selected, it is initialized from
+    the `IPA_KERNEL_BACKEND` environment variable, 'numpy' by default.
+    """
+    global _backend
+    if _backend is None:
+        backend = os.environ.get(BACKEND_ENV, 'numpy')
+        _backend = backend if backend in BACKENDS else 'numpy'
+    return _backend
+
+def get_numba_kernels(backend=None):
+    """
+    Get the module of the numba kernels if the 'numba' backend is selected, otherwise None.
+    The module is imported on first use, so that numba is not imported (and nothing is compiled) with the 'numpy' backend.
+
+    Args:
+        backend: (optional) 'numpy' or 'numba' to use instead of the selected backend (default: None, see `get_backend`).
+    """
+    if (backend if backend is not None else get_backend()) != 'numba':
+        return None
+    from ipa import numba_kernels
+    return numba_kernels
@@ -1,13 +1,63 @@
+import os
 import warnings
 
-import bbi
-import cooler
-import cooltools
 import numpy as np
 import pandas as pd
 
+from ipa.cache import stackup_cache_path
+from ipa.kernels import get_numba_kernels
 
-def mask_out_diagonals(matrix, min_diag, max_diag):
+
+# Weight columns stored in divisive form (4DN data portal, hic2cool), see `cooler.Cooler.matrix`
+DIVISIVE_WEIGHTS = ("KR", "VC", "VC_SQRT")
+
+# Columns of a BED6 file read by `read_bed` and the defaults of its optional columns
+BED_COLUMNS = ['chrom', 'start', 'end', 'name', 'score', 'strand']
+BED_DEFAULTS = {'name': '.', 'score': 0, 'strand': '.'}
+
+# Maximum number of matrix elements processed at once by the vectorized diagonal operations
+BLOCK_SIZE = 4_000_000
+
+# Approximate memory per pixel of a chunk read by the 'banded' engine: bin ids, counts, band mask and balanced values
+BYTES_PER_PIXEL = 48
+
+def iter_diagonal_offsets(shape, row_offset=0, col_offset=0, band=None, block_size=BLOCK_SIZE):
+	"""
+	Iterate over blocks of rows of a matrix together with the diagonal offsets of their elements.
+	The offset of the element (i, j) is |j - i|, i.e. the index of the diagonal the element lies on,
+	so that a band of diagonals can be selected or filled with a single vectorized operation per block.
+
+	Args:
+		shape: Shape of the matrix (number of rows, number of columns).
+		row_offset: Index of the first row of the matrix in the full matrix, for submatrices (default: 0).
+		col_offset: Index of the first column of the matrix in the full matrix, for submatrices (default: 0).
+		band: (optional) If given, only the columns of the elements with offsets lower than `band` are included in the blocks (default: None).
+		block_size: Maximum number of elements in a block, which bounds the size of the offsets array (default: BLOCK_SIZE).
+
+	Yields:
+		Tuples (rows, cols, offsets): slices of rows and columns of the block and a NumPy 2D array with the diagonal offsets of the block elements.
+	"""
+	nrows, ncols = shape
+	if band is None:
+		block_rows = max(1, block_size // max(ncols, 1))
+	else:
+		# Blocks of rows are kept short, so that the columns of a block stay close to the band
+		block_rows = max(1, min(max(64, 2 * band), block_size // (4 * band)))
+	for row_lo in range(0, nrows, block_rows):
+		row_hi = min(row_lo + block_rows, nrows)
+
+		# Columns of the block
+		if band is None:
+			col_lo, col_hi = 0, ncols
+		else:
+			col_lo = min(max(0, row_offset + row_lo - col_offset - band + 1), ncols)
+			col_hi = max(min(ncols, row_offset + row_hi - col_offset + band - 1), col_lo)
+
+		rows = np.arange(row_offset + row_lo, row_offset + row_hi)
+		cols = np.arange(col_offset + col_lo, col_offset + col_hi)
+		yield slice(row_lo, row_hi), slice(col_lo, col_hi), np.abs(cols[np.newaxis, :] - rows[:, np.newaxis])
+
+def mask_out_diagonals(matrix, min_diag, max_diag, row_offset=0, col_offset=0):
 	"""
 	Mask out first `min_diag` diagonals and diagonals starting 
 	from `max_diag` diagonal until the end of the matrix `matrix`.
@@ -16,27 +66,28 @@ def mask_out_diagonals(matrix, min_diag, max_diag):
 		matrix: NumPy 2D array (matrix) to modify.
 		min_diag: number of first diagonals to mask out.
 		max_diag: number of last diagonals to mask out.
+		row_offset: Index of the first row of `matrix` in the full matrix, if `matrix` is a tile of it (default: 0).
+		col_offset: Index of the first column of `matrix` in the full matrix, if `matrix` is a tile of it (default: 0).
 	"""
-	# Define functions to mask out diagonals above and below the main diagonal
-	mask_diagonal_above = lambda matrix, k: np.fill_diagonal(matrix[:, k:], np.nan) if matrix.shape[1] - k > 0 else None
-	mask_diagonal_below = lambda matrix, k: np.fill_diagonal(matrix[k:, :], np.nan) if matrix.shape[0] - k > 0 else None
+	# JIT-compiled kernel (optional, see `ipa.kernels`)
+	numba_kernels = get_numba_kernels()
+	if numba_kernels is not None:
+		numba_kernels.mask_out_diagonals(matrix, min_diag, -1 if max_diag is None else max_diag, row_offset, col_offset)
+		return
 
-	# Mask out diagonals lower the `min_diag` diagonal
-	for k in range(min_diag):
-		# Mask out the main diagonal (k = 0)
-		if k == 0:
-			np.fill_diagonal(matrix, np.nan)
-		else:
-			# Mask out the diagonal k
-			mask_diagonal_above(matrix, k)
-			mask_diagonal_below(matrix, k)
+	nrows, ncols = matrix.shape
+	if max_diag is None or max_diag >= max(row_offset + nrows - col_offset, col_offset + ncols - row_offset) - 1:
+		# Nothing to mask out
+		if min_diag <= 0:
+			return
 
-	# Mask out diagonals higher the `max_diag` diagonal 
-	if max_diag is not None:
-		for k in range(max_diag + 1, matrix.shape[0]):
-			# Mask out the diagonal k
-			mask_diagonal_above(matrix, k)
-			mask_diagonal_below(matrix, k)
+		# Mask out diagonals lower the `min_diag` diagonal, only the narrow band around the main diagonal is processed
+		for rows, cols, offsets in iter_diagonal_offsets(matrix.shape, row_offset, col_offset, band=min_diag):
+			matrix[rows, cols][offsets < min_diag] = np.nan
+	else:
+		# Mask out diagonals lower the `min_diag` diagonal and higher the `max_diag` diagonal
+		for rows, cols, offsets in iter_diagonal_offsets(matrix.shape, row_offset, col_offset):
+			matrix[rows, cols][(offsets < min_diag) | (offsets > max_diag)] = np.nan
 
 def create_expected_matrix(expected_arr):
 	"""
@@ -50,22 +101,23 @@ def create_expected_matrix(expected_arr):
 	Returns:
 		A square NumPy matrix with diagonals filled symmetrically.
 	"""
+	expected_arr = np.asarray(expected_arr)
 	n = len(expected_arr)  # The size of the square matrix (nxn)
-	matrix = np.zeros((n, n), dtype=expected_arr.dtype)  # Initialize an empty square matrix
+	matrix = np.empty((n, n), dtype=expected_arr.dtype)
 
-	# Fill the main diagonal (0th diagonal)
-	np.fill_diagonal(matrix, expected_arr[0])
-	
-	# Fill the upper and lower diagonals symmetrically
-	for k in range(1, n):
-		# Fill k-th diagonal above the main diagonal (upper diagonal)
-		if k < n:
-			np.fill_diagonal(matrix[:, k:], expected_arr[k])  # Fill diagonal above the main diagonal
-			np.fill_diagonal(matrix[k:, :], expected_arr[k])  # Fill corresponding lower diagonal
+	# JIT-compiled kernel (optional, see `ipa.kernels`)
+	numba_kernels = get_numba_kernels()
+	if numba_kernels is not None:
+		numba_kernels.fill_expected_matrix(matrix, expected_arr)
+		return matrix
+
+	# Fill every element with the expected value of its diagonal
+	for rows, cols, offsets in iter_diagonal_offsets(matrix.shape):
+		matrix[rows, cols] = expected_arr[offsets]
 
 	return matrix
 
-def fetch_cis_matrix(clr, chrom, clr_weight_name):
+def fetch_cis_matrix(clr, chrom, clr_weight_name, dtype=np.float64):
 	"""
 	Fetch the cis contact matrix for a given chromosome from a Cooler object.
 	
@@ -73,6 +125,7 @@ def fetch_cis_matrix(clr, chrom, clr_weight_name):
 		clr: Cooler object.
 		chrom: Chromosome name.
 		clr_weight_name: The name of the column in the .cool file that contains the balancing weights (default: 'weight').
+		dtype: Floating point type of the matrix, e.g. np.float32 to halve the memory (default: np.float64).
 	
 	Returns:
 		A NumPy 2D array with the cis contact matrix.
@@ -81,56 +134,600 @@ def fetch_cis_matrix(clr, chrom, clr_weight_name):
 	if clr_weight_name is None:
 		cis_matrix = clr.matrix(balance=False, sparse=True).fetch(chrom)
 	else:
-		cis_matrix = clr.matrix(balance=True, sparse=True).fetch(chrom)
+		cis_matrix = clr.matrix(balance=clr_weight_name, sparse=True).fetch(chrom)
 	
-	# Convert the sparse matrix to a dense NumPy array -- maybe to skip this step and put sparse=False in clr.matrix()?
-	cis_matrix_np = cis_matrix.toarray()
+	# Convert the sparse matrix to a dense NumPy array of the requested type
+	# (only the non-zero values are cast, so the dense matrix is allocated once)
+	cis_matrix_np = cis_matrix.astype(dtype).toarray()
 	del cis_matrix
 
-	# Convert the matrix to float type -- is there a way in Cooler to specify the type of the matrix?
-	cis_matrix_np = cis_matrix_np.astype(float)
-
 	return cis_matrix_np
 
-def calculate_observed_over_expected_matrix(cis_matrix, clr, chrom, view_df, min_diag, clr_weight_name, nproc):
+def fetch_cis_tile(clr, chrom, row_lo, row_hi, max_diag, clr_weight_name, dtype=np.float64):
 	"""
-	Calculate the observed over expected matrix for a given chromosome.
-	
+	Fetch a tile of rows of the cis contact matrix for a given chromosome: rows from `row_lo` to `row_hi` and the columns
+	within `max_diag` diagonals of them, so that the sums over the rows inside the [`min_diag`, `max_diag`] band are complete.
+	Tiles of consecutive rows overlap by `max_diag` columns on both sides.
+
 	Args:
-		cis_matrix: NumPy 2D array with the cis contact matrix.
 		clr: Cooler object.
 		chrom: Chromosome name.
+		row_lo: First row of the tile (relative to the chromosome start).
+		row_hi: Row after the last row of the tile (relative to the chromosome start).
+		max_diag: Last diagonal of the band. If None, the tile includes all columns.
+		clr_weight_name: The name of the column in the .cool file that contains the balancing weights. If None, raw counts are fetched.
+		dtype: Floating point type of the tile (default: np.float64).
+
+	Returns:
+		A tuple (tile, col_lo): NumPy 2D array with the tile and the index of its first column (relative to the chromosome start).
+	"""
+	lo, hi = clr.extent(chrom)
+	col_lo = 0 if max_diag is None else max(0, row_lo - max_diag)
+	col_hi = hi - lo if max_diag is None else min(hi - lo, row_hi + max_diag)
+
+	balance = False if clr_weight_name is None else clr_weight_name
+	tile = clr.matrix(balance=balance, sparse=True)[lo + row_lo:lo + row_hi, lo + col_lo:lo + col_hi]
+
+	return tile.astype(dtype).toarray(), col_lo
+
+def fetch_band_pixels(clr, chrom, min_diag, max_diag, clr_weight_name, chunksize=10_000_000, dtype=np.float64, row_lo=0, row_hi=None):
+	"""
+	Fetch the cis pixels of a given chromosome (or of a range of its rows) that lie inside the [`min_diag`, `max_diag`] diagonal band.
+	Pixels are read straight from the pixel table of the .cool file in chunks of `chunksize` pixels,
+	so the contact matrix is never densified.
+
+	Args:
+		clr: Cooler object.
+		chrom: Chromosome name.
+		min_diag: First diagonal of the band (diagonals below it are skipped).
+		max_diag: Last diagonal of the band. If None, the band is not restricted from above.
+		clr_weight_name: The name of the column in the .cool file that contains the balancing weights. If None, raw counts are returned.
+		chunksize: Number of pixels to read from the .cool file at once (default: 10_000_000).
+		dtype: Floating point type of the contact values (default: np.float64).
+		row_lo: First row (bin1, relative to the chromosome start) of the pixels to fetch (default: 0).
+		row_hi: End of the rows of the pixels to fetch. If None, the rows up to the end of the chromosome are fetched (default: None).
+
+	Yields:
+		Tuples of NumPy 1D arrays (bin1, bin2, values) with bin indices relative to the chromosome start and the (balanced) contact values.
+	"""
+	lo, hi = clr.extent(chrom)
+	row_hi = hi - lo if row_hi is None else row_hi
+
+	# Range of the pixel table that holds the rows
+	with clr.open('r') as grp:
+		pixel_lo, pixel_hi = grp['indexes']['bin1_offset'][[lo + row_lo, lo + row_hi]]
+
+	# Balancing weights of the chromosome bins
+	if clr_weight_name is not None:
+		weights = clr.bins()[clr_weight_name][lo:hi].to_numpy()
+		if clr_weight_name in DIVISIVE_WEIGHTS:
+			weights = 1 / weights
+		weights = weights.astype(dtype)
+
+	pixels = clr.pixels()
+	for chunk_lo in range(pixel_lo, pixel_hi, chunksize):
+		chunk = pixels[chunk_lo:min(chunk_lo + chunksize, pixel_hi)]
+		bin1 = chunk['bin1_id'].to_numpy() - lo
+		bin2 = chunk['bin2_id'].to_numpy() - lo
+
+		# Keep only cis pixels inside the diagonal band
+		diag = bin2 - bin1
+		in_band = (bin2 < hi - lo) & (diag >= min_diag)
+		if max_diag is not None:
+			in_band &= diag <= max_diag
+		bin1, bin2 = bin1[in_band], bin2[in_band]
+		values = chunk['count'].to_numpy()[in_band].astype(dtype)
+		del chunk, diag, in_band
+
+		# Balance the contact values
+		if clr_weight_name is not None:
+			values *= weights[bin1] * weights[bin2]
+
+		yield bin1, bin2, values
+
+def calculate_banded_sum(clr, chrom, min_diag, max_diag, clr_weight_name, expected_arr=None, chunksize=10_000_000, dtype=np.float64, row_lo=0, row_hi=None):
+	"""
+	Calculate the sum of contacts inside the [`min_diag`, `max_diag`] diagonal band for every bin of a given chromosome (or of a range of its bins).
+	Every pixel is added to both of its bins (pixels on the main diagonal are added once), which gives the same
+	result as `np.nansum` over the rows of the dense matrix masked by `mask_out_diagonals`,
+	while memory scales with the number of bins instead of its square.
+
+	Args:
+		clr: Cooler object.
+		chrom: Chromosome name.
+		min_diag: First diagonal of the band (diagonals below it are skipped).
+		max_diag: Last diagonal of the band. If None, the band is not restricted from above.
+		clr_weight_name: The name of the column in the .cool file that contains the balancing weights. If None, raw counts are summed.
+		expected_arr: (optional) NumPy 1D array of expected values per diagonal. If given, the observed over expected values are summed (default: None).
+		chunksize: Number of pixels to read from the .cool file at once (default: 10_000_000).
+		dtype: Floating point type of the contact values. The sums are always accumulated in float64 (default: np.float64).
+		row_lo: First bin (relative to the chromosome start) to calculate the sum for (default: 0).
+		row_hi: End of the bins to calculate the sum for. If None, the sum is calculated up to the end of the chromosome (default: None).
+			Pixels are read from the rows `max_diag` bins above `row_lo` on, because the upper triangle of the matrix holds the contacts of a bin with the bins before it in their rows.
+
+	Returns:
+		A NumPy 1D array with the sum of contacts for every bin from `row_lo` to `row_hi`.
+	"""
+	lo, hi = clr.extent(chrom)
+	row_hi = hi - lo if row_hi is None else row_hi
+	nrows = row_hi - row_lo
+	ipa_track = np.zeros(nrows)
+	pixel_row_lo = max(0, row_lo - max_diag) if max_diag is not None else 0
+	numba_kernels = get_numba_kernels()
+
+	# (`np.bincount` accumulates the weights in float64 whatever their type is)
+	for bin1, bin2, values in fetch_band_pixels(clr, chrom, min_diag, max_diag, clr_weight_name, chunksize, dtype, pixel_row_lo, row_hi):
+		# JIT-compiled kernel (optional, see `ipa.kernels`), an empty expected array stands for raw values
+		if numba_kernels is not None:
+			numba_kernels.accumulate_band_sums(ipa_track, bin1, bin2, values, row_lo, np.empty(0) if expected_arr is None else expected_arr)
+			continue
+
+		# Observed over expected values (optional)
+		if expected_arr is not None:
+			values /= expected_arr[bin2 - bin1]
+
+		# Skip pixels of the masked out bins, like `np.nansum` does
+		valid = ~np.isnan(values)
+		bin1, bin2, values = bin1[valid], bin2[valid], values[valid]
+
+		# Add every pixel to both of its bins (within the range of bins)
+		in_rows = bin1 >= row_lo
+		ipa_track += np.bincount(bin1[in_rows] - row_lo, weights=values[in_rows], minlength=nrows)
+		in_cols = (bin1 != bin2) & (bin2 >= row_lo) & (bin2 < row_hi)
+		ipa_track += np.bincount(bin2[in_cols] - row_lo, weights=values[in_cols], minlength=nrows)
+
+	return ipa_track
+
+def count_valid_pairs(good, min_diag, max_diag):
+	"""
+	Count the pairs of valid bins on every diagonal of the [`min_diag`, `max_diag`] band, like the `n_valid` column of `cooltools.expected_cis`.
+
+	Args:
+		good: NumPy 1D boolean array, True for the bins of the chromosome with a balancing weight.
+		min_diag: First diagonal of the band.
+		max_diag: Last diagonal of the band.
+
+	Returns:
+		A NumPy 1D array with the number of valid pairs on every diagonal from `min_diag` to `max_diag`.
+	"""
+	n = len(good)
+	n_valid = np.zeros(max_diag - min_diag + 1, dtype=np.int64)
+	for k in range(min_diag, min(max_diag, n - 1) + 1):
+		n_valid[k - min_diag] = np.count_nonzero(good[:n - k] & good[k:])
+
+	return n_valid
+
+def calculate_fused_oe_sum(clr, chrom, min_diag, max_diag, clr_weight_name, chunksize=10_000_000, dtype=np.float64):
+	"""
+	Calculate the sum of observed over expected contacts inside the [`min_diag`, `max_diag`] diagonal band for every bin
+	of a given chromosome in a single pass over the pixels of the band, without calculating the expected beforehand.
+	The pass accumulates the sum of contacts of every diagonal and the partial sums of every bin on every diagonal.
+	The expected of a diagonal is its sum of contacts over its number of valid pairs, which only depends on the balancing
+	weights (the 'balanced.avg' or 'count.avg' column of `cooltools.expected_cis`), and the O/E sum of a bin is then
+	the sum of its partial sums divided by the expected of their diagonals. The result is the same as `calculate_banded_sum`
+	with the expected of `cooltools.expected_cis`, while the pixels are read once instead of twice.
+
+	Args:
+		clr: Cooler object.
+		chrom: Chromosome name.
+		min_diag: First diagonal of the band (diagonals below it are skipped).
+		max_diag: Last diagonal of the band. The partial sums take (number of bins) x (`max_diag` - `min_diag` + 1) float64 values of memory.
+		clr_weight_name: The name of the column in the .cool file that contains the balancing weights. If None, raw counts are summed.
+		chunksize: Number of pixels to read from the .cool file at once (default: 10_000_000).
+		dtype: Floating point type of the contact values. The sums are always accumulated in float64 (default: np.float64).
+
+	Returns:
+		A NumPy 1D array with the sum of observed over expected contacts for every bin of the chromosome.
+	"""
+	assert max_diag is not None, "The observed over expected sum in a single pass needs a maximum distance"
+	lo, hi = clr.extent(chrom)
+	ndiags = max_diag - min_diag + 1
+	diag_sums = np.zeros(ndiags)
+	partial_sums = np.zeros((hi - lo, ndiags))
+	numba_kernels = get_numba_kernels()
+
+	for bin1, bin2, values in fetch_band_pixels(clr, chrom, min_diag, max_diag, clr_weight_name, chunksize, dtype):
+		# JIT-compiled kernel (optional, see `ipa.kernels`)
+		if numba_kernels is not None:
+			numba_kernels.accumulate_diagonal_sums(diag_sums, partial_sums, bin1, bin2, values, min_diag)
+			continue
+
+		# Skip pixels of the masked out bins, like `np.nansum` does
+		valid = ~np.isnan(values)
+		bin1, bin2, values = bin1[valid], bin2[valid], values[valid]
+		if len(values) == 0:
+			continue
+		diag = bin2 - bin1 - min_diag
+
+		# Sum of contacts of every diagonal (the numerator of the expected)
+		diag_sums += np.bincount(diag, weights=values, minlength=ndiags)
+
+		# Add every pixel to both of its bins at its diagonal (only the rows spanned by the chunk are counted at once)
+		row_lo, row_hi = bin1.min(), bin2.max() + 1
+		chunk_sums = np.bincount((bin1 - row_lo) * ndiags + diag, weights=values, minlength=(row_hi - row_lo) * ndiags)
+		off_diag = bin1 != bin2
+		chunk_sums += np.bincount((bin2[off_diag] - row_lo) * ndiags + diag[off_diag], weights=values[off_diag], minlength=(row_hi - row_lo) * ndiags)
+		partial_sums[row_lo:row_hi] += chunk_sums.reshape(row_hi - row_lo, ndiags)
+
+	# Number of valid pairs of every diagonal (the denominator of the expected): pairs of bins with a balancing weight
+	if clr_weight_name is not None:
+		good = ~np.isnan(clr.bins()[clr_weight_name][lo:hi].to_numpy())
+	else:
+		good = np.ones(hi - lo, dtype=bool)
+	n_valid = count_valid_pairs(good, min_diag, max_diag)
+
+	# Divide the partial sums by the expected (diagonals without contacts or valid pairs add nothing, like NaN values in `calculate_banded_sum`)
+	inverse_expected = np.zeros(ndiags)
+	nonzero = (diag_sums != 0) & (n_valid > 0)
+	inverse_expected[nonzero] = n_valid[nonzero] / diag_sums[nonzero]
+
+	return partial_sums @ inverse_expected
+
+def calculate_distance_profile(clr, chrom, max_diag, clr_weight_name, expected_arr=None, chunksize=10_000_000, out=None):
+	"""
+	Calculate the cumulative distance profile of every bin of a given chromosome: for every bin and every diagonal `k`
+	up to `max_diag`, the sum of contacts of the bin inside the [0, `k`] diagonal band.
+	The sum of contacts inside any [`min_diag`, `max_diag`] band is then a difference of two columns of the profile.
+
+	Args:
+		clr: Cooler object.
+		chrom: Chromosome name.
+		max_diag: Last diagonal of the profile.
+		clr_weight_name: The name of the column in the .cool file that contains the balancing weights. If None, raw counts are summed.
+		expected_arr: (optional) NumPy 1D array of expected values per diagonal. If given, the observed over expected values are summed (default: None).
+		chunksize: Number of pixels to read from the .cool file at once (default: 10_000_000).
+		out: (optional) C-contiguous float64 2D array of shape (number of bins, `max_diag` + 1) to calculate the profile in, e.g. the rows
+			of a memory-mapped index, so that the profile of the chromosome is not kept in memory. It is overwritten (default: None).
+
+	Returns:
+		A NumPy 2D array of shape (number of bins, `max_diag` + 1) with the cumulative sums of contacts (`out` if it is given).
+	"""
+	lo, hi = clr.extent(chrom)
+	ndiags = max_diag + 1
+	if out is None:
+		out = np.zeros((hi - lo, ndiags))
+	else:
+		assert out.shape == (hi - lo, ndiags) and out.dtype == np.float64, f"The profile of chromosome {chrom} must be a float64 array of shape {(hi - lo, ndiags)}"
+		out[...] = 0
+	# (a plain view of a memory-mapped `out`, for the numba kernels)
+	profile = np.asarray(out)
+	numba_kernels = get_numba_kernels()
+
+	for bin1, bin2, values in fetch_band_pixels(clr, chrom, 0, max_diag, clr_weight_name, chunksize):
+		diag = bin2 - bin1
+
+		# Observed over expected values (optional)
+		if expected_arr is not None:
+			values /= expected_arr[diag]
+
+		# JIT-compiled kernel (optional, see `ipa.kernels`), the sums of the diagonals are not needed
+		if numba_kernels is not None:
+			numba_kernels.accumulate_diagonal_sums(np.zeros(ndiags), profile, bin1, bin2, values, 0)
+			continue
+
+		# Skip pixels of the masked out bins, like `np.nansum` does
+		valid = ~np.isnan(values)
+		bin1, bin2, diag, values = bin1[valid], bin2[valid], diag[valid], values[valid]
+		if len(values) == 0:
+			continue
+
+		# Add every pixel to both of its bins at its diagonal (only the rows spanned by the chunk are counted at once)
+		row_lo, row_hi = bin1.min(), bin2.max() + 1
+		chunk_sums = np.bincount((bin1 - row_lo) * ndiags + diag, weights=values, minlength=(row_hi - row_lo) * ndiags)
+		off_diag = diag > 0
+		chunk_sums += np.bincount((bin2[off_diag] - row_lo) * ndiags + diag[off_diag], weights=values[off_diag], minlength=(row_hi - row_lo) * ndiags)
+		profile[row_lo:row_hi] += chunk_sums.reshape(row_hi - row_lo, ndiags)
+
+	# Cumulative sums in place, in blocks of rows of about `chunksize` values
+	block_rows = max(1, chunksize // ndiags)
+	for row_lo in range(0, hi - lo, block_rows):
+		np.cumsum(profile[row_lo:row_lo + block_rows], axis=1, out=profile[row_lo:row_lo + block_rows])
+
+	return out
+
+def calculate_row_sum(matrix):
+	"""
+	Sum the rows of a matrix ignoring NaN values, like `np.nansum(matrix, axis=1)`, but in place:
+	NaN values of `matrix` are set to 0 instead of copying it. The sums are accumulated in float64
+	(pairwise summation), also for float32 matrices.
+
+	Args:
+		matrix: NumPy 2D array (matrix) to sum, modified in place.
+
+	Returns:
+		A NumPy 1D float64 array with the sum of every row.
+	"""
+	np.copyto(matrix, 0, where=np.isnan(matrix))
+
+	return matrix.sum(axis=1, dtype=np.float64)
+
+def calculate_track_from_profile(profile, min_diag, max_diag):
+	"""
+	Calculate the sum of contacts inside the [`min_diag`, `max_diag`] diagonal band from the cumulative distance profile.
+
+	Args:
+		profile: NumPy 2D array with the cumulative distance profile of every bin, see `calculate_distance_profile`.
+		min_diag: First diagonal of the band.
+		max_diag: Last diagonal of the band. If None, the last diagonal of the profile is used.
+
+	Returns:
+		A NumPy 1D array with the sum of contacts for every bin.
+	"""
+	if max_diag is None or max_diag >= profile.shape[1]:
+		max_diag = profile.shape[1] - 1
+
+	ipa_track = np.array(profile[:, max_diag])
+	if min_diag > 0:
+		ipa_track -= profile[:, min_diag - 1]
+
+	return ipa_track
+
+def calculate_expected(clr, view_df, ignore_diags, clr_weight_name, nproc):
+	"""
+	Calculate the expected values for every diagonal of every chromosome in a single `cooltools.expected_cis` run.
+
+	Args:
+		clr: Cooler object.
 		view_df: ViewFrame with the chromosome sizes.
-		min_diag: Minimum diagonal to consider for the calculation.
+		ignore_diags: Number of first diagonals to ignore in the calculation of expected.
 		clr_weight_name: The name of the column in the .cool file that contains the balancing weights (default: 'weight').
 		nproc: Number of processes to use for the calculation of expected (default: 4).
-	
+
 	Returns:
-		A NumPy 2D array with the observed over expected matrix
+		A DataFrame with the expected values as returned by `cooltools.expected_cis`.
+	"""
+	import cooltools
+
+	return cooltools.expected_cis(clr, view_df=view_df, ignore_diags=ignore_diags, nproc=nproc,
+									chunksize=1_000_000, clr_weight_name=clr_weight_name)
+
+def get_expected_arrays(expected_df, clr_weight_name, min_diag=0):
+	"""
+	Extract the expected values of every chromosome from the expected DataFrame.
+
+	Args:
+		expected_df: DataFrame with the expected values as returned by `cooltools.expected_cis`.
+		clr_weight_name: The name of the column in the .cool file that contains the balancing weights (default: 'weight').
+		min_diag: Number of first diagonals to set to NaN, like `ignore_diags` in `cooltools.expected_cis` does (default: 0).
+
+	Returns:
+		A dictionary with chromosome names as keys and NumPy 1D arrays with the expected value for every diagonal as values.
 	"""
-	# Calculate expected
-	expected_df = cooltools.expected_cis(clr, view_df=view_df[view_df['chrom'] == chrom], 
-											ignore_diags=min_diag, nproc=nproc, chunksize=1_000_000, 
-											clr_weight_name=clr_weight_name)
-	
 	# Extract the expected values from the DataFrame
 	if clr_weight_name is None:
 		expected_colname = "count.avg"
 	else:
 		expected_colname = "balanced.avg"
-	expected_arr = expected_df[expected_colname]
-	del expected_df
 
-	# Obtaining expected matrix
-	expected_matrix = create_expected_matrix(expected_arr)
-	del expected_arr
+	expected_arrs = {}
+	for chrom, chrom_expected_df in expected_df.groupby('region1', sort=False):
+		expected_arr = np.array(chrom_expected_df.sort_values('dist')[expected_colname], dtype=float)
+		expected_arr[:min_diag] = np.nan
+		expected_arrs[chrom] = expected_arr
 
-	# Calculate observed over expected matrix
-	cis_matrix = cis_matrix / expected_matrix
-	del expected_matrix
+	return expected_arrs
+
+def divide_by_expected(matrix, expected_arr, min_diag=0, max_diag=None):
+	"""
+	Divide a square matrix by the expected values in place, diagonal by diagonal, without building the expected matrix.
+	Only the diagonals from `min_diag` to `max_diag` are divided: the other ones are expected to be masked out.
+
+	Args:
+		matrix: C-contiguous NumPy 2D array (matrix) to modify.
+		expected_arr: NumPy 1D array of expected values for every diagonal.
+		min_diag: First diagonal to divide (default: 0).
+		max_diag: Last diagonal to divide. If None, all diagonals starting from `min_diag` are divided (default: None).
+	"""
+	n = matrix.shape[0]
+	last_diag = n - 1 if max_diag is None else min(max_diag, n - 1)
+
+	# Diagonals are strided views of the flattened matrix
+	flat_matrix = matrix.reshape(-1)
+	for k in range(min_diag, last_diag + 1):
+		flat_matrix[k::n + 1][:n - k] /= expected_arr[k]
+		if k > 0:
+			flat_matrix[k * n::n + 1][:n - k] /= expected_arr[k]
+
+def calculate_observed_over_expected_matrix(cis_matrix, expected_arr, min_diag=0, max_diag=None, row_offset=0, col_offset=0):
+	"""
+	Calculate the observed over expected matrix for a given chromosome.
+	
+	Args:
+		cis_matrix: NumPy 2D array with the cis contact matrix with diagonals masked out by `mask_out_diagonals`.
+		expected_arr: NumPy 1D array of expected values for every diagonal of the chromosome.
+		min_diag: First diagonal that was not masked out (default: 0).
+		max_diag: Last diagonal that was not masked out. If None, the matrix was not masked from above (default: None).
+		row_offset: Index of the first row of `cis_matrix` in the chromosome matrix, if `cis_matrix` is a tile of it (default: 0).
+		col_offset: Index of the first column of `cis_matrix` in the chromosome matrix, if `cis_matrix` is a tile of it (default: 0).
+	
+	Returns:
+		A NumPy 2D array with the observed over expected matrix (`cis_matrix` modified in place).
+	"""
+	# JIT-compiled kernel (optional, see `ipa.kernels`)
+	numba_kernels = get_numba_kernels()
+	if numba_kernels is not None:
+		numba_kernels.divide_by_expected(cis_matrix, expected_arr, min_diag, -1 if max_diag is None else max_diag, row_offset, col_offset)
+	elif row_offset == col_offset == 0 and cis_matrix.shape[0] == cis_matrix.shape[1]:
+		divide_by_expected(cis_matrix, expected_arr, min_diag, max_diag)
+	else:
+		# Tiles are divided block by block (masked out elements stay NaN)
+		band = None if max_diag is None else max_diag + 1
+		for rows, cols, offsets in iter_diagonal_offsets(cis_matrix.shape, row_offset, col_offset, band=band):
+			cis_matrix[rows, cols] /= expected_arr[offsets]
 
 	return cis_matrix
 
+def estimate_track_memory(nbins, engine, expected, max_diag, chunksize=10_000_000, dtype=np.float64, nrows=None):
+	"""
+	Estimate the peak memory (in bytes) needed to calculate the IPA track of a chromosome.
+
+	Args:
+		nbins: Number of bins in the chromosome.
+		engine: Engine to calculate the track with ('banded', 'dense' or 'fused').
+		expected: If True, the track is based on the observed over expected matrix.
+		max_diag: Last diagonal of the band. If None, the band is not restricted from above.
+		chunksize: Number of pixels read from the .cool file at once by the 'banded' and 'fused' engines (default: 10_000_000).
+		dtype: Floating point type of the contact values (default: np.float64).
+		nrows: (optional) Number of rows of a tile of the chromosome for the 'dense' engine, see `fetch_cis_tile`. If None, the whole chromosome is calculated at once (default: None).
+
+	Returns:
+		Estimated number of bytes.
+	"""
+	if engine == 'dense':
+		# Dense matrix (or tile), the NaN mask of the row sum (masking, O/E and sum are calculated in place)
+		# and, as an upper bound, the pixels of every element fetched from the .cool file
+		if nrows is None or nrows >= nbins:
+			nrows, ncols = nbins, nbins
+		else:
+			ncols = nbins if max_diag is None else min(nbins, nrows + 2 * max_diag)
+		return nrows * ncols * (np.dtype(dtype).itemsize + 1 + BYTES_PER_PIXEL)
+
+	# Pixel chunk (bin ids, counts, band mask and balanced values) and per-bin arrays
+	band_width = nbins if max_diag is None else min(max_diag + 1, nbins)
+	memory = min(chunksize, nbins * band_width) * BYTES_PER_PIXEL + nbins * 8 * 4
+	if engine == 'fused':
+		# Partial sums of every bin on every diagonal of the band
+		memory += nbins * band_width * 8
+	return memory
+
+def split_row_tiles(nbins, max_diag, max_memory, dtype=np.float64):
+	"""
+	Split the rows of a chromosome into tiles that fit into a memory budget, see `fetch_cis_tile` and `estimate_track_memory`.
+	A tile of `r` rows spans up to `r` + 2 * `max_diag` columns.
+
+	Args:
+		nbins: Number of bins in the chromosome.
+		max_diag: Last diagonal of the band. If None, tiles span all columns.
+		max_memory: Memory budget of a tile in bytes.
+		dtype: Floating point type of the contact values (default: np.float64).
+
+	Returns:
+		A list of tuples (row_lo, row_hi) with the rows of every tile (at least one row per tile).
+	"""
+	bytes_per_element = np.dtype(dtype).itemsize + 1 + BYTES_PER_PIXEL
+	if max_diag is None or 2 * max_diag >= nbins:
+		tile_nrows = max_memory // (nbins * bytes_per_element)
+	else:
+		# Largest r with r * (r + 2 * max_diag) * bytes_per_element <= max_memory
+		tile_nrows = int(np.sqrt(max_diag ** 2 + max_memory / bytes_per_element) - max_diag)
+	tile_nrows = int(min(max(tile_nrows, 1), nbins))
+
+	return [(row_lo, min(row_lo + tile_nrows, nbins)) for row_lo in range(0, nbins, tile_nrows)]
+
+def split_track_tiles(chrom_nbins, engine, expected, max_diag, max_memory=None, dtype=np.float64):
+	"""
+	Split the IPA track calculation into row tiles (chrom, row_lo, row_hi). Every chromosome is a single tile,
+	except the chromosomes whose dense matrices do not fit into `max_memory`, which are split into row tiles by `split_row_tiles`.
+
+	Args:
+		chrom_nbins: Dictionary with chromosome names as keys and number of bins as values.
+		engine: Engine to calculate the track with ('banded', 'dense' or 'fused'). Only the 'dense' engine is tiled: the memory of the 'banded' and 'fused' engines is bounded by their chunk size and band.
+		expected: If True, the track is based on the observed over expected matrix.
+		max_diag: Last diagonal of the band. If None, the band is not restricted from above.
+		max_memory: (optional) Memory budget of a tile in bytes. If None, chromosomes are not split (default: None).
+		dtype: Floating point type of the contact values (default: np.float64).
+
+	Returns:
+		A list of tuples (chrom, row_lo, row_hi), in the order of `chrom_nbins`.
+	"""
+	tiles = []
+	for chrom, nbins in chrom_nbins.items():
+		if engine == 'dense' and max_memory is not None and estimate_track_memory(nbins, engine, expected, max_diag, dtype=dtype) > max_memory:
+			tiles += [(chrom, row_lo, row_hi) for row_lo, row_hi in split_row_tiles(nbins, max_diag, max_memory, dtype)]
+		else:
+			tiles.append((chrom, 0, nbins))
+
+	return tiles
+
+def split_track_shards(tiles, chrom_offsets, nshards, split_tiles=True):
+	"""
+	Split the row tiles of the IPA track calculation into `nshards` shards with about the same number of pixels, e.g. to calculate
+	the track on several machines. Tiles with more pixels than half a shard are split into row segments of at most half a shard
+	(if `split_tiles`); segments are calculated independently, because the 'banded' and 'dense' engines read the contacts
+	of the `max_diag` rows before a segment too. The tiles are assigned largest first to the shard with the fewest pixels,
+	so the split depends only on the .cool file and the parameters and is the same on every machine.
+
+	Args:
+		tiles: List of tuples (chrom, row_lo, row_hi), see `split_track_tiles`.
+		chrom_offsets: Dictionary with chromosome names as keys and NumPy 1D arrays with the offsets of the chromosome rows
+			in the pixel table (the 'bin1_offset' index of the .cool file, number of bins + 1 values) as values.
+		nshards: Number of shards.
+		split_tiles: If True, tiles with more pixels than half a shard are split into row segments (default: True).
+
+	Returns:
+		A list of `nshards` lists of tuples (chrom, row_lo, row_hi), every list in the order of `tiles`.
+	"""
+	get_pixels = lambda chrom, row_lo, row_hi: int(chrom_offsets[chrom][row_hi] - chrom_offsets[chrom][row_lo])
+	shard_pixels = sum(get_pixels(*tile) for tile in tiles) / nshards
+
+	# Split the tiles with more pixels than half a shard into segments with about the same number of pixels
+	# (small segments let the assignment below balance the shards)
+	segments = []
+	for chrom, row_lo, row_hi in tiles:
+		nsegments = int(np.ceil(2 * get_pixels(chrom, row_lo, row_hi) / shard_pixels)) if split_tiles and shard_pixels > 0 else 1
+		if nsegments <= 1:
+			segments.append((chrom, row_lo, row_hi))
+			continue
+		offsets = chrom_offsets[chrom][row_lo:row_hi + 1]
+		cuts = row_lo + np.searchsorted(offsets, offsets[0] + np.arange(1, nsegments) * (offsets[-1] - offsets[0]) / nsegments)
+		bounds = np.unique(np.concatenate([[row_lo], cuts, [row_hi]]))
+		segments += [(chrom, int(segment_lo), int(segment_hi)) for segment_lo, segment_hi in zip(bounds[:-1], bounds[1:])]
+
+	# Largest segment first to the shard with the fewest pixels (ties go to the first shard)
+	shard_loads = np.zeros(nshards)
+	shard_segments = [[] for _ in range(nshards)]
+	for i in sorted(range(len(segments)), key=lambda i: get_pixels(*segments[i]), reverse=True):
+		shard = int(np.argmin(shard_loads))
+		shard_segments[shard].append(i)
+		shard_loads[shard] += get_pixels(*segments[i])
+
+	return [[segments[i] for i in sorted(shard)] for shard in shard_segments]
+
+def split_chrom_jobs(chrom_nbins, nworkers):
+	"""
+	Split chromosomes into jobs for a pool of workers, largest chromosome first.
+	Chromosomes that are small compared to the genome are grouped together, so that assemblies with many small
+	scaffolds do not produce thousands of tiny jobs.
+
+	Args:
+		chrom_nbins: Dictionary with chromosome names as keys and number of bins as values.
+		nworkers: Number of workers.
+
+	Returns:
+		A list of jobs (lists of chromosome names), sorted by the total number of bins in decreasing order.
+	"""
+	min_job_nbins = sum(chrom_nbins.values()) / (4 * nworkers)
+
+	jobs, job, job_nbins = [], [], 0
+	for chrom, nbins in sorted(chrom_nbins.items(), key=lambda item: item[1], reverse=True):
+		job.append(chrom)
+		job_nbins += nbins
+		if job_nbins >= min_job_nbins:
+			jobs.append(job)
+			job, job_nbins = [], 0
+	if job:
+		jobs.append(job)
+
+	return sorted(jobs, key=lambda job: sum(chrom_nbins[chrom] for chrom in job), reverse=True)
+
+def parse_memory(memory):
+	"""
+	Parse a memory size given in bytes or as a string with a unit suffix, e.g. '512M' or '16G'.
+
+	Args:
+		memory: Memory size (int, str or None).
+
+	Returns:
+		Memory size in bytes or None.
+	"""
+	if memory is None or isinstance(memory, (int, float)):
+		return memory
+	units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+	memory = memory.strip().upper().rstrip('B')
+	if memory[-1] in units:
+		return int(float(memory[:-1]) * units[memory[-1]])
+	return int(memory)
+
 def warning_chromnames(chromnames, file_path):
 	"""
 	Check if all chromosome names start with 'chr' and issue a warning if not.
@@ -142,45 +739,286 @@ def warning_chromnames(chromnames, file_path):
 	if not all(str(chrom).startswith('chr') for chrom in chromnames):
 		warnings.warn(f"Some values in the 'chrom' column of {file_path} do not start with 'chr' prefix. Keep in mind that chromosome names in the .cool file and in all the files that will be used in the ipa_plot() function (e.g. TSS-TES sites, ATAC-Seq signal .bw file) should match each other.")
 
-def create_stackup_plot(bw_file, roi_df, flank=100_000, nbins=50):
+def read_bed(bed_file, columns=BED_COLUMNS):
+	"""
+	Read the first columns of a BED file (BED3, BED6, BED12 or other extended BED files) with pandas, without importing bioframe,
+	which pulls in matplotlib. Header lines ('track', 'browser' and '#' comments) and empty lines are skipped, and the optional
+	columns missing from the file are filled with their BED defaults ('.' for the name and the strand, 0 for the score).
+
+	Args:
+		bed_file: Path to the BED file (optionally gzipped).
+		columns: Names of the columns to read, the first three must be 'chrom', 'start' and 'end' (default: BED_COLUMNS).
+
+	Returns:
+		DataFrame with the given columns.
+	"""
+	import gzip
+	import io
+
+	# Skip the header lines
+	with (gzip.open if str(bed_file).endswith('.gz') else open)(bed_file, 'rt') as f:
+		lines = [line for line in f if line.strip() and not line.startswith(('#', 'track', 'browser'))]
+
+	# Only the first columns are parsed, and the missing optional columns are filled with their defaults
+	ncols = min(max((line.count('\t') + 1 for line in lines), default=3), len(columns))
+	bed_df = pd.read_csv(io.StringIO(''.join(lines)), sep='\t', header=None, index_col=False, usecols=range(ncols), names=columns[:ncols],
+						 dtype={'chrom': str, 'name': str, 'strand': str})
+	for column in columns[bed_df.shape[1]:]:
+		bed_df[column] = BED_DEFAULTS.get(column, np.nan)
+
+	return bed_df
+
+def create_stackup_plot(bw_file, roi_df, flank=100_000, nbins=50, cache_dir=None):
 	"""
 	Create a stackup plot for a given region of interest (ROI) using a bigWig file.
+	The bigWig file is opened once, and the left flank, the region and the right flank of every ROI
+	are fetched in a single batched query.
 
 	Args:
 		bw_file: Path to the bigWig file.
 		roi_df: DataFrame with the region of interest (ROI) information. It should contain at least 'chrom', 'start', and 'end'.
 		flank: Size of the flanking regions in bp (default: 100_000).
 		nbins: Number of bins to split the ROI into (default: 50).
+		cache_dir: (optional) Path to the directory to cache the stackup plot in as a .npy file. If the stackup plot for the same
+			bigWig file, ROI, flank and nbins is already cached, it is loaded memory-mapped instead (default: None).
 	
 	Returns:
-		A NumPy 2D array with the stackup plot.
+		A NumPy 2D array with the stackup plot (read-only if loaded from the cache).
 	"""
-	# Fetch the stackup signal for the region of interest and flanking regions
-	stackup_region = bbi.stackup(bw_file, roi_df.chrom, roi_df.start, roi_df.end, bins=nbins)
-	stackup_left_flank = bbi.stackup(bw_file, roi_df.chrom, roi_df.start - flank, roi_df.start, bins=nbins)
-	stackup_right_flank = bbi.stackup(bw_file, roi_df.chrom, roi_df.end, roi_df.end + flank, bins=nbins)
+	# Load the stackup plot from the cache (optional)
+	if cache_dir is not None:
+		cache_path = stackup_cache_path(cache_dir, bw_file, roi_df, flank, nbins)
+		if os.path.isfile(cache_path):
+			return np.load(cache_path, mmap_mode='r')
 
-	# Flip the stackup signal if the strand is negative
-	if 'strand' in roi_df.columns:
-		stackup_region = np.asarray(list(map(lambda stackup, strand: stackup[::-1] if strand is '-' else stackup, stackup_region, roi_df['strand'])))
-		stackup_left_flank_flipped = []
-		stackup_right_flank_flipped = []
-		for i, (s_left, s_right) in enumerate(zip(stackup_left_flank, stackup_right_flank)):
-			if roi_df['strand'].iloc[i] == '-':
-				stackup_left_flank_flipped.append(s_right[::-1].tolist())
-				stackup_right_flank_flipped.append(s_left[::-1].tolist())
-			else:
-				stackup_left_flank_flipped.append(s_left.tolist())
-				stackup_right_flank_flipped.append(s_right.tolist())
-		
-		stackup_left_flank = np.asarray(stackup_left_flank_flipped)
-		stackup_right_flank = np.asarray(stackup_right_flank_flipped)
+	chroms = roi_df['chrom'].to_numpy()
+	starts = roi_df['start'].to_numpy()
+	ends = roi_df['end'].to_numpy()
+
+	# Fetch the stackup signal for the left flanking regions, regions of interest and right flanking regions at once
+	import bbi
+	with bbi.open(bw_file) as f:
+		stackup = f.stackup(np.concatenate([chroms, chroms, chroms]),
+							np.concatenate([starts - flank, starts, ends]),
+							np.concatenate([starts, ends, ends + flank]),
+							bins=nbins)
+
+	stackup_concat = concat_stackup(stackup, roi_df, nbins)
 
-	# Concatenate the stackup signals for the left flank, region of interest, and right flank
-	stackup_concat = np.hstack((stackup_left_flank, stackup_region, stackup_right_flank))
+	# Save the stackup plot to the cache under a temporary name first, so that an interrupted run does not leave a broken cache
+	if cache_dir is not None:
+		with open(cache_path + '.tmp', 'wb') as f:
+			np.save(f, stackup_concat)
+		os.replace(cache_path + '.tmp', cache_path)
 
 	return stackup_concat
 
+def concat_stackup(stackup, roi_df, nbins):
+	"""
+	Concatenate the stackup signals for the left flank, region of interest, and right flank of every ROI.
+
+	Args:
+		stackup: NumPy 2D array of shape (3 * number of ROIs, `nbins`) with the left flanks, the regions and the right flanks.
+		roi_df: DataFrame with the region of interest (ROI) information.
+		nbins: Number of bins of every part.
+
+	Returns:
+		A NumPy 2D array of shape (number of ROIs, 3 * `nbins`).
+	"""
+	stackup_concat = stackup.reshape(3, len(roi_df), nbins).transpose(1, 0, 2).reshape(len(roi_df), 3 * nbins)
+
+	# Flip the stackup signal if the strand is negative (the flanks are swapped and reversed)
+	if 'strand' in roi_df.columns:
+		flip_stackup(stackup_concat, roi_df['strand'].to_numpy() == '-')
+
+	return stackup_concat
+
+def get_roi_windows(roi_df, flank, binsize, chrom_nbins):
+	"""
+	Get the bins that a stackup plot of the regions of interest (ROI) reads: the ROI extended by `flank` on both sides,
+	merged into non-overlapping windows.
+
+	Args:
+		roi_df: DataFrame with the region of interest (ROI) information. It should contain at least 'chrom', 'start', and 'end'.
+		flank: Size of the flanking regions in bp.
+		binsize: Bin size of the track in bp.
+		chrom_nbins: Dictionary with chromosome names as keys and number of bins as values.
+
+	Returns:
+		A list of tuples (chrom, bin_lo, bin_hi) with the windows, sorted by chromosome (in the order of `chrom_nbins`) and position.
+	"""
+	missing_chroms = set(roi_df['chrom']) - set(chrom_nbins)
+	assert not missing_chroms, f"Chromosomes {', '.join(map(str, sorted(missing_chroms)))} of the ROI are not in the .cool file"
+
+	windows = []
+	for chrom, nbins in chrom_nbins.items():
+		chrom_roi_df = roi_df[roi_df['chrom'] == chrom]
+		if chrom_roi_df.empty:
+			continue
+
+		# Flank-extended ROI in bins, sorted by start
+		bin_los = np.clip((chrom_roi_df['start'].to_numpy() - flank) // binsize, 0, nbins)
+		bin_his = np.clip(-(-(chrom_roi_df['end'].to_numpy() + flank) // binsize), 0, nbins)
+		order = np.argsort(bin_los, kind='stable')
+
+		# Merge overlapping and adjacent windows
+		for bin_lo, bin_hi in zip(bin_los[order], bin_his[order]):
+			if windows and windows[-1][0] == chrom and bin_lo <= windows[-1][2]:
+				windows[-1] = (chrom, windows[-1][1], max(windows[-1][2], int(bin_hi)))
+			elif bin_hi > bin_lo:
+				windows.append((chrom, int(bin_lo), int(bin_hi)))
+
+	return windows
+
+def read_bigwig_intervals(bw_file):
+	"""
+	Read all intervals of a bigWig file into memory, e.g. to stack up many random sets of regions with `stackup_intervals`.
+
+	Args:
+		bw_file: Path to the bigWig file.
+
+	Returns:
+		A tuple (intervals, chromsizes): a dictionary with chromosome names as keys and tuples of NumPy 1D arrays (starts, ends, values)
+		of the sorted intervals as values, and a pandas Series with the chromosome sizes in bp.
+	"""
+	import bbi
+	with bbi.open(bw_file) as f:
+		chromsizes = pd.Series(f.chromsizes)
+		intervals = {}
+		for chrom in chromsizes.index:
+			chrom_df = f.fetch_intervals(chrom, 0, -1, iterator=False)
+			intervals[chrom] = (chrom_df['start'].to_numpy(dtype=np.int64), chrom_df['end'].to_numpy(dtype=np.int64), chrom_df['value'].to_numpy(dtype=np.float64))
+
+	return intervals, chromsizes
+
+def tracks_to_intervals(tracks, binsize, chromsizes):
+	"""
+	Convert binned tracks to intervals (see `read_bigwig_intervals`), leaving out the bins without a value (NaN) like a bigWig file of the tracks.
+
+	Args:
+		tracks: Dictionary with chromosome names as keys and NumPy 1D arrays with one value per bin (NaN if there is no value) as values.
+		binsize: Bin size of the tracks in bp.
+		chromsizes: pandas Series with the chromosome sizes in bp.
+
+	Returns:
+		A dictionary with chromosome names as keys and tuples of NumPy 1D arrays (starts, ends, values) as values.
+	"""
+	intervals = {}
+	for chrom, track in tracks.items():
+		valid = np.flatnonzero(~np.isnan(track))
+		starts = valid.astype(np.int64) * binsize
+		intervals[chrom] = (starts, np.minimum(starts + binsize, int(chromsizes[chrom])), track[valid].astype(np.float64))
+
+	return intervals
+
+def stackup_intervals(intervals, chromsizes, chroms, starts, ends, nbins, missing=0.0, oob=np.nan):
+	"""
+	Summarize intervals kept in memory over many query intervals, like `bbi.BBIFile.stackup(..., bins=nbins, exact=True)` does for a bigWig file:
+	every query interval is split into `nbins` parts, and the value of a part is the mean of the values weighted by the base pairs they cover.
+	All query intervals are summarized at once from the cumulative sums of the values over base pairs.
+
+	Args:
+		intervals: Dictionary with chromosome names as keys and tuples of NumPy 1D arrays (starts, ends, values) of sorted,
+			non-overlapping intervals as values (see `read_bigwig_intervals`).
+		chromsizes: pandas Series with the chromosome sizes in bp.
+		chroms, starts, ends: Array-likes with the query intervals.
+		nbins: Number of parts of every query interval.
+		missing: Value of the parts without any value (default: 0.0).
+		oob: Value of the parts that lie (partly) out of the chromosome (default: np.nan).
+
+	Returns:
+		A NumPy 2D array of shape (number of query intervals, `nbins`).
+	"""
+	# Intervals of all chromosomes in genome-wide coordinates, with an empty interval after the last one
+	chromsizes = pd.Series(chromsizes).astype(np.int64)
+	chrom_offsets = pd.Series(np.concatenate([[0], np.cumsum(chromsizes.to_numpy())[:-1]]), index=chromsizes.index)
+	chromnames = [chrom for chrom in chromsizes.index if chrom in intervals]
+	interval_starts = np.concatenate([intervals[chrom][0] + chrom_offsets[chrom] for chrom in chromnames] + [[np.iinfo(np.int64).max]])
+	interval_ends = np.concatenate([intervals[chrom][1] + chrom_offsets[chrom] for chrom in chromnames] + [[np.iinfo(np.int64).max]])
+	values = np.concatenate([intervals[chrom][2] for chrom in chromnames] + [[0.]])
+
+	# Cumulative sums over base pairs of the values and of the base pairs with a value, at the interval ends
+	lengths = interval_ends[:-1] - interval_starts[:-1]
+	value_cumsum = np.concatenate([[0.], np.cumsum(values[:-1] * lengths)])
+	coverage_cumsum = np.concatenate([[0], np.cumsum(lengths)])
+
+	# Boundaries of the parts of every query interval (one row per query interval)
+	starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+	edges = starts[:, None] + np.arange(nbins + 1) * (ends - starts)[:, None] // nbins
+	chrom_ends = pd.Series(chroms).map(chromsizes).to_numpy(dtype=np.int64)[:, None]
+	positions = np.clip(edges, 0, chrom_ends) + pd.Series(chroms).map(chrom_offsets).to_numpy(dtype=np.int64)[:, None]
+
+	# Cumulative sums at the boundaries: the intervals that end before a boundary and the covered part of the next one
+	next_interval = np.searchsorted(interval_ends, positions, side='right')
+	covered = np.clip(positions - interval_starts[next_interval], 0, None)
+	value_sums = np.diff(value_cumsum[next_interval] + values[next_interval] * covered, axis=1)
+	coverages = np.diff(coverage_cumsum[next_interval] + covered, axis=1)
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		stackup = np.where(coverages > 0, value_sums / coverages, missing)
+	stackup[(edges[:, :-1] < 0) | (edges[:, 1:] > chrom_ends)] = oob
+
+	return stackup
+
+def create_stackup_plot_from_intervals(intervals, chromsizes, roi_df, flank=100_000, nbins=50):
+	"""
+	Create a stackup plot for a given region of interest (ROI) from intervals kept in memory (see `read_bigwig_intervals`).
+	The result is the same as `create_stackup_plot` for a bigWig file of the intervals.
+
+	Args:
+		intervals: Dictionary with chromosome names as keys and tuples of NumPy 1D arrays (starts, ends, values) as values.
+		chromsizes: pandas Series with the chromosome sizes in bp.
+		roi_df: DataFrame with the region of interest (ROI) information. It should contain at least 'chrom', 'start', and 'end'.
+		flank: Size of the flanking regions in bp (default: 100_000).
+		nbins: Number of bins to split the ROI into (default: 50).
+
+	Returns:
+		A NumPy 2D array with the stackup plot.
+	"""
+	chroms = roi_df['chrom'].to_numpy()
+	starts = roi_df['start'].to_numpy()
+	ends = roi_df['end'].to_numpy()
+
+	# Summarize the left flanking regions, regions of interest and right flanking regions at once
+	stackup = stackup_intervals(intervals, chromsizes, np.concatenate([chroms, chroms, chroms]),
+								np.concatenate([starts - flank, starts, ends]), np.concatenate([starts, ends, ends + flank]), nbins)
+
+	return concat_stackup(stackup, roi_df, nbins)
+
+def create_stackup_plot_from_tracks(tracks, binsize, chromsizes, roi_df, flank=100_000, nbins=50):
+	"""
+	Create a stackup plot for a given region of interest (ROI) from binned tracks kept in memory, e.g. the IPA track
+	calculated for the bins around the ROI only. The result is the same as `create_stackup_plot` for a bigWig file of the tracks.
+
+	Args:
+		tracks: Dictionary with chromosome names as keys and NumPy 1D arrays with one value per bin (NaN if there is no value) as values.
+		binsize: Bin size of the tracks in bp.
+		chromsizes: pandas Series with the chromosome sizes in bp.
+		roi_df: DataFrame with the region of interest (ROI) information. It should contain at least 'chrom', 'start', and 'end'.
+		flank: Size of the flanking regions in bp (default: 100_000).
+		nbins: Number of bins to split the ROI into (default: 50).
+
+	Returns:
+		A NumPy 2D array with the stackup plot.
+	"""
+	return create_stackup_plot_from_intervals(tracks_to_intervals(tracks, binsize, chromsizes), chromsizes, roi_df, flank, nbins)
+
+def flip_stackup(stackup, flip):
+	"""
+	Reverse rows of a stackup matrix in place.
+
+	Args:
+		stackup: NumPy 2D array with the stackup plot.
+		flip: NumPy 1D boolean array, True for the rows to reverse (e.g. regions on the negative strand).
+	"""
+	# JIT-compiled kernel (optional, see `ipa.kernels`)
+	numba_kernels = get_numba_kernels()
+	if numba_kernels is not None:
+		numba_kernels.flip_rows(stackup, np.asarray(flip, dtype=bool))
+		return
+
+	stackup[flip] = stackup[flip, ::-1]
+
 def filter_regions(roi_df, min_roi_size=None, max_roi_size=None):
 	"""
 	Filter regions of interest in the roi file based on their size.
@@ -200,3 +1038,225 @@ def filter_regions(roi_df, min_roi_size=None, max_roi_size=None):
 	roi_df.reset_index(drop=True, inplace=True)
 
 	return roi_df
+
+def bootstrap_profile(stackup, n_boot=1000, ci=0.95, seed=None, batch_size=100):
+	"""
+	Bootstrap confidence interval of the mean profile of a stackup plot, resampling the rows (regions of interest) with replacement.
+	Every resample is drawn as a row of counts of the rows, so that a batch of resampled mean profiles is
+	a single matrix product with the stackup plot. NaN values are left out of the means, like in `np.nanmean`.
+
+	Args:
+		stackup: NumPy 2D array with the stackup plot.
+		n_boot: Number of bootstrap resamples (default: 1000).
+		ci: Confidence level of the interval (default: 0.95).
+		seed: (optional) Seed of the random number generator (default: None).
+		batch_size: Number of resamples per matrix product (default: 100).
+
+	Returns:
+		A tuple of NumPy 1D arrays with the lower and upper bounds of the confidence interval of every bin.
+	"""
+	rng = np.random.default_rng(seed)
+	valid = ~np.isnan(stackup)
+	values = np.where(valid, stackup, 0.)
+	valid = valid.astype(np.float64)
+	nrows = len(stackup)
+
+	boot_profiles = np.empty((n_boot, stackup.shape[1]))
+	for lo in range(0, n_boot, batch_size):
+		# Number of times every row is drawn in every resample of the batch
+		nresamples = min(batch_size, n_boot - lo)
+		draws = rng.integers(0, nrows, size=(nresamples, nrows)) + np.arange(nresamples)[:, None] * nrows
+		counts = np.bincount(draws.ravel(), minlength=nresamples * nrows).reshape(nresamples, nrows).astype(np.float64)
+		with np.errstate(divide='ignore', invalid='ignore'):
+			boot_profiles[lo:lo + len(counts)] = (counts @ values) / (counts @ valid)
+
+	# Percentile interval (bins without values get NaN bounds)
+	alpha = (1 - ci) / 2
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', category=RuntimeWarning)
+		ci_low, ci_high = np.nanquantile(boot_profiles, [alpha, 1 - alpha], axis=0)
+
+	return ci_low, ci_high
+
+def shift_regions(roi_df, chromsizes, flank, nsets, gaps_df=None, seed=None, max_tries=100):
+	"""
+	Draw random sets of regions with the chromosomes, sizes and strands of the regions of interest, e.g. for an empirical null of the IPA profile.
+	Every region is moved to a uniformly drawn position on its own chromosome, such that the region with its flanks
+	is inside the chromosome and does not overlap any gap. Positions that overlap a gap are drawn again, all at once.
+
+	Args:
+		roi_df: DataFrame with the region of interest (ROI) information. It should contain at least 'chrom', 'start', and 'end'.
+		chromsizes: pandas Series with the chromosome sizes in bp. Regions on other chromosomes are not moved.
+		flank: Size of the flanking regions in bp.
+		nsets: Number of random sets of regions.
+		gaps_df: (optional) DataFrame with the 'chrom', 'start' and 'end' of the gaps, e.g. assembly gaps or blacklisted regions (default: None).
+		seed: (optional) Seed of the random number generator or a NumPy random generator (default: None).
+		max_tries: Maximum number of draws of a region that overlaps gaps. A region that still overlaps a gap is not moved (default: 100).
+
+	Returns:
+		DataFrame with the columns of `roi_df` and `nsets` * len(roi_df) rows: the random sets one after another.
+	"""
+	rng = np.random.default_rng(seed)
+	shifted_df = pd.concat([roi_df] * nsets, ignore_index=True)
+	starts = shifted_df['start'].to_numpy(dtype=np.int64)
+	sizes = shifted_df['end'].to_numpy(dtype=np.int64) - starts
+	chromsizes = pd.Series(chromsizes).astype(np.int64)
+	chrom_ends = shifted_df['chrom'].map(chromsizes).to_numpy()
+	known = ~np.isnan(chrom_ends)
+	chrom_ends = np.where(known, chrom_ends, 0).astype(np.int64)
+
+	# Range of the start positions: the flanks inside the chromosome (or at least the region, on chromosomes that are too short)
+	lo = np.full(len(starts), flank, dtype=np.int64)
+	hi = chrom_ends - sizes - flank
+	too_short = hi < lo
+	lo[too_short], hi[too_short] = 0, np.maximum(chrom_ends - sizes, 0)[too_short]
+	lo[~known], hi[~known] = starts[~known], starts[~known]
+
+	# Gaps in genome-wide coordinates, sorted by start (with running maximum of the ends, so that the ends are sorted too)
+	chrom_offsets = pd.Series(np.concatenate([[0], np.cumsum(chromsizes.to_numpy())[:-1]]), index=chromsizes.index)
+	offsets = shifted_df['chrom'].map(chrom_offsets).fillna(0).to_numpy(dtype=np.int64)
+	if gaps_df is not None:
+		gaps_df = gaps_df[gaps_df['chrom'].isin(chromsizes.index)]
+		gap_starts = gaps_df['start'].to_numpy(dtype=np.int64) + gaps_df['chrom'].map(chrom_offsets).to_numpy(dtype=np.int64)
+		gap_ends = gaps_df['end'].to_numpy(dtype=np.int64) + gaps_df['chrom'].map(chrom_offsets).to_numpy(dtype=np.int64)
+		order = np.argsort(gap_starts)
+		gap_starts, gap_ends = gap_starts[order], np.maximum.accumulate(gap_ends[order])
+
+	# Draw the positions, then draw again the ones that overlap a gap
+	new_starts = np.empty(len(starts), dtype=np.int64)
+	redraw = np.arange(len(starts))
+	for _ in range(max_tries):
+		new_starts[redraw] = rng.integers(lo[redraw], hi[redraw], endpoint=True)
+		if gaps_df is None or not len(gap_starts):
+			break
+		# A window overlaps a gap if the first gap that ends after the window start begins before the window end
+		window_starts = offsets[redraw] + new_starts[redraw] - flank
+		window_ends = offsets[redraw] + new_starts[redraw] + sizes[redraw] + flank
+		first_gap = np.searchsorted(gap_ends, window_starts, side='right')
+		overlap = first_gap < len(gap_starts)
+		overlap[overlap] = gap_starts[first_gap[overlap]] < window_ends[overlap]
+		redraw = redraw[overlap & known[redraw]]
+		if not len(redraw):
+			break
+	else:
+		new_starts[redraw] = starts[redraw]
+		warnings.warn(f"{len(redraw)} shifted regions overlap gaps after {max_tries} draws and are kept at their positions.")
+
+	shifted_df['start'] = new_starts
+	shifted_df['end'] = new_starts + sizes
+
+	return shifted_df
+
+def calculate_null_profiles(stackup_fn, roi_df, chromsizes, flank, nbins, n_perm=1000, gaps_df=None, seed=None, max_values=5_000_000):
+	"""
+	Empirical null of the mean profile of a stackup plot: the mean profiles of `n_perm` random sets of shifted regions of interest
+	(see `shift_regions`). The random sets are stacked up in batches, with one call of `stackup_fn` per batch.
+
+	Args:
+		stackup_fn: Function that creates the stackup plot (NumPy 2D array of shape (len(ROI DataFrame), 3 * `nbins`)) of a ROI DataFrame,
+			e.g. `create_stackup_plot` of a bigWig file without the cache.
+		roi_df: DataFrame with the region of interest (ROI) information. It should contain at least 'chrom', 'start', and 'end'.
+		chromsizes: pandas Series with the chromosome sizes in bp.
+		flank: Size of the flanking regions in bp.
+		nbins: Number of bins to split the ROI into.
+		n_perm: Number of random sets of regions (default: 1000).
+		gaps_df: (optional) DataFrame with the 'chrom', 'start' and 'end' of the gaps to avoid (default: None).
+		seed: (optional) Seed of the random number generator (default: None).
+		max_values: Maximum number of stackup values of a batch (default: 5_000_000, i.e. 40 MB).
+
+	Returns:
+		A NumPy 2D array of shape (`n_perm`, 3 * `nbins`) with the mean profile of every random set.
+	"""
+	rng = np.random.default_rng(seed)
+	batch_size = max(1, max_values // max(1, len(roi_df) * 3 * nbins))
+
+	null_profiles = []
+	for lo in range(0, n_perm, batch_size):
+		nsets = min(batch_size, n_perm - lo)
+		stackup = stackup_fn(shift_regions(roi_df, chromsizes, flank, nsets, gaps_df, rng))
+		with warnings.catch_warnings():
+			warnings.simplefilter('ignore', category=RuntimeWarning)
+			null_profiles.append(np.nanmean(np.reshape(stackup, (nsets, len(roi_df), -1)), axis=1))
+
+	return np.concatenate(null_profiles)
+
+def calculate_profile_statistics(stackup, n_boot=0, ci=0.95, null_profiles=None, seed=None):
+	"""
+	Significance statistics of the mean profile of a stackup plot: the bootstrap confidence interval (see `bootstrap_profile`)
+	and the band of the empirical null profiles (see `calculate_null_profiles`) with the two-sided empirical p-value of every bin.
+
+	Args:
+		stackup: NumPy 2D array with the stackup plot.
+		n_boot: Number of bootstrap resamples, no confidence interval if 0 (default: 0).
+		ci: Confidence level of the bootstrap interval and of the null band (default: 0.95).
+		null_profiles: (optional) NumPy 2D array with the null mean profiles (default: None).
+		seed: (optional) Seed of the random number generator (default: None).
+
+	Returns:
+		A dictionary of NumPy 1D arrays: 'ci_low' and 'ci_high' with `n_boot`, and 'null_mean', 'null_low', 'null_high' and 'p_value' with `null_profiles`.
+	"""
+	statistics = {}
+	if n_boot:
+		statistics['ci_low'], statistics['ci_high'] = bootstrap_profile(stackup, n_boot, ci, seed)
+
+	if null_profiles is not None:
+		alpha = (1 - ci) / 2
+		with warnings.catch_warnings():
+			warnings.simplefilter('ignore', category=RuntimeWarning)
+			profile = np.nanmean(stackup, axis=0)
+			null_mean = np.nanmean(null_profiles, axis=0)
+			statistics['null_mean'] = null_mean
+			statistics['null_low'], statistics['null_high'] = np.nanquantile(null_profiles, [alpha, 1 - alpha], axis=0)
+		# Share of the null profiles at least as far from the null mean as the profile (with the profile itself counted as one of them)
+		n_extreme = np.sum(np.abs(null_profiles - null_mean) >= np.abs(profile - null_mean), axis=0)
+		statistics['p_value'] = (n_extreme + 1) / (np.sum(~np.isnan(null_profiles), axis=0) + 1)
+
+	return statistics
+
+def create_profile_table(stackups, roi_name, flank=100_000, statistics=None):
+	"""
+	Aggregate stackup plots into a long-format profile table: mean, median, standard error of the mean
+	and number of values of every bin of every stackup plot.
+
+	Args:
+		stackups: Dictionary {bigWig name: NumPy 2D array with the stackup plot}.
+		roi_name: Name of the set of regions of interest, e.g. the basename of the roi file.
+		flank: Size of the flanking regions in bp (default: 100_000).
+		statistics: (optional) Dictionary {bigWig name: dictionary of per-bin statistics from `calculate_profile_statistics`},
+			added as extra columns (default: None).
+
+	Returns:
+		DataFrame with the columns 'bigwig', 'roi', 'bin', 'flank', 'mean', 'median', 'sem' and 'n', and the columns of the statistics.
+	"""
+	profiles = []
+	for bw_name, stackup in stackups.items():
+		# Bins without values (all NaN) get NaN statistics
+		with warnings.catch_warnings():
+			warnings.simplefilter('ignore', category=RuntimeWarning)
+			n = np.sum(~np.isnan(stackup), axis=0)
+			profiles.append(pd.DataFrame({
+				'bigwig': bw_name,
+				'roi': roi_name,
+				'bin': np.arange(stackup.shape[1]),
+				'flank': flank,
+				'mean': np.nanmean(stackup, axis=0),
+				'median': np.nanmedian(stackup, axis=0),
+				'sem': np.nanstd(stackup, axis=0, ddof=1) / np.sqrt(n),
+				'n': n,
+				**(statistics or {}).get(bw_name, {}),
+			}))
+
+	return pd.concat(profiles, ignore_index=True)
+
+def write_profile_table(profiles_df, path):
+	"""
+	Write a profile table to a .tsv or .parquet file (chosen by the file extension).
+
+	Args:
+		profiles_df: DataFrame with the profile table (see `create_profile_table`).
+		path: Path to the output file.
+	"""
+	if path.endswith('.parquet'):
+		profiles_df.to_parquet(path, index=False)
+	else:
+		profiles_df.to_csv(path, sep='\t', index=False)
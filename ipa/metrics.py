@@ -0,0 +1,177 @@
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+
+# Metrics recorded by the current process, or None if metrics are not recorded. Worker processes record their own
+# metrics (see `start_metrics` and `stop_metrics`) and send them back with their results to be added with `add_records`
+_METRICS = None
+
+def start_metrics():
+    """
+    Start recording stage-level metrics in the current process, dropping the records of a previous recording.
+    """
+    global _METRICS
+    _METRICS = {'records': []}
+
+def stop_metrics():
+    """
+    Stop recording metrics in the current process.
+
+    Returns:
+        The list of the recorded stages (see `record_stage`), or None if metrics were not recorded.
+    """
+    global _METRICS
+    metrics, _METRICS = _METRICS, None
+    return metrics['records'] if metrics is not None else None
+
+def metrics_enabled():
+    """
+    Check if metrics are recorded in the current process.
+    """
+    return _METRICS is not None
+
+def add_records(records):
+    """
+    Add the stages recorded by a worker process (see `stop_metrics`) to the metrics of the current process.
+    """
+    if _METRICS is not None and records:
+        _METRICS['records'].extend(records)
+
+def get_peak_rss():
+    """
+    Get the peak resident set size (in bytes) of the current process and of the largest of its terminated child processes.
+    """
+    import resource
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+
+@contextmanager
+def record_stage(stage, **fields):
+    """
+    Record the wall time and the peak RSS (after the stage) of a stage of the calculation, e.g. the IPA track of a row tile of a chromosome.
+    Nothing is recorded if metrics are not enabled in the current process (see `start_metrics`).
+
+    Args:
+        stage: Name of the stage.
+        **fields: Fields of the record, e.g. 'sample' (the input file), 'chrom' and the counters 'pixels_read', 'bins' and 'bytes_written'.
+
+    Yields:
+        The dictionary of the record, so that counters known only at the end of the stage can be added to it.
+    """
+    if _METRICS is None:
+        yield {}
+        return
+
+    record = {'stage': stage, **fields}
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        record['peak_rss'] = get_peak_rss()[0]
+        record['pid'] = os.getpid()
+        _METRICS['records'].append(record)
+
+def summarize_metrics(records):
+    """
+    Sum up the recorded stages per stage and per sample and chromosome.
+
+    Args:
+        records: List of the recorded stages (see `record_stage`).
+
+    Returns:
+        A tuple of two dictionaries: the totals of every stage ('calls', 'seconds', 'pixels_read', 'bins', 'bytes_written', 'peak_rss'
+        and the throughput 'pixels_per_second' and 'bins_per_second'), and the totals of every stage per sample and chromosome
+        ({sample: {chrom: {stage: totals}}}, for the stages that are recorded per chromosome).
+    """
+    def add(totals, record):
+        totals['calls'] = totals.get('calls', 0) + 1
+        for counter in ('seconds', 'pixels_read', 'bins', 'bytes_written'):
+            totals[counter] = totals.get(counter, 0) + record.get(counter, 0)
+        totals['peak_rss'] = max(totals.get('peak_rss', 0), record['peak_rss'])
+
+    stages, chroms = {}, {}
+    for record in records:
+        add(stages.setdefault(record['stage'], {}), record)
+        if record.get('chrom') is not None:
+            add(chroms.setdefault(str(record.get('sample')), {}).setdefault(record['chrom'], {}).setdefault(record['stage'], {}), record)
+
+    # Throughput of the stages that count pixels or bins (per second of the stage, summed over the processes that ran it)
+    for totals in list(stages.values()) + [totals for sample in chroms.values() for chrom in sample.values() for totals in chrom.values()]:
+        for counter, throughput in (('pixels_read', 'pixels_per_second'), ('bins', 'bins_per_second')):
+            if totals[counter] and totals['seconds'] > 0:
+                totals[throughput] = totals[counter] / totals['seconds']
+
+    return stages, chroms
+
+def write_metrics(path, records, run_info=None, wall_seconds=None):
+    """
+    Write the recorded metrics of a run to a JSON file with the run information, the wall time and peak RSS of the run,
+    the totals of every stage and of every chromosome (see `summarize_metrics`) and all records.
+    """
+    stages, chroms = summarize_metrics(records)
+    peak_rss, peak_worker_rss = get_peak_rss()
+    metrics = {'run': run_info or {}, 'wall_seconds': wall_seconds, 'peak_rss': peak_rss, 'peak_worker_rss': peak_worker_rss,
+               'stages': stages, 'chroms': chroms, 'records': records}
+
+    # Write the file under a temporary name first, so that an interrupted run does not leave a broken file
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(metrics, f, indent=2, default=str)
+    os.replace(path + '.tmp', path)
+
+@contextmanager
+def profile_run(path):
+    """
+    Profile the current process (worker processes are not profiled) and save the profile to `path`: an HTML report of pyinstrument
+    if `path` ends with '.html' (pyinstrument must be installed), otherwise cProfile statistics that can be read with `pstats` or snakeviz.
+    """
+    if path.endswith('.html'):
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise ImportError("pyinstrument is required for an HTML profile. Install pyinstrument or save cProfile statistics (e.g. a .prof file) instead.")
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(path, 'w') as f:
+                f.write(profiler.output_html())
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+
+@contextmanager
+def instrument_run(metrics_path=None, profile_path=None, run_info=None):
+    """
+    Record the metrics of a run and write them to `metrics_path` (see `write_metrics`), and profile it to `profile_path` (see `profile_run`).
+    The metrics are written even if the run fails, with its status in the run information. Does nothing if both paths are None.
+    """
+    if metrics_path is not None:
+        start_metrics()
+    start = time.perf_counter()
+    status = 'failed'
+    try:
+        if profile_path is not None:
+            with profile_run(profile_path):
+                yield
+        else:
+            yield
+        status = 'done'
+    finally:
+        if metrics_path is not None:
+            write_metrics(metrics_path, stop_metrics(), {**(run_info or {}), 'status': status}, time.perf_counter() - start)
@@ -0,0 +1,78 @@
+import numba
+import numpy as np
+
+
+# Kernels of the 'numba' backend, see `ipa.kernels`. They are compiled on their first call (and cached next to this file),
+# release the GIL and loop over the pixels or matrix elements once without temporary arrays. Floating point errors follow
+# the NumPy semantics (e.g. a division by zero gives inf instead of raising), like the 'numpy' backend
+
+@numba.njit(nogil=True, cache=True, error_model='numpy')
+def accumulate_band_sums(ipa_track, bin1, bin2, values, row_lo, expected_arr):
+    nrows = ipa_track.shape[0]
+    divide = expected_arr.shape[0] > 0
+    for i in range(values.shape[0]):
+        value = np.float64(values[i])
+        if divide:
+            value /= expected_arr[bin2[i] - bin1[i]]
+        if np.isnan(value):
+            continue
+        row = bin1[i] - row_lo
+        if 0 <= row < nrows:
+            ipa_track[row] += value
+        row = bin2[i] - row_lo
+        if bin1[i] != bin2[i] and 0 <= row < nrows:
+            ipa_track[row] += value
+
+@numba.njit(nogil=True, cache=True, error_model='numpy')
+def accumulate_diagonal_sums(diag_sums, partial_sums, bin1, bin2, values, min_diag):
+    for i in range(values.shape[0]):
+        value = np.float64(values[i])
+        if np.isnan(value):
+            continue
+        diag = bin2[i] - bin1[i] - min_diag
+        diag_sums[diag] += value
+        partial_sums[bin1[i], diag] += value
+        if bin1[i] != bin2[i]:
+            partial_sums[bin2[i], diag] += value
+
+@numba.njit(nogil=True, cache=True, error_model='numpy')
+def mask_out_diagonals(matrix, min_diag, max_diag, row_offset, col_offset):
+    nrows, ncols = matrix.shape
+    for i in range(nrows):
+        row = row_offset + i - col_offset
+        # Columns of the diagonals lower than `min_diag`, then the columns of the diagonals higher than `max_diag` (-1 for no limit) on both sides
+        for j in range(max(0, row - min_diag + 1), min(ncols, row + min_diag)):
+            matrix[i, j] = np.nan
+        if max_diag >= 0:
+            for j in range(0, min(ncols, max(0, row - max_diag))):
+                matrix[i, j] = np.nan
+            for j in range(max(0, row + max_diag + 1), ncols):
+                matrix[i, j] = np.nan
+
+@numba.njit(nogil=True, cache=True, error_model='numpy')
+def fill_expected_matrix(matrix, expected_arr):
+    n = matrix.shape[0]
+    for i in range(n):
+        for j in range(n):
+            matrix[i, j] = expected_arr[abs(j - i)]
+
+@numba.njit(nogil=True, cache=True, error_model='numpy')
+def divide_by_expected(matrix, expected_arr, min_diag, max_diag, row_offset, col_offset):
+    nrows, ncols = matrix.shape
+    for i in range(nrows):
+        row = row_offset + i - col_offset
+        # Columns of the [`min_diag`, `max_diag`] band (-1 for no limit) on the left and on the right of the main diagonal
+        col_lo = 0 if max_diag < 0 else max(0, row - max_diag)
+        col_hi = ncols if max_diag < 0 else min(ncols, row + max_diag + 1)
+        for j in range(col_lo, min(col_hi, max(0, row - min_diag + 1))):
+            matrix[i, j] /= expected_arr[row - j]
+        for j in range(max(col_lo, row + max(min_diag, 1)), col_hi):
+            matrix[i, j] /= expected_arr[j - row]
+
+@numba.njit(nogil=True, cache=True, error_model='numpy')
+def flip_rows(stackup, flip):
+    ncols = stackup.shape[1]
+    for i in range(stackup.shape[0]):
+        if flip[i]:
+            for j in range(ncols // 2):
+                stackup[i, j], stackup[i, ncols - 1 - j] = stackup[i, ncols - 1 - j], stackup[i, j]
@@ -0,0 +1,150 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import matplotlib
+import matplotlib.pyplot as plt
+matplotlib.use('Agg')
+import numpy as np
+import pandas as pd
+
+
+# Columns of the profile table with the significance bands of the profiles
+STATISTICS_COLUMNS = ['ci_low', 'ci_high', 'null_mean', 'null_low', 'null_high']
+
+def render_ipa_plot(profile, bw_file, output_dir, profile_2=None, extra_bw_file=None, roi_start_name=None, roi_end_name=None, flank=100_000, nbins=50, statistics=None, statistics_2=None):
+    """
+    Render an IPA plot from one or two aggregated profiles and save it to a .png file in `output_dir`.
+
+    Args:
+        profile: NumPy 1D array with the aggregated (mean) stackup profile of the first bigWig file.
+        bw_file: Path to (or name of) the first bigWig file.
+        output_dir: Path to the output directory which will store the output plot file.
+        profile_2: (optional) NumPy 1D array with the aggregated profile of the second bigWig file (default: None).
+        extra_bw_file: (optional) Path to (or name of) the second bigWig file (default: None).
+        roi_start_name: Alias for the start of the region of interest, e.g. TSS or loop start (default: None).
+        roi_end_name: Alias for the end of the region of interest, e.g. TES or loop end (default: None).
+        flank: Flank size in bp (default: 100_000).
+        nbins: Number of bins the ROI was split into (default: 50).
+        statistics: (optional) Dictionary with the significance statistics of the first profile (see `ipa.lib.calculate_profile_statistics`):
+            the bootstrap confidence interval is drawn as a band and the permutation null as a dashed line with a lighter band (default: None).
+        statistics_2: (optional) Dictionary with the significance statistics of the second profile (default: None).
+
+    Returns:
+        Path to the output plot file.
+    """
+    # IPA plot
+    f, ax1 = plt.subplots(figsize=[15, 5])
+
+    # Plot the first dataset
+    line1, = ax1.plot(profile, label=os.path.basename(bw_file))
+    _draw_statistics(ax1, statistics, line1.get_color())
+    ax1.set_xlabel(f'Distance from {roi_start_name}/{roi_end_name}, kbp')
+    ax1.set_ylabel(os.path.basename(bw_file))
+    ax1.set_title(os.path.basename(os.path.normpath(output_dir)))
+
+    # Make x-axis ticks
+    x_ticks = list(np.arange(0, nbins + 10, 10)) + list(np.arange(2 * nbins - 1, 3 * nbins, 10))
+    x_labels = [int(x) for x in list(np.linspace(-flank // 1000, 0, 6))[:-1]] + [roi_start_name, roi_end_name] + [int(x) for x in list(np.linspace(0, flank // 1000, 6))[1:]]
+
+    ax1.set_xticks(x_ticks)
+    ax1.set_xticklabels(x_labels)
+
+    # Create a second y-axis (optional)
+    if profile_2 is not None:
+        ax2 = ax1.twinx()
+        line2, = ax2.plot(profile_2, color='r', label=os.path.basename(extra_bw_file))
+        _draw_statistics(ax2, statistics_2, 'r')
+        ax2.set_ylabel(os.path.basename(extra_bw_file))
+        lines = [line1, line2]
+        output_plot_filename = os.path.join(output_dir, f"{os.path.basename(bw_file).split('.')[0]}_{os.path.basename(extra_bw_file).split('.')[0]}.png")
+    else:
+        lines = [line1]
+        output_plot_filename = os.path.join(output_dir, f"{os.path.basename(bw_file).split('.')[0]}.png")
+
+    # Combine legends
+    labels = [line.get_label() for line in lines]
+    ax1.legend(lines, labels, loc='best')
+
+    # Save the plot
+    f.savefig(output_plot_filename, dpi=300, bbox_inches='tight')
+    plt.close(f)
+
+    return output_plot_filename
+
+def _draw_statistics(ax, statistics, color):
+    """
+    Draw the bootstrap confidence interval and the permutation null of a profile in the color of its line.
+    """
+    if not statistics:
+        return
+    if 'ci_low' in statistics:
+        x = np.arange(len(statistics['ci_low']))
+        ax.fill_between(x, statistics['ci_low'], statistics['ci_high'], color=color, alpha=0.25, linewidth=0)
+    if 'null_mean' in statistics:
+        x = np.arange(len(statistics['null_mean']))
+        ax.plot(x, statistics['null_mean'], color=color, linestyle='--', linewidth=1)
+        ax.fill_between(x, statistics['null_low'], statistics['null_high'], color=color, alpha=0.1, linewidth=0)
+
+def render_profiles(profiles_file, output_dir, roi_start_name=None, roi_end_name=None):
+    """
+    Render IPA plots from a profile table written by `ipa_plot` in the profiles-only mode.
+    One plot is rendered per ROI set: the first bigWig file of the table is plotted on the main y-axis
+    and the second one (if any) on the second y-axis, like `ipa_plot` does, with the significance bands if the table has them.
+
+    Args:
+        profiles_file: Path to the profile table (.tsv or .parquet).
+        output_dir: Path to the output directory which will store the output plot files.
+        roi_start_name: Alias for the start of the region of interest, e.g. TSS or loop start (default: None).
+        roi_end_name: Alias for the end of the region of interest, e.g. TES or loop end (default: None).
+
+    Returns:
+        List of paths to the output plot files.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    profiles_df = read_profiles(profiles_file)
+
+    output_plot_filenames = []
+    for _, roi_profiles_df in profiles_df.groupby('roi', sort=False):
+        bw_names = roi_profiles_df['bigwig'].unique()
+        flank = int(roi_profiles_df['flank'].iloc[0])
+        nbins = len(roi_profiles_df) // len(bw_names) // 3
+        get_profile = lambda bw_name: roi_profiles_df.loc[roi_profiles_df['bigwig'] == bw_name].sort_values('bin')['mean'].to_numpy()
+        get_statistics = lambda bw_name: {column: values.to_numpy() for column, values in roi_profiles_df.loc[roi_profiles_df['bigwig'] == bw_name].sort_values('bin').items()
+                                          if column in STATISTICS_COLUMNS and not values.isna().all()}
+
+        profile_2, extra_bw_name = (get_profile(bw_names[1]), bw_names[1]) if len(bw_names) > 1 else (None, None)
+        statistics_2 = get_statistics(bw_names[1]) if len(bw_names) > 1 else None
+        output_plot_filenames.append(render_ipa_plot(get_profile(bw_names[0]), bw_names[0], output_dir, profile_2, extra_bw_name,
+                                                     roi_start_name, roi_end_name, flank, nbins, get_statistics(bw_names[0]), statistics_2))
+
+    return output_plot_filenames
+
+def render_profiles_batch(profiles_files, output_dir, roi_start_name=None, roi_end_name=None, nproc=4):
+    """
+    Render IPA plots from many profile tables in parallel, see `render_profiles`.
+
+    Args:
+        profiles_files: List of paths to the profile tables (.tsv or .parquet).
+        output_dir: Path to the output directory which will store the output plot files.
+        roi_start_name: Alias for the start of the region of interest, e.g. TSS or loop start (default: None).
+        roi_end_name: Alias for the end of the region of interest, e.g. TES or loop end (default: None).
+        nproc: Number of processes to render the plots with (default: 4).
+
+    Returns:
+        List of paths to the output plot files.
+    """
+    render = partial(render_profiles, output_dir=output_dir, roi_start_name=roi_start_name, roi_end_name=roi_end_name)
+    if nproc <= 1 or len(profiles_files) <= 1:
+        return [filename for profiles_file in profiles_files for filename in render(profiles_file)]
+
+    with ProcessPoolExecutor(max_workers=min(nproc, len(profiles_files))) as executor:
+        return [filename for filenames in executor.map(render, profiles_files) for filename in filenames]
+
+def read_profiles(profiles_file):
+    """
+    Read a profile table written by `ipa_plot` in the profiles-only mode (.tsv or .parquet).
+    """
+    if profiles_file.endswith('.parquet'):
+        return pd.read_parquet(profiles_file)
+    return pd.read_csv(profiles_file, sep='\t')
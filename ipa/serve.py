@@ -0,0 +1,365 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import math
+import os
+import threading
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+import pandas as pd
+
+from ipa.cache import file_identity, get_cache_dir, make_cache_key, split_cooler_uri
+from ipa.lib import calculate_banded_sum, get_expected_arrays, get_roi_windows, filter_regions, read_bigwig_intervals, create_stackup_plot_from_tracks, create_stackup_plot_from_intervals, create_profile_table, parse_memory
+
+
+# Messages of the service (shown by the CLI)
+logger = logging.getLogger(__name__)
+
+# Reason phrases of the HTTP status codes sent by the service
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+def serve(host='127.0.0.1', port=8765, socket_path=None, nworkers=4, cache_size='1G', block_size=1_000, cache_dir=None, chunksize=1_000_000):
+    """
+    Run the IPA query service: a local HTTP server that keeps the .cool and bigWig files open and answers region-scoped requests
+    for the IPA track and the stackup profiles, until it is interrupted. Requests are read by an asyncio event loop and calculated
+    concurrently by a pool of `nworkers` threads. The band sums are calculated in blocks of `block_size` bins with the 'banded'
+    engine and kept, together with the intervals of the bigWig files, in an LRU cache of `cache_size`, so that overlapping
+    and neighbouring windows (e.g. of a genome browser) are calculated once.
+
+    Endpoints (all parameters are query parameters, the regions of interest of /profile can be sent as a JSON body instead):
+        GET /track: IPA track of a region. Parameters: 'cool' (path to the .cool file or cooler URI), 'resolution' (optional, appended
+            to an .mcool path), 'chrom', 'start' and 'end' (optional, the whole chromosome by default), 'min_dist', 'max_dist'
+            (in bp or 'None'), 'expected' (0 or 1) and 'clr_weight_name', with the defaults of `ipa_track`.
+        GET or POST /profile: Aggregated profile of the stackup plot (see `create_profile_table`) of a bigWig file ('bw') or of the
+            IPA track of a .cool file ('cool' with the parameters of /track). The regions of interest are read from a BED file ('roi')
+            or from the 'regions' list of the JSON body, rows of [chrom, start, end, name, score, strand] with at least the first three
+            columns. Optional parameters: 'flank', 'nbins', 'min_roi_size' and 'max_roi_size', with the defaults of `ipa_plot`.
+        GET /status: Number of entries, size, hits and misses of the cache.
+
+    Args:
+        host: Host to listen on (default: '127.0.0.1').
+        port: Port to listen on (default: 8765).
+        socket_path: (optional) Path to a Unix socket to listen on instead of `host` and `port` (default: None).
+        nworkers: Number of threads that calculate the requests (default: 4).
+        cache_size: Memory budget of the cache in bytes or as a string like '1G' (default: '1G').
+        block_size: Number of bins of the cached blocks of band sums (default: 1_000).
+        cache_dir: (optional) Path to the directory to cache the expected in. If None, the expected is kept in the LRU cache only (default: None).
+        chunksize: Number of pixels to read from the .cool file at once (default: 1_000_000).
+    """
+    state = create_service_state(nworkers, cache_size, block_size, cache_dir, chunksize)
+    try:
+        asyncio.run(_run_server(state, host, port, socket_path))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        state['pool'].shutdown(wait=False)
+
+def create_service_state(nworkers=4, cache_size='1G', block_size=1_000, cache_dir=None, chunksize=1_000_000):
+    """
+    Create the state of the IPA query service (see `serve`): the worker pool, the LRU cache and the open file handles.
+    Requests can be answered without a server with `handle_request`, e.g. from a notebook.
+
+    Returns:
+        A dictionary with the state of the service.
+    """
+    assert block_size > 0, f"Block size must be positive, got {block_size}"
+    return {'pool': ThreadPoolExecutor(max_workers=nworkers), 'nproc': nworkers, 'cache': create_lru_cache(parse_memory(cache_size)),
+            'block_size': block_size, 'cache_dir': cache_dir, 'chunksize': chunksize, 'handles': {}, 'lock': threading.Lock()}
+
+def create_lru_cache(max_bytes):
+    """
+    Create a thread-safe LRU cache that holds at most `max_bytes` (at least its most recent entry), see `get_cached`.
+    """
+    return {'entries': OrderedDict(), 'nbytes': 0, 'max_bytes': max_bytes, 'hits': 0, 'misses': 0, 'pending': {}, 'lock': threading.Lock()}
+
+def get_cached(cache, key, compute, get_nbytes):
+    """
+    Get an entry of an LRU cache, or calculate it with `compute` and add it to the cache, evicting the least recently used entries
+    that exceed the size of the cache. Concurrent requests of a missing entry wait for the first one to calculate it.
+
+    Args:
+        cache: Cache created by `create_lru_cache`.
+        key: Hashable key of the entry.
+        compute: Function without arguments that calculates the entry.
+        get_nbytes: Function that returns the size of an entry in bytes.
+
+    Returns:
+        The entry.
+    """
+    with cache['lock']:
+        if key in cache['entries']:
+            cache['entries'].move_to_end(key)
+            cache['hits'] += 1
+            return cache['entries'][key][0]
+        key_lock = cache['pending'].setdefault(key, threading.Lock())
+
+    with key_lock:
+        # (the entry may have been calculated by another thread in the meantime)
+        with cache['lock']:
+            if key in cache['entries']:
+                cache['entries'].move_to_end(key)
+                cache['hits'] += 1
+                return cache['entries'][key][0]
+        try:
+            value = compute()
+            nbytes = get_nbytes(value)
+            with cache['lock']:
+                cache['misses'] += 1
+                cache['entries'][key] = (value, nbytes)
+                cache['nbytes'] += nbytes
+                while cache['nbytes'] > cache['max_bytes'] and len(cache['entries']) > 1:
+                    _, (_, evicted_nbytes) = cache['entries'].popitem(last=False)
+                    cache['nbytes'] -= evicted_nbytes
+        finally:
+            with cache['lock']:
+                cache['pending'].pop(key, None)
+
+    return value
+
+def _get_handle(state, path, open_file):
+    """
+    Get the handle of a file opened with `open_file(path)`, kept open between requests and reopened if the file has changed.
+
+    Returns:
+        A tuple (handle, file identity, see `file_identity`).
+    """
+    identity = file_identity(split_cooler_uri(path)[0])
+    with state['lock']:
+        if path in state['handles'] and state['handles'][path][1] == identity:
+            return state['handles'][path]
+    handle = (open_file(path), identity)
+    with state['lock']:
+        state['handles'][path] = handle
+    return handle
+
+def _get_track_params(params):
+    """
+    Parameters of the IPA track of a request: the cooler URI (with the optional 'resolution'), 'min_dist', 'max_dist', 'expected' and 'clr_weight_name'.
+    """
+    clr_path = _get_param(params, 'cool', str)
+    resolution = _get_param(params, 'resolution', int, None)
+    if resolution is not None:
+        clr_path = f"{clr_path}::resolutions/{resolution}"
+    get_dist = lambda value: None if value == 'None' else int(value)
+    return {'clr_path': clr_path, 'min_dist': _get_param(params, 'min_dist', get_dist, 40_000), 'max_dist': _get_param(params, 'max_dist', get_dist, 100_000),
+            'expected': _get_param(params, 'expected', lambda value: value.lower() in ('1', 'true'), False), 'clr_weight_name': _get_param(params, 'clr_weight_name', str, 'weight')}
+
+def _get_param(params, name, convert, default=KeyError):
+    """
+    Get a query parameter converted by `convert`. A missing parameter without a default raises a KeyError.
+    """
+    if name not in params:
+        if default is KeyError:
+            raise KeyError(f"Missing parameter '{name}'")
+        return default
+    return convert(params[name][-1])
+
+def get_band_sums(state, clr_path, chrom, row_lo, row_hi, min_dist=40_000, max_dist=100_000, expected=False, clr_weight_name='weight'):
+    """
+    Calculate the IPA track (sums of contacts inside the [`min_dist`, `max_dist`] diagonal band) for a range of bins of a chromosome.
+    The range is covered by blocks of `block_size` bins that are calculated with the 'banded' engine and kept in the cache of the service.
+
+    Returns:
+        A NumPy 1D array with the IPA track of the bins from `row_lo` to `row_hi` (NaN for the bins without contacts).
+    """
+    import cooler
+    clr, identity = _get_handle(state, clr_path, cooler.Cooler)
+    resolution, block_size = clr.binsize, state['block_size']
+    min_diag = math.floor(min_dist / resolution) if min_dist is not None else 0
+    max_diag = math.ceil(max_dist / resolution) if max_dist is not None else None
+    lo, hi = clr.extent(chrom)
+    assert 0 <= row_lo <= row_hi <= hi - lo, f"Bins {row_lo}-{row_hi} are outside of chromosome {chrom} with {hi - lo} bins"
+
+    # Expected values of the diagonals (optional), calculated or loaded from the cache directory once per .cool file
+    expected_arr = None
+    if expected:
+        from ipa.ipa import _load_expected
+        key = ('expected', make_cache_key(cooler=identity, clr_path=clr_path, clr_weight_name=clr_weight_name, min_diag=min_diag))
+        expected_arrs = get_cached(state['cache'], key, lambda: get_expected_arrays(_load_expected(clr, clr_path, clr_weight_name, state['nproc'], get_cache_dir(None, state['cache_dir'])), clr_weight_name, min_diag),
+                                   lambda expected_arrs: sum(expected_arr.nbytes for expected_arr in expected_arrs.values()))
+        expected_arr = expected_arrs[chrom]
+
+    # Band sums of the blocks that overlap the range
+    track_key = make_cache_key(cooler=identity, clr_path=clr_path, clr_weight_name=clr_weight_name, min_diag=min_diag, max_diag=max_diag, expected=expected)
+    blocks = []
+    for block_lo in range(row_lo // block_size * block_size, row_hi, block_size):
+        block_hi = min(block_lo + block_size, hi - lo)
+        blocks.append(get_cached(state['cache'], ('band_sums', track_key, chrom, block_lo),
+                                 lambda: calculate_banded_sum(clr, chrom, min_diag, max_diag, clr_weight_name, expected_arr, state['chunksize'], np.float64, block_lo, block_hi),
+                                 lambda block: block.nbytes))
+    offset = row_lo % block_size
+    ipa_track = np.concatenate(blocks)[offset:offset + row_hi - row_lo] if blocks else np.zeros(0)
+    ipa_track[ipa_track == 0.] = np.nan
+
+    return ipa_track
+
+def query_track(state, params):
+    """
+    Answer a /track request (see `serve`).
+
+    Returns:
+        A dictionary with the region, the bin size, the track parameters, the bin starts and the values (None for the bins without contacts).
+    """
+    import cooler
+    track_params = _get_track_params(params)
+    clr, _ = _get_handle(state, track_params['clr_path'], cooler.Cooler)
+    chrom = _get_param(params, 'chrom', str)
+    assert chrom in clr.chromnames, f"Chromosome {chrom} is not in {track_params['clr_path']}"
+    chromsize = int(clr.chromsizes[chrom])
+    start = max(0, _get_param(params, 'start', int, 0))
+    end = min(chromsize, _get_param(params, 'end', int, chromsize))
+    assert start < end, f"Region {chrom}:{start}-{end} is empty"
+
+    # Bins that overlap the region
+    resolution = clr.binsize
+    row_lo, row_hi = start // resolution, -(-end // resolution)
+    ipa_track = get_band_sums(state, row_lo=row_lo, row_hi=row_hi, chrom=chrom, **track_params)
+
+    return {**track_params, 'chrom': chrom, 'start': start, 'end': end, 'binsize': int(resolution),
+            'starts': (np.arange(row_lo, row_hi) * resolution).tolist(), 'values': _to_json_values(ipa_track)}
+
+def query_profile(state, params, body=None):
+    """
+    Answer a /profile request (see `serve`).
+
+    Returns:
+        A dictionary with the parameters of the profile, the number of regions and the columns of the profile table (see `create_profile_table`).
+    """
+    flank = _get_param(params, 'flank', int, 100_000)
+    nbins = _get_param(params, 'nbins', int, 50)
+    roi_df = filter_regions(_get_request_roi(params, body), _get_param(params, 'min_roi_size', int, None), _get_param(params, 'max_roi_size', int, None))
+    assert not roi_df.empty, "No regions of interest"
+
+    if 'bw' in params:
+        # Stackup plot of the bigWig file from its intervals, which are read once and kept in the cache
+        bw_file = _get_param(params, 'bw', str)
+        name = os.path.basename(bw_file)
+        intervals, chromsizes = get_cached(state['cache'], ('intervals', make_cache_key(bw=file_identity(bw_file))), lambda: read_bigwig_intervals(bw_file),
+                                           lambda bw_intervals: sum(array.nbytes for chrom_intervals in bw_intervals[0].values() for array in chrom_intervals))
+        stackup = create_stackup_plot_from_intervals(intervals, chromsizes, roi_df, flank, nbins)
+    else:
+        # Stackup plot of the IPA track calculated around the regions of interest only
+        import cooler
+        track_params = _get_track_params(params)
+        clr, _ = _get_handle(state, track_params['clr_path'], cooler.Cooler)
+        name = os.path.basename(track_params['clr_path'])
+        chrom_nbins = {chrom: int(np.diff(clr.extent(chrom))[0]) for chrom in clr.chromnames}
+        ipa_tracks = {chrom: np.full(nbins_chrom, np.nan) for chrom, nbins_chrom in chrom_nbins.items()}
+        for chrom, row_lo, row_hi in get_roi_windows(roi_df, flank, clr.binsize, chrom_nbins):
+            ipa_tracks[chrom][row_lo:row_hi] = get_band_sums(state, row_lo=row_lo, row_hi=row_hi, chrom=chrom, **track_params)
+        stackup = create_stackup_plot_from_tracks(ipa_tracks, clr.binsize, clr.chromsizes, roi_df, flank, nbins)
+
+    profiles_df = create_profile_table({name: stackup}, 'request', flank)
+    return {'name': name, 'flank': flank, 'nbins': nbins, 'n_regions': len(roi_df),
+            **{column: _to_json_values(profiles_df[column].to_numpy(dtype=np.float64)) for column in ['mean', 'median', 'sem', 'n']}}
+
+def _get_request_roi(params, body=None):
+    """
+    Regions of interest of a request: read from the BED file of the 'roi' parameter or from the 'regions' list of the JSON body.
+    """
+    if 'roi' in params:
+        from ipa.ipa import _read_roi
+        return _read_roi(_get_param(params, 'roi', str))
+
+    regions = json.loads(body)['regions'] if body else None
+    assert regions, "Regions of interest must be given as the 'roi' parameter or as the 'regions' list of the JSON body"
+    columns = ['chrom', 'start', 'end', 'name', 'score', 'strand'][:len(regions[0])]
+    assert len(columns) >= 3, "Regions of interest must have at least the columns chrom, start and end"
+    return pd.DataFrame(regions, columns=columns).astype({'chrom': str, 'start': np.int64, 'end': np.int64})
+
+def _to_json_values(values):
+    """
+    Convert a NumPy 1D array to a list for a JSON response, with None for NaN.
+    """
+    return [None if np.isnan(value) else value for value in values.tolist()]
+
+def handle_request(state, method, target, body=b''):
+    """
+    Answer a request of the IPA query service (see `serve`).
+
+    Args:
+        state: State of the service created by `create_service_state`.
+        method: HTTP method, 'GET' or 'POST'.
+        target: Request target with the path and the query parameters, e.g. '/track?cool=test.cool&chrom=chr1'.
+        body: (optional) Body of the request (default: b'').
+
+    Returns:
+        A tuple (HTTP status code, dictionary with the JSON response). Invalid requests get the status 400 with the error message.
+    """
+    url = urlsplit(target)
+    params = parse_qs(url.query)
+    routes = {'/track': ('GET',), '/profile': ('GET', 'POST'), '/status': ('GET',)}
+    if url.path not in routes:
+        return 404, {'error': f"Unknown endpoint {url.path}. Available endpoints: {', '.join(routes)}"}
+    if method not in routes[url.path]:
+        return 405, {'error': f"Method {method} is not allowed for {url.path}"}
+
+    try:
+        if url.path == '/track':
+            return 200, query_track(state, params)
+        elif url.path == '/profile':
+            return 200, query_profile(state, params, body)
+        else:
+            cache = state['cache']
+            with cache['lock']:
+                return 200, {'entries': len(cache['entries']), 'nbytes': cache['nbytes'], 'max_bytes': cache['max_bytes'], 'hits': cache['hits'], 'misses': cache['misses']}
+    except (AssertionError, KeyError, ValueError, FileNotFoundError) as error:
+        return 400, {'error': str(error).strip('"')}
+    except Exception as error:
+        return 500, {'error': f"{type(error).__name__}: {error}"}
+
+async def _run_server(state, host, port, socket_path=None):
+    """
+    Listen on the Unix socket `socket_path` or on `host`:`port` and answer the requests until the server is stopped.
+    """
+    handle_connection = lambda reader, writer: _handle_connection(state, reader, writer)
+    if socket_path is not None:
+        server = await asyncio.start_unix_server(handle_connection, path=socket_path)
+        logger.info(f"IPA query service is listening on {socket_path}")
+    else:
+        server = await asyncio.start_server(handle_connection, host, port)
+        logger.info(f"IPA query service is listening on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+async def _handle_connection(state, reader, writer):
+    """
+    Read HTTP/1.1 requests from a connection and answer them, calculating every request in the worker pool of the service.
+    The connection is kept alive until the client closes it or asks to close it.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            # Request line and headers
+            request_line = await reader.readline()
+            if not request_line.strip():
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            try:
+                method, target, _ = request_line.decode('latin-1').split()
+                status, response = await loop.run_in_executor(state['pool'], handle_request, state, method, target, body)
+            except ValueError:
+                status, response = 400, {'error': 'Malformed request line'}
+
+            payload = json.dumps(response).encode()
+            keep_alive = headers.get('connection', '').lower() != 'close'
+            writer.write(f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                         f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + payload)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
@@ -0,0 +1,96 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# Output formats of the IPA track and the extensions of their files
+TRACK_FORMATS = {'bigwig': '.bw', 'bedgraph': '.bedGraph', 'hdf5': '.h5', 'npz': '.npz'}
+
+def track_output_path(output_dir, output_format='bigwig'):
+    """
+    Get the path to the IPA track file of the given format in the output directory.
+    """
+    assert output_format in TRACK_FORMATS, f"Unknown output format {output_format}. Available formats: {', '.join(TRACK_FORMATS)}"
+    return os.path.join(output_dir, f"ipa_track{TRACK_FORMATS[output_format]}")
+
+def check_track_format(output_format):
+    """
+    Check that the output format of the IPA track is known and that the package it needs is installed,
+    so that a run fails before the track is calculated rather than when it is written.
+    """
+    assert output_format in TRACK_FORMATS, f"Unknown output format {output_format}. Available formats: {', '.join(TRACK_FORMATS)}"
+    if output_format == 'hdf5':
+        import importlib.util
+        if importlib.util.find_spec('h5py') is None:
+            raise ImportError("h5py is required for the 'hdf5' output format. Install h5py (pip install h5py or pip install ipa[hdf5]) or use another output format.")
+
+def open_track_writer(path, output_format, chromsizes, binsize):
+    """
+    Open a streaming writer of an IPA track. Chromosomes are written one at a time with `write_track_chrom` and the file
+    is written under a temporary name until `close_track_writer` is called, so that an interrupted run never leaves a broken track.
+    The bigWig file is written in-process with pyBigWig, without an external binary.
+
+    Args:
+        path: Path to the output file.
+        output_format: Format of the output file: 'bigwig', 'bedgraph', 'hdf5' (one dataset per chromosome) or 'npz' (one array per chromosome).
+        chromsizes: pandas Series with the chromosome sizes in bp, in the order of the chromosomes in the .cool file.
+        binsize: Bin size of the track in bp.
+
+    Returns:
+        A dictionary with the state of the writer.
+    """
+    check_track_format(output_format)
+    writer = {'path': path, 'tmp_path': path + '.tmp', 'format': output_format, 'chromsizes': chromsizes, 'binsize': binsize}
+
+    if output_format == 'bigwig':
+        import pyBigWig
+        writer['file'] = pyBigWig.open(writer['tmp_path'], 'w')
+        writer['file'].addHeader([(str(chrom), int(size)) for chrom, size in chromsizes.items()])
+    elif output_format == 'bedgraph':
+        writer['file'] = open(writer['tmp_path'], 'w')
+    elif output_format == 'hdf5':
+        import h5py
+        writer['file'] = h5py.File(writer['tmp_path'], 'w')
+        writer['file'].attrs['binsize'] = binsize
+    else:
+        import zipfile
+        writer['file'] = zipfile.ZipFile(writer['tmp_path'], 'w', allowZip64=True)
+
+    return writer
+
+def write_track_chrom(writer, chrom, ipa_track):
+    """
+    Write the IPA track of a chromosome. The bigWig and bedGraph formats skip the bins without a value (NaN), and need
+    the chromosomes to be written in the order of `chromsizes`; the array formats store the whole track of the chromosome.
+
+    Args:
+        writer: Writer opened with `open_track_writer`.
+        chrom: Chromosome name.
+        ipa_track: NumPy 1D array with the IPA track of the chromosome, one value per bin.
+    """
+    output_format, binsize = writer['format'], writer['binsize']
+
+    if output_format in ('bigwig', 'bedgraph'):
+        # Intervals of the bins with a value (the last bin of the chromosome ends at the chromosome end)
+        valid = np.flatnonzero(~np.isnan(ipa_track))
+        starts = valid * binsize
+        ends = np.minimum(starts + binsize, int(writer['chromsizes'][chrom]))
+        values = ipa_track[valid].astype(np.float64)
+
+        if output_format == 'bedgraph':
+            pd.DataFrame({'chrom': chrom, 'start': starts, 'end': ends, 'value': values}).to_csv(writer['file'], sep='\t', header=False, index=False)
+        elif len(valid):
+            writer['file'].addEntries([str(chrom)] * len(valid), starts.tolist(), ends=ends.tolist(), values=values.tolist())
+    elif output_format == 'hdf5':
+        writer['file'].create_dataset(str(chrom), data=ipa_track, compression='gzip')
+    else:
+        with writer['file'].open(f"{chrom}.npy", 'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, np.ascontiguousarray(ipa_track))
+
+def close_track_writer(writer):
+    """
+    Finish the IPA track file and move it from its temporary name to its path.
+    """
+    writer['file'].close()
+    os.replace(writer['tmp_path'], writer['path'])
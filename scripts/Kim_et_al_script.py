@@ -23,6 +23,7 @@ nbins = 50
 parser = argparse.ArgumentParser(description="Reproduce results of Kim et al. (2025) related to the IPA analysis.")
 parser.add_argument("--input-dir", type=str, required=True, help="Downloaded directory containing input data files (data_Kim_et_al).")
 parser.add_argument("--output-dir", type=str, required=True, help="Directory to save the output results.")
+parser.add_argument("--resume", action="store_true", default=False, help="Resume a killed run: species with finished tracks and plots are skipped, and the IPA track of an unfinished species is resumed from its chromosome checkpoints.")
 args = parser.parse_args()
 
 # Define the input and output directories
@@ -68,7 +69,8 @@ for species, params in tqdm(species_params.items()):
         roi_start_name="TSS" if species != "Sarc" else "RSS",
         roi_end_name="TES" if species != "Sarc" else "RES",
         flank=params["flank"],
-        nbins=nbins
+        nbins=nbins,
+        resume=args.resume
     )
 
     print(f"IPA analysis completed for {species}. Results saved to {species_output_dir}.")
@@ -18,8 +18,13 @@ setup(
         "cooler",
         "cooltools",
         "pybbi",
+        "pyBigWig",
         "tqdm",
     ],
+    extras_require={
+        "hdf5": ["h5py"],
+        "numba": ["numba"],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+# The synthetic data generators of the benchmarks (see benchmarks/synthetic.py)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'benchmarks'))
+from synthetic import make_chromsizes, make_loop_anchors, make_synthetic_cool, make_synthetic_bigwig, make_synthetic_bed
+
+
+@pytest.fixture(scope='session')
+def dataset(tmp_path_factory):
+    """
+    Tiny synthetic dataset: a balanced .cool file of 3 chromosomes (150, 100 and 50 bins of 10 kb), a bigWig signal and a BED file of stranded regions.
+    """
+    output_dir = tmp_path_factory.mktemp('dataset')
+    chromsizes = make_chromsizes(3_000_000, 3)
+    loop_anchors = make_loop_anchors(chromsizes, 200_000, seed=0)
+    return {
+        'chromsizes': chromsizes,
+        'resolution': 10_000,
+        'cool': make_synthetic_cool(str(output_dir / 'test.cool'), chromsizes, 10_000, max_dist=1_000_000, loop_anchors=loop_anchors, seed=0),
+        'bw': make_synthetic_bigwig(str(output_dir / 'test.bw'), chromsizes, 1000, loop_anchors=loop_anchors, seed=0),
+        'bed': make_synthetic_bed(str(output_dir / 'test.bed'), chromsizes, 40, max_size=50_000, flank=50_000, seed=0),
+    }
@@ -0,0 +1,41 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+from ipa import ipa_track, ipa_plot
+from ipa.cache import get_cache_dir
+from ipa.cli import main
+
+
+def test_get_cache_dir(tmp_path):
+    assert get_cache_dir(str(tmp_path), False) is None
+    assert get_cache_dir(None) is None
+    assert not os.listdir(tmp_path)
+    assert get_cache_dir(str(tmp_path)) == str(tmp_path / '.ipa_cache') and os.path.isdir(tmp_path / '.ipa_cache')
+    assert get_cache_dir(None, str(tmp_path / 'cache')) == str(tmp_path / 'cache')
+
+def test_output_dir_cache(dataset, tmp_path):
+    # Copies of the inputs in a directory of their own, which must stay untouched
+    input_dir = tmp_path / 'inputs'
+    input_dir.mkdir()
+    clr_path = shutil.copy(dataset['cool'], input_dir / 'test.cool')
+    bw_file = shutil.copy(dataset['bw'], input_dir / 'test.bw')
+
+    ipa_track(str(clr_path), str(tmp_path / 'track'), expected=True, min_dist=20_000, max_dist=200_000, nproc=1, cache_dir=False, output_format='npz')
+    ipa_plot(str(bw_file), dataset['bed'], str(tmp_path / 'plot'), flank=50_000, nbins=10, cache_dir=False, profiles_only=True)
+    assert not os.path.exists(tmp_path / 'track' / '.ipa_cache')
+    assert not os.path.exists(tmp_path / 'plot' / '.ipa_cache')
+
+    # The cache directories are created in the output directories by default
+    ipa_track(str(clr_path), str(tmp_path / 'track_cached'), expected=True, min_dist=20_000, max_dist=200_000, nproc=1, output_format='npz')
+    ipa_plot(str(bw_file), dataset['bed'], str(tmp_path / 'plot_cached'), flank=50_000, nbins=10, profiles_only=True)
+    assert os.listdir(tmp_path / 'track_cached' / '.ipa_cache')
+    assert os.listdir(tmp_path / 'plot_cached' / '.ipa_cache')
+    assert sorted(os.listdir(input_dir)) == ['test.bw', 'test.cool']
+
+def test_no_cache_with_cache_dir(dataset, tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['ipa', 'track', '-c', dataset['cool'], '-o', str(tmp_path), '--no-cache', '--cache-dir', str(tmp_path / 'cache')])
+    with pytest.raises(SystemExit):
+        main()
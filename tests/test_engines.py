@@ -0,0 +1,79 @@
+import math
+
+import numpy as np
+import pytest
+
+from ipa import ipa_track
+
+
+@pytest.fixture(scope='module')
+def cache_dir(tmp_path_factory):
+    return str(tmp_path_factory.mktemp('cache'))
+
+@pytest.fixture(scope='module')
+def reference_tracks(dataset):
+    """
+    IPA tracks calculated like the original implementation: the dense cis matrix of every chromosome, masked out diagonals,
+    divided by the expected matrix of `cooltools.expected_cis` (optional) and summed with `np.nansum`.
+    """
+    import bioframe
+    import cooler
+    import cooltools
+    clr = cooler.Cooler(dataset['cool'])
+    view_df = bioframe.make_viewframe(clr.chromsizes)
+
+    def calculate(expected, min_dist, max_dist):
+        min_diag = math.floor(min_dist / clr.binsize) if min_dist is not None else 0
+        max_diag = math.ceil(max_dist / clr.binsize) if max_dist is not None else math.inf
+        tracks = {}
+        for chrom in clr.chromnames:
+            cis_matrix = clr.matrix(balance='weight').fetch(chrom).astype(float)
+            diagonals = np.abs(np.subtract.outer(np.arange(len(cis_matrix)), np.arange(len(cis_matrix))))
+            cis_matrix[(diagonals < min_diag) | (diagonals > max_diag)] = np.nan
+            if expected:
+                expected_df = cooltools.expected_cis(clr, view_df=view_df[view_df['chrom'] == chrom], ignore_diags=min_diag, nproc=1, chunksize=1_000_000, clr_weight_name='weight')
+                cis_matrix /= expected_df['balanced.avg'].to_numpy()[diagonals]
+            ipa_track = np.nansum(cis_matrix, axis=1)
+            ipa_track[ipa_track == 0.] = np.nan
+            tracks[chrom] = ipa_track
+        return tracks
+
+    return calculate
+
+def load_track(output_dir):
+    with np.load(output_dir / 'ipa_track.npz') as f:
+        return {chrom: f[chrom] for chrom in f.files}
+
+@pytest.mark.parametrize('precision', ['float64', 'float32'])
+@pytest.mark.parametrize('min_dist, max_dist', [(40_000, 100_000), (20_000, None), (None, 200_000), (None, None)])
+@pytest.mark.parametrize('expected', [False, True])
+@pytest.mark.parametrize('engine', ['banded', 'dense'])
+def test_engine_parity(dataset, reference_tracks, cache_dir, tmp_path, engine, expected, min_dist, max_dist, precision):
+    ipa_track(dataset['cool'], str(tmp_path), expected=expected, min_dist=min_dist, max_dist=max_dist, nproc=1, engine=engine, cache_dir=cache_dir, precision=precision, output_format='npz')
+    track, reference = load_track(tmp_path), reference_tracks(expected, min_dist, max_dist)
+    assert list(track) == list(reference)
+    for chrom in reference:
+        np.testing.assert_allclose(track[chrom], reference[chrom], rtol=1e-12 if precision == 'float64' else 1e-5, equal_nan=True)
+
+@pytest.mark.parametrize('precision', ['float64', 'float32'])
+@pytest.mark.parametrize('min_dist, max_dist', [(40_000, 100_000), (None, 200_000), (20_000, 1_500_000)])
+def test_fused_engine_parity(dataset, reference_tracks, tmp_path, min_dist, max_dist, precision):
+    # The expected of the 'fused' engine comes from the same pass over the pixels instead of `cooltools.expected_cis`
+    ipa_track(dataset['cool'], str(tmp_path), expected=True, min_dist=min_dist, max_dist=max_dist, nproc=1, engine='fused', cache_dir=False, precision=precision, output_format='npz')
+    track, reference = load_track(tmp_path), reference_tracks(True, min_dist, max_dist)
+    assert list(track) == list(reference)
+    for chrom in reference:
+        np.testing.assert_allclose(track[chrom], reference[chrom], rtol=1e-12 if precision == 'float64' else 1e-5, equal_nan=True)
+
+@pytest.mark.parametrize('expected, max_dist, message', [(False, 100_000, "expected=True"), (True, None, "maximum distance")])
+def test_fused_engine_errors(dataset, tmp_path, expected, max_dist, message):
+    with pytest.raises(AssertionError, match=message):
+        ipa_track(dataset['cool'], str(tmp_path / 'track'), expected=expected, max_dist=max_dist, nproc=1, engine='fused', cache_dir=False, output_format='npz')
+    assert not (tmp_path / 'track').exists()
+
+def test_dense_engine_tiles(dataset, reference_tracks, cache_dir, tmp_path):
+    # A memory budget below the dense matrices of the chromosomes splits them into row tiles
+    ipa_track(dataset['cool'], str(tmp_path), expected=True, min_dist=20_000, max_dist=200_000, nproc=1, engine='dense', max_memory=50_000, cache_dir=cache_dir, output_format='npz')
+    track, reference = load_track(tmp_path), reference_tracks(True, 20_000, 200_000)
+    for chrom in reference:
+        np.testing.assert_allclose(track[chrom], reference[chrom], rtol=1e-12, equal_nan=True)
@@ -0,0 +1,38 @@
+import os
+import shutil
+from collections import namedtuple
+
+import numpy as np
+import pytest
+
+from ipa import ipa_track, ipa_index
+
+TRACK_PARAMS = {'nproc': 1, 'cache_dir': False, 'output_format': 'npz'}
+
+
+def load_track(output_dir):
+    with np.load(os.path.join(output_dir, 'ipa_track.npz')) as f:
+        return {chrom: f[chrom] for chrom in f.files}
+
+@pytest.fixture(scope='module', params=[False, True], ids=['observed', 'expected'])
+def index(dataset, tmp_path_factory, request):
+    # The index covers whole chromosomes (150 bins), so that tracks without a maximum distance can be calculated from it
+    output_dir = tmp_path_factory.mktemp('index')
+    return request.param, ipa_index(dataset['cool'], str(output_dir), max_dist=1_500_000, expected=request.param, nproc=1, cache_dir=False)
+
+@pytest.mark.parametrize('min_dist, max_dist', [(40_000, 100_000), (20_000, 1_000_000), (None, 200_000), (0, None)])
+def test_index_track(dataset, index, tmp_path, min_dist, max_dist):
+    expected, index_path = index
+    ipa_track(dataset['cool'], str(tmp_path / 'index'), expected=expected, min_dist=min_dist, max_dist=max_dist, index_path=index_path, **TRACK_PARAMS)
+    ipa_track(dataset['cool'], str(tmp_path / 'direct'), expected=expected, min_dist=min_dist, max_dist=max_dist, **TRACK_PARAMS)
+    track, reference = load_track(tmp_path / 'index'), load_track(tmp_path / 'direct')
+    assert list(track) == list(reference)
+    for chrom in reference:
+        np.testing.assert_allclose(track[chrom], reference[chrom], rtol=1e-12, atol=1e-12 * np.nanmax(reference[chrom]), equal_nan=True)
+
+def test_index_disk_space(dataset, tmp_path, monkeypatch):
+    # An index larger than the free disk space fails before the index file is created
+    monkeypatch.setattr(shutil, 'disk_usage', lambda path: namedtuple('usage', 'total used free')(10**6, 10**6 - 10**4, 10**4))
+    with pytest.raises(AssertionError, match="free"):
+        ipa_index(dataset['cool'], str(tmp_path), max_dist=1_000_000, nproc=1, cache_dir=False)
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.npy')]
@@ -0,0 +1,136 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('numba')
+
+import ipa.kernels
+from ipa.kernels import BACKEND_ENV, get_backend, set_backend
+from ipa.lib import mask_out_diagonals, calculate_observed_over_expected_matrix, calculate_banded_sum, calculate_fused_oe_sum, flip_stackup
+
+BACKENDS = ['numpy', 'numba']
+
+
+@pytest.fixture
+def restore_backend():
+    """
+    Restore the kernel backend selected before the test.
+    """
+    previous = get_backend()
+    yield
+    set_backend(previous)
+
+@pytest.fixture
+def backend(request, restore_backend):
+    """
+    Select the kernel backend of the test (parametrized with `indirect`), the previous backend is restored afterwards.
+    """
+    return set_backend(request.param)
+
+def get_diagonals(shape, row_offset, col_offset):
+    """
+    Diagonal of every element of a tile of a symmetric matrix.
+    """
+    return np.abs(np.subtract.outer(row_offset + np.arange(shape[0]), col_offset + np.arange(shape[1])))
+
+@pytest.fixture
+def pixels():
+    """
+    Tiny upper triangle of a 12 x 12 matrix as pixel arrays, with a masked out (NaN) pixel.
+    """
+    rng = np.random.default_rng(0)
+    bin1, bin2 = np.triu_indices(12)
+    values = rng.random(len(bin1))
+    values[5] = np.nan
+    return bin1, bin2, values
+
+def test_accumulate_band_sums(pixels):
+    from ipa import numba_kernels
+    bin1, bin2, values = pixels
+    expected_arr = np.linspace(1, 2, 12)
+    for row_lo, nrows, divide in [(0, 12, False), (4, 5, False), (4, 5, True)]:
+        ipa_track = np.zeros(nrows)
+        numba_kernels.accumulate_band_sums(ipa_track, bin1, bin2, values.copy(), row_lo, expected_arr if divide else np.empty(0))
+
+        # Every pixel is added to both of its bins within the rows
+        reference = np.zeros(nrows)
+        for i, j, value in zip(bin1, bin2, values / expected_arr[bin2 - bin1] if divide else values):
+            for row in {i, j}:
+                if row_lo <= row < row_lo + nrows and not np.isnan(value):
+                    reference[row - row_lo] += value
+        np.testing.assert_allclose(ipa_track, reference, rtol=1e-12)
+
+def test_accumulate_diagonal_sums(pixels):
+    from ipa import numba_kernels
+    bin1, bin2, values = pixels
+    min_diag, max_diag = 2, 6
+    band = (bin2 - bin1 >= min_diag) & (bin2 - bin1 <= max_diag)
+    bin1, bin2, values = bin1[band], bin2[band], values[band]
+    diag_sums, partial_sums = np.zeros(max_diag - min_diag + 1), np.zeros((12, max_diag - min_diag + 1))
+    numba_kernels.accumulate_diagonal_sums(diag_sums, partial_sums, bin1, bin2, values, min_diag)
+
+    valid = ~np.isnan(values)
+    diag = bin2[valid] - bin1[valid] - min_diag
+    reference_partial_sums = np.zeros_like(partial_sums)
+    np.add.at(reference_partial_sums, (bin1[valid], diag), values[valid])
+    np.add.at(reference_partial_sums, (bin2[valid], diag), values[valid])
+    np.testing.assert_allclose(diag_sums, np.bincount(diag, weights=values[valid], minlength=len(diag_sums)), rtol=1e-12)
+    np.testing.assert_allclose(partial_sums, reference_partial_sums, rtol=1e-12)
+
+@pytest.mark.parametrize('backend', BACKENDS, indirect=True)
+@pytest.mark.parametrize('row_offset, col_offset', [(0, 0), (6, 2), (2, 6), (8, 0)])
+@pytest.mark.parametrize('min_diag, max_diag', [(0, None), (2, None), (2, 4)])
+def test_mask_out_diagonals(backend, row_offset, col_offset, min_diag, max_diag):
+    matrix = np.ones((5, 7))
+    mask_out_diagonals(matrix, min_diag, max_diag, row_offset, col_offset)
+    diagonals = get_diagonals(matrix.shape, row_offset, col_offset)
+    np.testing.assert_array_equal(np.isnan(matrix), (diagonals < min_diag) | (diagonals > (np.inf if max_diag is None else max_diag)))
+
+@pytest.mark.parametrize('backend', BACKENDS, indirect=True)
+@pytest.mark.parametrize('row_offset, col_offset', [(0, 0), (6, 2), (2, 6)])
+@pytest.mark.parametrize('max_diag', [None, 4])
+def test_observed_over_expected_tile(backend, row_offset, col_offset, max_diag):
+    # Masked tile of the rows and columns around them, like the row tiles of the 'dense' engine
+    rng = np.random.default_rng(0)
+    matrix = rng.random((5, 7)) if (row_offset, col_offset) != (0, 0) else rng.random((7, 7))
+    expected_arr = rng.random(16) + 0.5
+    mask_out_diagonals(matrix, 1, max_diag, row_offset, col_offset)
+    reference = matrix / expected_arr[get_diagonals(matrix.shape, row_offset, col_offset)]
+    np.testing.assert_allclose(calculate_observed_over_expected_matrix(matrix, expected_arr, 1, max_diag, row_offset, col_offset), reference, rtol=1e-15)
+
+@pytest.mark.parametrize('backend', BACKENDS, indirect=True)
+def test_flip_stackup(backend):
+    stackup = np.arange(20.).reshape(4, 5)
+    flip = np.array([True, False, False, True])
+    reference = np.where(flip[:, None], stackup[:, ::-1], stackup)
+    flip_stackup(stackup, flip)
+    np.testing.assert_array_equal(stackup, reference)
+
+def test_band_sums_parity(dataset, restore_backend):
+    # Sums of the pixels of a synthetic .cool file with both backends, on whole chromosomes and on a row tile
+    import cooler
+    clr = cooler.Cooler(dataset['cool'])
+    expected_arr = 1 / (np.arange(150) + 1.)
+    results = {}
+    for backend in BACKENDS:
+        set_backend(backend)
+        results[backend] = [
+            calculate_banded_sum(clr, 'chr1', 2, 20, 'weight'),
+            calculate_banded_sum(clr, 'chr1', 2, 20, 'weight', expected_arr, row_lo=60, row_hi=90),
+            calculate_fused_oe_sum(clr, 'chr1', 2, 20, 'weight'),
+        ]
+    for result, reference in zip(results['numba'], results['numpy']):
+        np.testing.assert_allclose(result, reference, rtol=1e-12)
+
+def test_backend_state(monkeypatch, restore_backend):
+    # The environment variable is only the initial backend, `set_backend` does not change the environment
+    monkeypatch.setattr(ipa.kernels, '_backend', None)
+    monkeypatch.setenv(BACKEND_ENV, 'numba')
+    assert get_backend() == 'numba'
+    monkeypatch.setenv(BACKEND_ENV, 'numpy')
+    assert get_backend() == 'numba'
+    assert set_backend('numpy') == 'numpy' and get_backend() == 'numpy'
+    assert os.environ[BACKEND_ENV] == 'numpy'
+    assert set_backend('auto') == 'numba' and os.environ[BACKEND_ENV] == 'numpy'
+    assert ipa.kernels.get_numba_kernels() is not None and ipa.kernels.get_numba_kernels('numpy') is None
@@ -0,0 +1,14 @@
+import logging
+
+from ipa import ipa_track
+
+
+def test_track_messages_are_logged(dataset, tmp_path, capsys, caplog):
+    # Progress messages go to the 'ipa' loggers, not to stdout
+    with caplog.at_level(logging.INFO, logger='ipa'):
+        for _ in range(2):
+            ipa_track(dataset['cool'], str(tmp_path), min_dist=20_000, max_dist=200_000, nproc=1, cache_dir=False, output_format='npz', resume=True)
+    assert capsys.readouterr().out == ''
+    messages = [record.getMessage() for record in caplog.records]
+    assert any(message.startswith("Peak RSS") for message in messages)
+    assert any(message.endswith("is up to date, skipping it") for message in messages)
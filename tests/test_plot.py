@@ -0,0 +1,42 @@
+import os
+import shutil
+import sys
+import threading
+import time
+
+import pandas as pd
+
+from ipa import ipa_plot_batch
+from ipa.lib import calculate_null_profiles
+
+
+def test_plot_batch_null_one_bigwig_at_a_time(dataset, tmp_path, monkeypatch):
+    extra_bw_files = [shutil.copy(dataset['bw'], tmp_path / f'extra{i}.bw') for i in range(3)]
+
+    # Counts the bigWig files whose intervals are in memory at the same time
+    lock = threading.Lock()
+    counts = {'active': 0, 'max': 0}
+    def counting_null_profiles(*args):
+        with lock:
+            counts['active'] += 1
+            counts['max'] = max(counts['max'], counts['active'])
+        time.sleep(0.05)
+        try:
+            return calculate_null_profiles(*args)
+        finally:
+            with lock:
+                counts['active'] -= 1
+    monkeypatch.setattr(sys.modules['ipa.ipa'], 'calculate_null_profiles', counting_null_profiles)
+
+    tables = {}
+    for nproc in (1, 3):
+        output_dir = tmp_path / f'plot_{nproc}'
+        ipa_plot_batch(dataset['bw'], dataset['bed'], str(output_dir), [str(f) for f in extra_bw_files], flank=50_000, nbins=10, nproc=nproc,
+                       cache_dir=False, profiles_only=True, n_perm=5, seed=0)
+        tables[nproc] = {name: pd.read_csv(output_dir / name, sep='\t') for name in sorted(os.listdir(output_dir))}
+    assert counts['max'] == 1
+
+    # The null does not depend on the number of threads
+    assert tables[1].keys() == tables[3].keys() and len(tables[1]) == 3
+    for name in tables[1]:
+        pd.testing.assert_frame_equal(tables[1][name], tables[3][name])
@@ -0,0 +1,43 @@
+import os
+
+import pandas as pd
+
+from ipa import ipa_plot
+from ipa.ipa import _read_roi
+
+
+def write_bed12(bed_file, path, header=True):
+    """
+    Write the regions of a BED6 file as a BED12 file (one block per region), with track, browser and comment lines if `header` is True.
+    """
+    bed_df = pd.read_csv(bed_file, sep='\t', header=None)
+    sizes = bed_df[2] - bed_df[1]
+    bed12_df = pd.concat([bed_df, bed_df[1], bed_df[2], pd.Series(0, index=bed_df.index), pd.Series(1, index=bed_df.index),
+                          sizes.astype(str) + ',', pd.Series('0,', index=bed_df.index)], axis=1)
+    with open(path, 'w') as f:
+        if header:
+            f.write('track name=regions description="regions of interest"\nbrowser position chr1:1-100000\n# comment\n')
+        bed12_df.to_csv(f, sep='\t', header=False, index=False)
+    return path
+
+def test_read_bed12_with_header(dataset, tmp_path):
+    roi_df = _read_roi(dataset['bed'])
+    bed12_df = _read_roi(write_bed12(dataset['bed'], tmp_path / 'roi.bed'))
+    assert list(bed12_df.columns) == ['chrom', 'start', 'end', 'name', 'score', 'strand']
+    pd.testing.assert_frame_equal(bed12_df, roi_df)
+
+def test_read_bed3(dataset, tmp_path):
+    bed_df = pd.read_csv(dataset['bed'], sep='\t', header=None)
+    bed_df[[0, 1, 2]].to_csv(tmp_path / 'roi.bed', sep='\t', header=False, index=False)
+    roi_df = _read_roi(tmp_path / 'roi.bed', min_roi_size=10_000)
+    assert (roi_df['strand'] == '.').all() and (roi_df['name'] == '.').all() and (roi_df['score'] == 0).all()
+    assert (roi_df['end'] - roi_df['start'] >= 10_000).all()
+
+def test_plot_bed12(dataset, tmp_path):
+    # The profiles of the regions of a BED12 file with a header are the ones of the BED6 file
+    bed12_file = write_bed12(dataset['bed'], tmp_path / 'roi12.bed')
+    for roi_file, output_dir in ((dataset['bed'], tmp_path / 'bed6'), (bed12_file, tmp_path / 'bed12')):
+        ipa_plot(dataset['bw'], str(roi_file), str(output_dir), flank=50_000, nbins=10, cache_dir=False, profiles_only=True)
+    profiles = [pd.read_csv(os.path.join(output_dir, os.listdir(output_dir)[0]), sep='\t') for output_dir in (tmp_path / 'bed6', tmp_path / 'bed12')]
+    # (the 'roi' column is named after the BED file)
+    pd.testing.assert_frame_equal(profiles[0].drop(columns='roi'), profiles[1].drop(columns='roi'))
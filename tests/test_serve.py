@@ -0,0 +1,120 @@
+import json
+import os
+from urllib.parse import urlencode
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ipa import ipa_track, ipa_plot
+from ipa.ipa import _read_roi
+from ipa.lib import create_stackup_plot_from_tracks, create_profile_table
+from ipa.serve import create_service_state, create_lru_cache, get_cached, handle_request
+
+TRACK_PARAMS = {'min_dist': 20_000, 'max_dist': 200_000}
+
+
+@pytest.fixture(scope='module')
+def cache_dir(tmp_path_factory):
+    return str(tmp_path_factory.mktemp('cache'))
+
+@pytest.fixture(scope='module')
+def state(cache_dir):
+    # Blocks of 40 bins, so that the regions span several cached blocks
+    state = create_service_state(nworkers=1, cache_size='64M', block_size=40, cache_dir=cache_dir)
+    yield state
+    state['pool'].shutdown()
+
+@pytest.fixture(scope='module')
+def tracks(dataset, cache_dir, tmp_path_factory):
+    """
+    IPA tracks of the whole .cool file calculated by `ipa_track`, without and with the expected (0 for the bins without contacts, like the service).
+    """
+    tracks = {}
+    for expected in (False, True):
+        output_dir = tmp_path_factory.mktemp('track')
+        ipa_track(dataset['cool'], str(output_dir), expected=expected, nproc=1, cache_dir=cache_dir, output_format='npz', **TRACK_PARAMS)
+        with np.load(output_dir / 'ipa_track.npz') as f:
+            tracks[expected] = {chrom: np.where(f[chrom] == 0, np.nan, f[chrom]) for chrom in f.files}
+    return tracks
+
+def request(state, path, method='GET', body=b'', **params):
+    return handle_request(state, method, f"{path}?{urlencode(params)}", body)
+
+@pytest.mark.parametrize('expected', [False, True])
+def test_track(dataset, state, tracks, expected):
+    status, response = request(state, '/track', cool=dataset['cool'], chrom='chr1', start=235_000, end=1_234_567, expected=int(expected), **TRACK_PARAMS)
+    assert status == 200
+    assert response['starts'][0] == 230_000 and response['starts'][-1] == 1_230_000
+    values = np.array([np.nan if value is None else value for value in response['values']])
+    np.testing.assert_allclose(values, tracks[expected]['chr1'][23:124], rtol=1e-12)
+
+def test_profile_bw(dataset, state, cache_dir, tmp_path):
+    status, response = request(state, '/profile', bw=dataset['bw'], roi=dataset['bed'], flank=50_000, nbins=10)
+    assert status == 200 and response['n_regions'] == len(_read_roi(dataset['bed']))
+
+    # Same profile as `ipa plot`
+    ipa_plot(dataset['bw'], dataset['bed'], str(tmp_path), flank=50_000, nbins=10, cache_dir=cache_dir, profiles_only=True)
+    profiles_df = pd.read_csv(tmp_path / os.listdir(tmp_path)[0], sep='\t')
+    np.testing.assert_allclose(np.array(response['mean'], dtype=float), profiles_df['mean'], rtol=1e-9)
+
+def test_profile_cool(dataset, state, tracks):
+    status, response = request(state, '/profile', cool=dataset['cool'], roi=dataset['bed'], flank=50_000, nbins=10, expected=1, **TRACK_PARAMS)
+    assert status == 200
+
+    # Same profile as the stackup plot of the whole track
+    import cooler
+    clr = cooler.Cooler(dataset['cool'])
+    stackup = create_stackup_plot_from_tracks(tracks[True], clr.binsize, clr.chromsizes, _read_roi(dataset['bed']), 50_000, 10)
+    profiles_df = create_profile_table({'track': stackup}, 'request', 50_000)
+    np.testing.assert_allclose(np.array(response['mean'], dtype=float), profiles_df['mean'], rtol=1e-9)
+
+def test_profile_post(dataset, state):
+    roi_df = _read_roi(dataset['bed'])
+    body = json.dumps({'regions': roi_df.values.tolist()}).encode()
+    status, response = request(state, '/profile', method='POST', body=body, bw=dataset['bw'], flank=50_000, nbins=10)
+    assert status == 200
+    assert response == request(state, '/profile', bw=dataset['bw'], roi=dataset['bed'], flank=50_000, nbins=10)[1]
+
+def test_status(dataset, state):
+    request(state, '/track', cool=dataset['cool'], chrom='chr2', **TRACK_PARAMS)
+    hits = request(state, '/status')[1]['hits']
+    request(state, '/track', cool=dataset['cool'], chrom='chr2', **TRACK_PARAMS)
+    status, response = request(state, '/status')
+    assert status == 200
+    assert response['hits'] > hits and response['entries'] > 0 and 0 < response['nbytes'] <= response['max_bytes']
+
+@pytest.mark.parametrize('path, method, body, params', [
+    ('/track', 'GET', b'', {'chrom': 'chr1'}),
+    ('/track', 'GET', b'', {'cool': 'missing.cool', 'chrom': 'chr1'}),
+    ('/track', 'GET', b'', {'cool': None, 'chrom': 'chrX'}),
+    ('/track', 'GET', b'', {'cool': None, 'chrom': 'chr1', 'start': 'abc'}),
+    ('/track', 'GET', b'', {'cool': None, 'chrom': 'chr1', 'start': 100_000, 'end': 50_000}),
+    ('/profile', 'GET', b'', {'bw': None}),
+    ('/profile', 'POST', b'{"regions": []}', {'bw': None}),
+    ('/profile', 'GET', b'', {'bw': None, 'roi': None, 'min_roi_size': 10 ** 9}),
+])
+def test_bad_requests(dataset, state, path, method, body, params):
+    # (None stands for the path of the test file)
+    params = {name: dataset[{'cool': 'cool', 'bw': 'bw', 'roi': 'bed'}[name]] if value is None else value for name, value in params.items()}
+    status, response = request(state, path, method, body, **params)
+    assert status == 400 and response['error']
+
+def test_unknown_requests(state):
+    assert request(state, '/unknown')[0] == 404
+    assert request(state, '/track', method='POST')[0] == 405
+
+def test_lru_eviction():
+    cache = create_lru_cache(100)
+    for key in range(4):
+        get_cached(cache, key, lambda: np.zeros(5), lambda value: value.nbytes)
+    assert cache['nbytes'] <= 100 and list(cache['entries']) == [2, 3]
+
+    # A hit makes the entry the most recently used one, which is kept
+    get_cached(cache, 2, lambda: pytest.fail("The entry is cached"), lambda value: value.nbytes)
+    get_cached(cache, 4, lambda: np.zeros(5), lambda value: value.nbytes)
+    assert list(cache['entries']) == [2, 4] and (cache['hits'], cache['misses']) == (1, 5)
+
+    # An entry larger than the cache is kept alone
+    get_cached(cache, 5, lambda: np.zeros(20), lambda value: value.nbytes)
+    assert list(cache['entries']) == [5] and cache['nbytes'] == 160
@@ -0,0 +1,56 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from ipa import ipa_track, ipa_merge
+from ipa.checkpoint import shard_output_path, load_shard
+
+TRACK_PARAMS = {'min_dist': 20_000, 'max_dist': 200_000, 'nproc': 1, 'output_format': 'npz'}
+NSHARDS = 4
+
+
+def load_track(output_dir):
+    with np.load(os.path.join(output_dir, 'ipa_track.npz')) as f:
+        return {chrom: f[chrom] for chrom in f.files}
+
+def calculate_shards(clr_path, output_dir, nshards=NSHARDS, **params):
+    for i in range(1, nshards + 1):
+        ipa_track(clr_path, str(output_dir), shard=f"{i}/{nshards}", **{**TRACK_PARAMS, **params})
+    return [shard_output_path(str(output_dir), i, nshards) for i in range(1, nshards + 1)]
+
+@pytest.mark.parametrize('engine, expected', [('banded', False), ('banded', True), ('dense', True)])
+def test_merge(dataset, tmp_path, engine, expected):
+    cache_dir = str(tmp_path / 'cache')
+    ipa_track(dataset['cool'], str(tmp_path / 'track'), engine=engine, expected=expected, cache_dir=cache_dir, **TRACK_PARAMS)
+    shard_paths = calculate_shards(dataset['cool'], tmp_path / 'shards', engine=engine, expected=expected, cache_dir=cache_dir)
+
+    # The largest chromosome (half of the pixels) is split into row segments over several shards
+    segments = [tile for path in shard_paths for tile in load_shard(path)[0]['tiles'] if tile[0] == 'chr1']
+    assert len(segments) > 1 and any(row_lo > 0 for _, row_lo, _ in segments)
+
+    ipa_merge([str(tmp_path / 'shards')], str(tmp_path / 'merged'), output_format='npz')
+    track, merged_track = load_track(tmp_path / 'track'), load_track(tmp_path / 'merged')
+    assert list(merged_track) == list(track)
+    for chrom in track:
+        np.testing.assert_allclose(merged_track[chrom], track[chrom], rtol=1e-12, equal_nan=True)
+
+def test_merge_errors(dataset, tmp_path):
+    shard_paths = calculate_shards(dataset['cool'], tmp_path / 'shards')
+
+    # Missing shard
+    with pytest.raises(AssertionError, match="missing"):
+        ipa_merge(shard_paths[1:], str(tmp_path / 'merged'), output_format='npz')
+
+    # Duplicated shard
+    duplicate_path = str(tmp_path / 'duplicate.npz')
+    shutil.copy(shard_paths[0], duplicate_path)
+    with pytest.raises(AssertionError, match="more than once"):
+        ipa_merge(shard_paths + [duplicate_path], str(tmp_path / 'merged'), output_format='npz')
+
+    # Shard of another track (different parameters)
+    other_paths = calculate_shards(dataset['cool'], tmp_path / 'other', min_dist=40_000)
+    with pytest.raises(AssertionError, match="another IPA track"):
+        ipa_merge(shard_paths[:-1] + other_paths[-1:], str(tmp_path / 'merged'), output_format='npz')
+    assert not os.path.exists(tmp_path / 'merged')
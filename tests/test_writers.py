@@ -0,0 +1,34 @@
+import importlib.util
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ipa import ipa_track
+from ipa.writers import open_track_writer, write_track_chrom, close_track_writer
+
+
+def test_bigwig_writer(tmp_path):
+    import pyBigWig
+
+    chromsizes = pd.Series({'chr1': 2500, 'chr2': 1000})
+    tracks = {'chr1': np.array([1., np.nan, 3.]), 'chr2': np.array([np.nan])}
+    writer = open_track_writer(str(tmp_path / 'ipa_track.bw'), 'bigwig', chromsizes, 1000)
+    for chrom, track in tracks.items():
+        write_track_chrom(writer, chrom, track)
+    close_track_writer(writer)
+
+    # Bins without a value are skipped, the last bin ends at the chromosome end
+    with pyBigWig.open(str(tmp_path / 'ipa_track.bw')) as f:
+        assert f.chroms() == {'chr1': 2500, 'chr2': 1000}
+        assert f.intervals('chr1') == ((0, 1000, 1.), (2000, 2500, 3.))
+        assert f.intervals('chr2') is None
+
+def test_hdf5_without_h5py(dataset, tmp_path, monkeypatch):
+    find_spec = importlib.util.find_spec
+    monkeypatch.setattr(importlib.util, 'find_spec', lambda name, *args: None if name == 'h5py' else find_spec(name, *args))
+    with pytest.raises(ImportError, match='h5py'):
+        ipa_track(dataset['cool'], str(tmp_path / 'output'), output_format='hdf5')
+    # The run fails before anything is calculated or written
+    assert not os.path.exists(tmp_path / 'output')